@@ -0,0 +1,133 @@
+import mmap
+import os
+import pickle
+import zlib
+from hashlib import blake2b
+from pathlib import Path
+from threading import Lock
+
+from src.Config import get_logger
+from src.FileTracker import stat_signature
+
+logger_name, logger = get_logger(__name__)
+
+
+# Content defined chunking: files are cut where their contents look a certain way (not at fixed offsets), so inserting data only changes
+# the chunks around the insertion and the same data is cut into the same chunks in every file. Both sides keep an index of the chunks of
+# their files (ChunkStore) and only the chunks the receiver can't find anywhere locally are transferred.
+#
+# Cut points are searched for at anchors (newlines, found with bytes.find instead of rolling a hash over every byte in python).
+# An anchor is a cut point if the hash of the WINDOW bytes before it matches BOUNDARY_MASK. Data without anchors (e.g. runs of zeros)
+# is cut at MAX_CHUNK_SIZE.
+
+MIN_CHUNKED_SIZE = 1024 * 1024 # smaller files are sent whole
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+WINDOW = 48
+BOUNDARY_MASK = 0x7f # 1 in 128 anchors is a cut point (~every 32 KiB of random data, more often in text)
+ANCHOR = b"\n"
+DIGEST_SIZE = 16
+MAX_BATCH_SIZE = 1024 * 1024 # chunks are sent in messages of about this size
+
+
+
+def boundaries(data) -> list:
+    """ end offsets of the chunks of *data* (bytes or mmap) """
+    ends, start, size = [], 0, len(data)
+    while size - start > MAX_CHUNK_SIZE:
+        pos, cut = start + MIN_CHUNK_SIZE, start + MAX_CHUNK_SIZE
+        while (anchor := data.find(ANCHOR, pos, cut)) != -1:
+            pos = anchor + 1
+            if zlib.crc32(data[pos - WINDOW:pos]) & BOUNDARY_MASK == 0:
+                cut = pos
+                break
+        ends.append(cut)
+        start = cut
+    if size > start: ends.append(size)
+    return ends
+
+
+def digest(data) -> bytes:
+    return blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def chunk_file(path) -> list:
+    """ recipe of the file at *path*: (digest, length) of its chunks in order """
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0: return []
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            recipe, start = [], 0
+            for end in boundaries(data):
+                recipe.append((digest(data[start:end]), end - start))
+                start = end
+            return recipe
+
+
+def offsets(recipe) -> list:
+    """ start offsets of the chunks of *recipe* """
+    result, offset = [], 0
+    for _, length in recipe:
+        result.append(offset)
+        offset += length
+    return result
+
+
+
+class ChunkStore:
+    """
+    index of the chunks of local files (digest -> where to find it). The index is not kept up to date when files change, chunks are
+    verified when they are read instead. Saved in the data directory
+    """
+    def __init__(self, path:Path):
+        self.path = path
+        self.chunks = {} # digest -> (file path, offset, length)
+        self.files = {} # file path -> (stat signature, recipe) of the indexed files
+        self.lock = Lock() # shared by the server and all clients
+        if self.path.exists():
+            try: self.chunks, self.files = pickle.loads(self.path.read_bytes())
+            except Exception: logger.exception(f"Could not load chunk index {self.path}, starting with an empty one")
+
+    def recipe(self, path) -> list:
+        """ recipe of the file at *path*, the file is (re)chunked and indexed if it changed since it was indexed """
+        path = os.path.abspath(path)
+        signature = stat_signature(os.stat(path))
+        with self.lock:
+            if path in self.files and self.files[path][0] == signature: return self.files[path][1]
+        recipe = chunk_file(path)
+        self.add(path, recipe, signature)
+        return recipe
+
+    def add(self, path, recipe, signature=None) -> None:
+        """ indexes the chunks of the file at *path* which consists of *recipe* """
+        path = os.path.abspath(path)
+        if signature is None: signature = stat_signature(os.stat(path))
+        with self.lock:
+            self.files[path] = (signature, recipe)
+            for (chunk, length), offset in zip(recipe, offsets(recipe)):
+                self.chunks[chunk] = (path, offset, length)
+
+    def read(self, chunk) -> bytes:
+        """ contents of *chunk* if it can be found locally, else None """
+        with self.lock: location = self.chunks.get(chunk)
+        if location is None: return None
+        path, offset, length = location
+        try:
+            with open(path, "rb") as file:
+                file.seek(offset)
+                data = file.read(length)
+        except OSError: data = b""
+        if len(data) == length and digest(data) == chunk: return data
+        with self.lock: # the file changed since it was indexed
+            if self.chunks.get(chunk) == location: del self.chunks[chunk]
+            self.files.pop(path, None)
+        return None
+
+    def __contains__(self, chunk): return chunk in self.chunks
+
+    def save(self):
+        with self.lock:
+            self.files = {path: entry for path, entry in self.files.items() if os.path.isfile(path)}
+            self.chunks = {chunk: location for chunk, location in self.chunks.items() if location[0] in self.files}
+            data = pickle.dumps((self.chunks, self.files))
+        self.path.write_bytes(data)
+        logger.info(f"Save chunk index ({len(self.chunks)} chunks of {len(self.files)} files)")
@@ -1,15 +1,30 @@
 import copy
 import os
 import pickle 
+import shutil
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
 
 from pathlib import Path
-from threading import Event, Thread
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, RLock, Thread
 
 from imohash import hashfile
+from imohash.imohash import SAMPLE_THRESHOLD
 from send2trash import send2trash
 
+from src.Chunks import MIN_CHUNKED_SIZE, digest, offsets
 from src.Config import DEFAULT_TIME, get_logger
-from src.Network import NT_Code, Socket
+from src.Delta import MIN_DELTA_SIZE, block_size_for, patch, signature
+from src.Compression import choose_codec
+from src.FileTracker import Folder
+from src.Merge import contents
+from src.Limits import UNLIMITED
+from src.Network import CAP_CHUNKS, CAP_COMPRESSION, CAP_LANES, CAP_RANGES, CAP_STREAMS, FileChangedError, NT_Code, Socket, part_path
+from src.Staging import Staging
+from src.Streams import Multiplexer
+from src.Swarm import MIN_RANGED_SIZE
 from src.utils import copy_name, NestedDict
 from src.Codes import CONFLICT_POLICY, CONFLICT_TYPE, RESOLVE_POLICY, SYNC_STATUS, SYNC_RET_CODE
 
@@ -18,11 +33,40 @@ logger_name, logger = get_logger(__name__)
 
 
 
+class SyncSlots:
+    """ number of syncs that may run at the same time across all peers (shared by the SyncQueues of all clients) """
+    def __init__(self, n):
+        self.free = n
+        self.queues = [] # queues that wait for a free slot, in the order they get the next one
+        self.lock = Lock()
+        
+    def take(self) -> bool:
+        with self.lock:
+            if self.free <= 0: return False
+            self.free -= 1
+            return True
+        
+    def give_back(self):
+        with self.lock:
+            self.free += 1
+            if self.queues: self.queues.append(self.queues.pop(0)) # the peers take turns
+            queues = list(self.queues)
+        for queue in queues: queue.run_next()
+        
+        
+
 class SyncQueue:
+    """ 
+    runs the syncs of a peer on a pool of workers. Syncs whose directories (the first two arguments: local and remote directory) are not
+    used by a running sync run at the same time, at most *max_parallel* for this peer and as many as *slots* allows across all peers.
+    Pending syncs start in the order of their priority
+    """
     class SyncEvent:
         def __init__(self) -> None:
             self.event = Event()
             self.ret = None
+            self.queued = time.monotonic()
+            self.started = None
         
         def done(self, ret):
             self.ret = ret
@@ -32,28 +76,80 @@ class SyncQueue:
             self.event.wait()
             return self.ret
             
-    def __init__(self, sync_func):
-        self.queue = []
+    def __init__(self, sync_func, max_parallel=4, slots=None):
+        self.queue = [] # pending syncs: (event, args, kwargs)
         self.sync_func = sync_func
-        self.running_thread = Thread()
+        self.max_parallel = max_parallel
+        self.slots = slots
+        self.running = 0
+        self.busy = Counter() # ("local", directory) / ("remote", directory) used by running syncs (see directories)
+        self.waits = deque(maxlen=100) # seconds the last syncs were pending
+        self.lock = Lock()
+        self.workers = ThreadPoolExecutor(max_parallel, thread_name_prefix="sync")
+        if self.slots is not None: 
+            with self.slots.lock: self.slots.queues.append(self)
         
     def add_sync(self, priority, *args, **kwargs):
-        if ((args, kwargs)) not in self.queue:
+        """ queues a sync (priority -1: last, 0: first), a sync that is already pending is not queued twice """
+        with self.lock:
+            for sync_event, pending_args, pending_kwargs in self.queue:
+                if (pending_args, pending_kwargs) == (args, kwargs): return sync_event
             sync_event = self.SyncEvent()
             if priority == -1:  self.queue.append((sync_event, args, kwargs))
             else:  self.queue.insert(min(priority, len(self.queue)), (sync_event, args, kwargs))  # low priority number = high priority
-            if self.running_thread.is_alive(): self.running_thread.join()
-            else: self.run_next()
-            return sync_event
+        self.run_next()
+        return sync_event
      
-    def run_next(self):     
-        def run():
-            while self.queue:
-                event, args, kwargs = self.queue.pop(0)
-                event.done(self.sync_func(*args, **kwargs))
-                    
-        self.running_thread = Thread(target=run)
-        self.running_thread.run()
+    def run_next(self):
+        """ starts the pending syncs that can run now """
+        with self.lock:
+            for entry in list(self.queue):
+                if self.running >= self.max_parallel: break
+                event, args, kwargs = entry
+                if any(self.busy[directory] for directory in self.directories(args)): continue # wait for the sync that uses the directory
+                if self.slots is not None and not self.slots.take(): break
+                self.queue.remove(entry)
+                self.running += 1
+                self.busy.update(self.directories(args))
+                event.started = time.monotonic()
+                self.waits.append(event.started - event.queued)
+                self.workers.submit(self._run, event, args, kwargs)
+                
+    @staticmethod
+    def directories(args):
+        """ the directories a sync uses, a local path that is also the path of a remote directory is another directory """
+        return (("local", args[0]), ("remote", args[1]))
+                
+    def _run(self, event, args, kwargs):
+        try: ret = self.sync_func(*args, **kwargs)
+        except Exception:
+            logger.exception(f"Sync of {args[:2]} failed")
+            ret = None
+        finally:
+            with self.lock:
+                self.busy.subtract(self.directories(args))
+                self.running -= 1
+            if self.slots is not None: self.slots.give_back() # also runs the next syncs of this queue
+            else: self.run_next()
+        event.done(ret)
+        
+    def stats(self) -> dict:
+        """ queue depth and how long syncs wait before they start """
+        with self.lock:
+            now, waits = time.monotonic(), list(self.waits)
+            return {"pending": len(self.queue), "running": self.running, 
+                    "mean_wait": sum(waits) / len(waits) if waits else 0.0, "max_wait": max(waits, default=0.0),
+                    "oldest_pending": max((now - event.queued for event, _, _ in self.queue), default=0.0)}
+        
+    def shut_down(self):
+        """ pending syncs are dropped, running syncs finish """
+        with self.lock:
+            for event, _, _ in self.queue: event.done(None)
+            self.queue = []
+        if self.slots is not None: 
+            with self.slots.lock: 
+                if self in self.slots.queues: self.slots.queues.remove(self)
+        self.workers.shutdown(wait=False)
      
     
     
@@ -79,39 +175,45 @@ class Conflicts:
         try: self.conflicts = pickle.loads(self.save_file.read_bytes())
         except: self.conflicts = NestedDict()
         self.resolve_events = NestedDict()
+        self.lock = RLock() # syncs of different directories record conflicts at the same time (NestedDict creates entries when reading)
         
     def save(self):
-        self.save_file.write_bytes(pickle.dumps(self.conflicts))
+        with self.lock:
+            self.save_file.write_bytes(pickle.dumps(self.conflicts))
         
     def new_sync(self, local_dir, remote_dir): # delete old unresolved conflicts
-        for key, conflict in list(self.conflicts[local_dir][remote_dir].items()):
-            if not conflict.resolve_policy:
-                del self.conflicts[local_dir][remote_dir][key]
+        with self.lock:
+            for key, conflict in list(self.conflicts[local_dir][remote_dir].items()):
+                if not conflict.resolve_policy:
+                    del self.conflicts[local_dir][remote_dir][key]
 
     def register_conflict(self, local_dir:str, remote_dir:str, is_dir:bool, local_dir_elem, remote_dir_elem, conflict_type) -> None:
-        local_dir, remote_dir = str(local_dir), str(remote_dir)
-        self.conflicts[local_dir][remote_dir][(local_dir_elem.rel_path, is_dir)] = self.Conflict(local_dir_elem, remote_dir_elem, conflict_type)
-        self.resolve_events[local_dir][remote_dir][(local_dir_elem.rel_path, is_dir)] = Event()
-        self.save()
-        return self.conflicts[local_dir][remote_dir][(local_dir_elem.rel_path, is_dir)] 
+        with self.lock:
+            local_dir, remote_dir = str(local_dir), str(remote_dir)
+            self.conflicts[local_dir][remote_dir][(local_dir_elem.rel_path, is_dir)] = self.Conflict(local_dir_elem, remote_dir_elem, conflict_type)
+            self.resolve_events[local_dir][remote_dir][(local_dir_elem.rel_path, is_dir)] = Event()
+            self.save()
+            return self.conflicts[local_dir][remote_dir][(local_dir_elem.rel_path, is_dir)] 
 
     def resolve_conflict(self, local_dir:str, remote_dir:str, rel_path:Path, is_dir:bool, resolve_policy):
-        local_dir, remote_dir, rel_path = str(local_dir), str(remote_dir), Path(rel_path)
-        self.conflicts[local_dir][remote_dir][(rel_path, is_dir)].resolve_policy = resolve_policy # using tuple as key to avoid double loops
-        if not isinstance(self.resolve_events[local_dir][remote_dir][(rel_path, is_dir)], Event): # loading from disk does not initialize events
-            self.resolve_events[local_dir][remote_dir][(rel_path, is_dir)] = Event()
-        self.resolve_events[local_dir][remote_dir][(rel_path, is_dir)].set()
-        self.save()
+        with self.lock:
+            local_dir, remote_dir, rel_path = str(local_dir), str(remote_dir), Path(rel_path)
+            self.conflicts[local_dir][remote_dir][(rel_path, is_dir)].resolve_policy = resolve_policy # using tuple as key to avoid double loops
+            if not isinstance(self.resolve_events[local_dir][remote_dir][(rel_path, is_dir)], Event): # loading from disk does not initialize events
+                self.resolve_events[local_dir][remote_dir][(rel_path, is_dir)] = Event()
+            self.resolve_events[local_dir][remote_dir][(rel_path, is_dir)].set()
+            self.save()
         
     def is_resolved(self, local_dir, remote_dir, local_obj, remote_obj, rel_path, is_dir):
-        try: 
-            conflict = self.conflicts[local_dir][remote_dir][(rel_path, is_dir)] 
-            if conflict.local_hash == local_obj.hash and conflict.remote_hash == remote_obj.hash:
-                return conflict.resolve_policy
-            else:
+        with self.lock:
+            try: 
+                conflict = self.conflicts[local_dir][remote_dir][(rel_path, is_dir)] 
+                if conflict.local_hash == local_obj.hash and conflict.remote_hash == remote_obj.hash:
+                    return conflict.resolve_policy
+                else:
+                    return False
+            except AttributeError: 
                 return False
-        except AttributeError: 
-            return False
     
     def wait_for_resolve(self, local_dir, remote_dir, rel_path, is_dir):
         local_dir, remote_dir, rel_path = str(local_dir), str(remote_dir), Path(rel_path)
@@ -119,18 +221,21 @@ class Conflicts:
         return self.conflicts[local_dir][remote_dir][(rel_path, is_dir)].resolve_policy
         
     def has_unresolved_conflicts(self, local_dir, remote_dir):
-        for key, conflict in self.conflicts[str(local_dir)][str(remote_dir)].items():
-            if conflict.resolve_policy is False:
-                return False
-        return True
+        with self.lock:
+            for key, conflict in self.conflicts[str(local_dir)][str(remote_dir)].items():
+                if conflict.resolve_policy is False:
+                    return False
+            return True
             
     def reset_sync_conflicts(self, local_dir, remote_dir):
-        self.conflicts[local_dir][remote_dir] = NestedDict()
+        with self.lock:
+            self.conflicts[local_dir][remote_dir] = NestedDict()
         
     def get_conflicts(self, local_dir, remote_dir):
         files, folders = {}, {}
-        for key, conflict in self.conflicts[str(local_dir)][str(remote_dir)].items():
-            (folders  if key[1] is True else files)[key[0]] = conflict
+        with self.lock:
+            for key, conflict in self.conflicts[str(local_dir)][str(remote_dir)].items():
+                (folders  if key[1] is True else files)[key[0]] = conflict
         return files, folders
 
 
@@ -138,20 +243,257 @@ class Conflicts:
 
 
 
-class Client(Socket):
-    def __init__(self, uuid, sessions, file_tracker, log_settings, directory_locks, sync_status_callback, new_conflict_callback, data_path):
+class Lane(Socket):
+    """ connection that is used for file transfers. A Client is its own main lane and may open extra lanes for bulk transfers """
+    def __init__(self, logger=None, download_window=256, chunk_store=None, staging=None):
         super().__init__()
+        self.logger = logger
+        self.download_window = download_window # max number of files requested but not yet received
+        self.chunk_store = chunk_store # index of the chunks of local files (see src/Chunks.py)
+        self.staging = staging # makes the received files durable and records their hashes (see src/Staging.py)
+        self.mux = None # streams of the connection if requests are multiplexed (see request)
+        
+    def open(self, hostname, port, uuid, conn):
+        """ opens a lane that uses the compression and limits of the main connection *conn* """
+        self.connect(hostname, port)
+        self.recv_multi() # greeting is only relevant for the main connection
+        self.send_multi(NT_Code.REQ_LANE, uuid, {CAP_COMPRESSION: conn.codec.name if conn.codec else None})
+        self.inherit(conn)
+        
+    def close(self):
+        try: self.send_code(NT_Code.END_CONN)
+        except OSError: pass
+        super().close()
+        
+    @contextmanager
+    def request(self):
+        """ connection to send a request on and receive the reply from: a new stream if the connection is multiplexed, the lane itself otherwise """
+        if self.mux is None:
+            yield self
+            return
+        conn = Socket(self.mux.open())
+        conn.inherit(self)
+        try: yield conn
+        finally: conn.close()
+        
+    def req_file(self, remote_dir:str, remote_file:str, local_dir:str, local_file:str):
+        local_path = os.path.join(local_dir, local_file)
+        if os.path.isfile(local_path) and os.path.getsize(local_path) >= MIN_DELTA_SIZE: # only send what changed
+            return self.req_file_delta(remote_dir, remote_file, local_dir, local_file)
+        with self.request() as conn:
+            with conn.batch():
+                conn.send_code(NT_Code.REQ_FILE)
+                conn.send_str(remote_dir)
+                conn.send_str(remote_file)
+            local_path = os.path.join(local_dir, local_file)
+            try: hash = conn.recv_file(local_path, self.staging.per_file)
+            except FileChangedError:
+                self.logger.warning(f"Remote file '{remote_file}' in '{remote_dir}' changed during the download, it will be downloaded during the next sync")
+                return
+            self.staging.received(local_dir, local_path, hash)
+        self.logger.info(f"Download file '{local_file}' in '{local_dir}'")
+        
+    def req_files(self, remote_dir:str, files:list, local_dir:str, hashes=None):
+        """ downloads *files* (paths relative to remote_dir and local_dir) """
+        self.req_batches(remote_dir, batched(files, max(1, self.download_window // 2)), local_dir, hashes)
+            
+    def req_batches(self, remote_dir:str, batches, local_dir:str, hashes=None):
+        """ 
+        downloads *batches* (lists of paths). The next batch is requested before the current one is received 
+        so the server streams files back to back instead of waiting for a round trip per file. The hashes of the received files
+        (computed while receiving them) are added to *hashes* (path -> hash) if it is given
+        """
+        requested, in_flight = deque(), 0
+        with self.request() as conn:
+            for batch in batches:
+                with conn.batch():
+                    conn.send_code(NT_Code.REQ_FILES)
+                    conn.send_str(remote_dir)
+                    conn.send_obj(batch)
+                requested.append(batch)
+                in_flight += len(batch)
+                while in_flight >= self.download_window: 
+                    in_flight -= self._recv_files(conn, local_dir, requested.popleft(), hashes)
+            while requested: self._recv_files(conn, local_dir, requested.popleft(), hashes)
+            
+    def _recv_files(self, conn, local_dir, batch, hashes):
+        received = 0
+        for file in batch:
+            if conn.recv_int(): # file is available
+                local_path = os.path.join(local_dir, file)
+                try: hash = conn.recv_file(local_path, self.staging.per_file)
+                except FileChangedError:
+                    self.logger.warning(f"Remote file '{file}' changed during the download, it will be downloaded during the next sync")
+                    continue
+                self.staging.received(local_dir, local_path, hash)
+                if hashes is not None: hashes[file] = hash
+                self.logger.debug(f"Download file '{file}' in '{local_dir}'")
+                received += 1
+            else: self.logger.warning(f"Remote file '{file}' is not available")
+        self.logger.info(f"Downloaded {received} files in '{local_dir}'")
+        return len(batch)
+        
+    def req_file_ranges(self, remote_dir:str, ranges:list) -> list:
+        """ 
+        downloads parts of files: *ranges* are (remote file, offset, length, opened local file), each part is written to the local file
+        at the same offset. Returns for every range whether it has been received completely
+        """
+        received = []
+        with self.request() as conn:
+            with conn.batch():
+                for remote_file, offset, length, _ in ranges:
+                    conn.send_code(NT_Code.REQ_FILE_RANGE)
+                    conn.send_str(remote_dir)
+                    conn.send_str(remote_file)
+                    conn.send_int(offset)
+                    conn.send_int(length)
+            for remote_file, offset, length, file in ranges:
+                if not conn.recv_int(): # file is not available
+                    received.append(False)
+                    continue
+                file.seek(offset)
+                try: received.append(conn.recv_opened_file(file) == length)
+                except FileChangedError: received.append(False)
+        self.logger.debug(f"Downloaded {sum(received)} of {len(ranges)} ranges in '{remote_dir}'")
+        return received
+        
+    def req_file_delta(self, remote_dir:str, remote_file:str, local_dir:str, local_file:str, basis=None):
+        """ 
+        updates the existing local copy (or creates it from the local file *basis*) by downloading only the blocks that differ from the 
+        remote file (see src/Delta.py). Returns False if the remote file is not available (the local copy is left as it is)
+        """
+        local_path = os.path.join(local_dir, local_file)
+        basis = basis or local_path
+        block_size = block_size_for(os.path.getsize(basis))
+        basis_size, blocks = signature(basis, block_size)
+        with self.request() as conn:
+            with conn.batch():
+                conn.send_code(NT_Code.REQ_FILE_DELTA)
+                conn.send_str(remote_dir)
+                conn.send_str(remote_file)
+                conn.send_obj((block_size, basis_size, blocks))
+            if not conn.recv_int():
+                self.logger.warning(f"Remote file '{remote_file}' in '{remote_dir}' is not available for a delta")
+                return False
+
+            received = 0
+            def operations():
+                nonlocal received
+                for batch in iter(conn.recv, NT_Code.END_MSG):
+                    received += sum(len(operation) for operation in batch if isinstance(operation, bytes))
+                    yield from batch
+            temp_path = part_path(local_path)
+            try:
+                with open(basis, "rb") as basis_file, open(temp_path, "wb") as file:
+                    patch(basis_file, operations(), file, block_size)
+                self.staging.replace(local_dir, temp_path, local_path)
+            except BaseException:
+                if os.path.exists(temp_path): os.remove(temp_path)
+                raise
+        self.logger.info(f"Download delta of file '{local_file}' in '{local_dir}' ({received} literal bytes, {os.path.getsize(local_path)} bytes total)")
+        return True
+        
+    def req_file_chunks(self, remote_dir:str, remote_file:str, local_dir:str, local_file:str, candidates=()):
+        """ 
+        downloads only the chunks of the remote file that can't be found in any indexed local file (see src/Chunks.py). The old copy
+        and *candidates* (local files that probably share chunks with the remote file, e.g. copies of it) are indexed first
+        """
+        local_path = os.path.join(local_dir, local_file)
+        for candidate in (local_path, *candidates):
+            try: self.chunk_store.recipe(candidate)
+            except OSError: pass # does not exist (anymore)
+        with self.request() as conn:
+            with conn.batch():
+                conn.send_code(NT_Code.REQ_FILE_CHUNKS)
+                conn.send_str(remote_dir)
+                conn.send_str(remote_file)
+            recipe = conn.recv_obj()
+            if recipe is None:
+                self.logger.warning(f"Remote file '{remote_file}' in '{remote_dir}' is not available")
+                return
+
+            starts = {} # chunk -> offsets in the file (the same chunk can occur several times)
+            for (chunk, _), start in zip(recipe, offsets(recipe)): starts.setdefault(chunk, []).append(start)
+            received, corrupt = 0, False
+            temp_path = part_path(local_path)
+            try:
+                with open(temp_path, "wb") as file:
+                    def write(chunk, data):
+                        self.limits.disk_write.take(len(data) * len(starts[chunk]), self.peer)
+                        for start in starts[chunk]:
+                            file.seek(start)
+                            file.write(data)
+                    file.truncate(sum(length for _, length in recipe))
+                    wanted, seen = [], set() # indices of the chunks that are not available locally
+                    for i, (chunk, _) in enumerate(recipe):
+                        if chunk in seen: continue
+                        seen.add(chunk)
+                        if (data := self.chunk_store.read(chunk)) is not None: 
+                            self.limits.disk_read.take(len(data), self.peer)
+                            write(chunk, data)
+                        else: wanted.append(i)
+                    conn.send_obj(wanted)
+
+                    wanted = iter(wanted)
+                    for batch in iter(conn.recv, NT_Code.END_MSG):
+                        if batch is None: # the remote file can't be read anymore
+                            corrupt = True
+                            continue
+                        for data in batch:
+                            chunk = recipe[next(wanted)][0]
+                            if digest(data) != chunk: corrupt = True # the remote file changed while it was sent
+                            else: write(chunk, data)
+                            received += len(data)
+                if corrupt: raise ValueError(f"Remote file '{remote_file}' in '{remote_dir}' changed during the download")
+                self.staging.replace(local_dir, temp_path, local_path)
+            except ValueError as e:
+                os.remove(temp_path)
+                self.logger.warning(f"{e}, it will be downloaded during the next sync")
+                return
+            except BaseException:
+                if os.path.exists(temp_path): os.remove(temp_path)
+                raise
+        self.chunk_store.add(local_path, recipe)
+        self.logger.info(f"Download chunks of file '{local_file}' in '{local_dir}' ({received} bytes received, {os.path.getsize(local_path)} bytes total)")
+
+
+
+def batched(files, batch_size):
+    return [[str(file) for file in files[i:i + batch_size]] for i in range(0, len(files), batch_size)]
+
+
+
+
+
+class Client(Lane):
+    def __init__(self, uuid, sessions, file_tracker, log_settings, directory_locks, sync_status_callback, new_conflict_callback, data_path, \
+            download_window=256, lanes=0, compression=(), chunk_store=None, sync_workers=4, sync_slots=None, limits=UNLIMITED, swarm=None, staging=None):
+        super().__init__(download_window=download_window, chunk_store=chunk_store, staging=staging or Staging(file_tracker))
+        self.limits = limits # shared with the lanes and streams
         self.uuid = uuid
         self.file_tracker = file_tracker
-        self.sync_queue = SyncQueue(self._sync)
+        self.sync_queue = SyncQueue(self._sync, sync_workers, sync_slots)
         self.sessions = sessions
         self.logging_settings = log_settings
         self.directory_locks = directory_locks
         self.sync_status_callback = sync_status_callback
         self.new_conflict_callback = new_conflict_callback
         self.data_path = data_path
+        self.max_lanes = lanes # number of extra connections used for bulk transfers
+        self.lanes = []
+        self.lanes_lock = Lock() # held while the lanes are opened
+        self.lanes_in_use = Lock() # the extra lanes are used by one sync at a time
+        self.compression = compression # codecs in order of preference
+        self.remote_graphs = {} # remote dir -> graph received during the last sync (kept up to date with changes/tree hashes, see req_dir_graph)
+        self.remote_versions = {} # remote dir -> version of the graph in remote_graphs
+        self.graphs_lock = Lock() # remote_graphs are also read by the syncs with other peers (see src/Swarm.py)
+        self.swarm = swarm # downloads from other peers that have copies of the directory being synced
         
         # will be initilized in self.connect
+        self.n_lanes = 0 # number of lanes both sides agreed on
+        self.use_chunks = False # whether both sides can transfer files as chunks
+        self.use_streams = False # whether both sides can multiplex requests (see src/Streams.py)
+        self.use_ranges = False # whether parts of files can be requested
         self.conflicts = None
         self.logger = None 
         self.server_hostname = None
@@ -165,8 +507,14 @@ class Client(Socket):
         super().connect(hostname, port)
         self.connected = True  
         
-        uuid, dir_info = self.recv_multi()
-        self.remote_uuid = uuid
+        uuid, dir_info, caps = self.recv_multi()
+        self.n_lanes = min(self.max_lanes, caps.get(CAP_LANES, 0))
+        self.use_chunks = self.chunk_store is not None and caps.get(CAP_CHUNKS, False)
+        self.use_streams = caps.get(CAP_STREAMS, False)
+        self.use_ranges = caps.get(CAP_RANGES, False)
+        if not self.use_streams: self.sync_queue.max_parallel = 1 # the requests of syncs running at the same time would get mixed up
+        self._codec = choose_codec(self.compression, caps.get(CAP_COMPRESSION, ())) # used after the introduction
+        self.remote_uuid = self.peer = uuid
         self.sessions.start(self.remote_uuid)
         self.conflicts = Conflicts(self.data_path / f"Conflicts_{self.remote_uuid}.pickle")
         
@@ -174,15 +522,29 @@ class Client(Socket):
         self.logger.info(f"Client connected to {self.conn_str()}")
         return uuid, dir_info
     
+    def introduce(self, uuid, hostname, port):
+        """ tells the server who we are and which of the offered capabilities we use """
+        self.send_multi(uuid, hostname, port, {CAP_COMPRESSION: self._codec.name if self._codec else None, CAP_STREAMS: self.use_streams})
+        self.codec = self._codec
+        self.logger.info(f"Compression: {self.codec.name if self.codec else None}")
+        if self.use_streams: # every request is sent on a stream of its own from now on
+            self.mux = Multiplexer(self)
+            Thread(target=self.mux.run, name=f"streams->{self.remote_uuid}", daemon=True).start()
+    
     def close(self):
+        self.sync_queue.shut_down()
+        for lane in self.lanes: lane.close()
+        self.lanes = []
         if self.connected:
             self.connected = False
-            try: self.send_code(NT_Code.END_CONN)
+            try: 
+                with self.request() as conn: conn.send_code(NT_Code.END_CONN)
             except ConnectionResetError: pass
             self.logger.info(f"Client disconnected from {self.conn_str()}")
             self.sessions.end(self.remote_uuid)
             logger.info(f"Shut down Client connected to {self.conn_str()}")
-        super().close()
+        if self.mux is not None: self.mux.close()
+        Socket.close(self)
         self.logger.info("Client socket closed")  
     
     
@@ -190,23 +552,117 @@ class Client(Socket):
         return f"{self.remote_uuid} @ (hostname: {self.server_hostname}, port: {self.server_port})"
        
 
+    def open_lanes(self):
+        """ opens the extra lanes agreed on during the handshake (once, on the first sync) """
+        with self.lanes_lock: self._open_lanes()
+            
+    def _open_lanes(self):
+        while len(self.lanes) < self.n_lanes:
+            lane = Lane(self.logger, self.download_window, self.chunk_store, self.staging)
+            try: lane.open(self.server_hostname, self.server_port, self.uuid, self)
+            except OSError as e:
+                self.logger.warning(f"Failed to open transfer lane to {self.conn_str()}: {e}")
+                self.n_lanes = len(self.lanes)
+                break
+            self.lanes.append(lane)
+            self.logger.debug(f"Opened transfer lane {len(self.lanes)} to {self.conn_str()}")
+        
+    def download_files(self, remote_dir:str, files:list, local_dir:str):
+        """ 
+        spreads the download of *files* across all lanes. Lanes take the next batch as soon as they are done with their last one. 
+        If another sync is using the lanes, the files are downloaded on a stream of the main connection
+        """
+        if len(self.lanes) < 2 or not self.lanes_in_use.acquire(blocking=False): return self.req_files(remote_dir, files, local_dir)
+        try: self._download_files(remote_dir, files, local_dir)
+        finally: self.lanes_in_use.release()
+        
+    def _download_files(self, remote_dir, files, local_dir):
+        lanes = self.lanes
+        batch_size = max(1, min(self.download_window // 2, len(files) // (2 * len(lanes))))
+        batches, lock = iter(batched(files, batch_size)), Lock()
+        def take():
+            while True:
+                with lock: batch = next(batches, None)
+                if batch is None: return
+                yield batch
+        with ThreadPoolExecutor(len(lanes), thread_name_prefix="lane") as executor:
+            for future in [executor.submit(lane.req_batches, remote_dir, take(), local_dir) for lane in lanes]: 
+                future.result() # reraises exceptions of the lanes
+        
     def req_dir_list(self): # is not used anywhere?
-        self.send_code(NT_Code.REQ_DIR_LST)
-        self.logger.debug(f"Receive directory list")
-        return self.recv_obj()        
+        with self.request() as conn:
+            conn.send_code(NT_Code.REQ_DIR_LST)
+            self.logger.debug(f"Receive directory list")
+            return conn.recv_obj()        
         
-    def req_file(self, remote_dir:str, remote_file:str, local_dir:str, local_file:str):
-        self.send_code(NT_Code.REQ_FILE)
-        self.send_str(remote_dir)
-        self.send_str(remote_file)
-        self.recv_file(os.path.join(local_dir, local_file))
-        self.logger.info(f"Download file '{local_file}' in '{local_dir}'")
-    
     def req_dir_graph(self, remote_dir):
-        self.send_code(NT_Code.REQ_DIR_GRAPH)
-        self.send_str(remote_dir)
-        self.logger.debug(f"Receive directory graph")
-        return self.recv_obj()    
+        """ 
+        returns the current graph of *remote_dir*. If it has been received before, only the changes since are requested. If the remote
+        does not know them anymore, only the folders whose tree hash changed are requested. Otherwise the whole graph is requested
+        """
+        with self.graphs_lock:
+            graph = self.remote_graphs.get(remote_dir)
+            if graph is not None and not self._req_dir_changes(remote_dir, graph): graph = self._req_dir_tree(remote_dir, graph)
+            if graph is None:
+                with self.request() as conn:
+                    with conn.batch():
+                        conn.send_code(NT_Code.REQ_DIR_GRAPH)
+                        conn.send_str(remote_dir)
+                    self.logger.debug(f"Receive directory graph")
+                    graph = self.remote_graphs[remote_dir] = conn.recv_obj()
+                    self.remote_versions[remote_dir] = conn.recv_obj()
+            return graph
+    
+    def _req_dir_changes(self, remote_dir, graph):
+        """ applies the changes since the last sync to the cached *graph*, returns whether it is up to date now """
+        with self.request() as conn:
+            with conn.batch():
+                conn.send_code(NT_Code.REQ_DIR_CHANGES)
+                conn.send_str(remote_dir)
+                conn.send_obj(self.remote_versions[remote_dir])
+            reply = conn.recv_obj()
+        if reply is None: return False
+        entries, version, tree_hash = reply
+        self.logger.debug(f"Receive {len(entries)} changes")
+        for parts, node in entries:
+            parent = graph.get_folder(parts[:-1])
+            if parent is None: return False
+            name = parts[-1]
+            parent.files.pop(name, None)
+            parent.folders.pop(name, None)
+            if isinstance(node, Folder): 
+                node.attach(parent)
+                parent.folders[name] = node
+            elif node is not None:
+                node.parent, node.ctx = parent, parent.ctx
+                parent.files[name] = node
+            parent._invalidate()
+        self.remote_versions[remote_dir] = version
+        return graph.tree_hash == tree_hash # if not, the tree hashes find the differences
+    
+    def _req_dir_tree(self, remote_dir, graph):
+        """ 
+        updates the cached *graph* top down by requesting the folders whose tree hash changed (one round trip per level of changed folders).
+        Returns None if the remote graph has been rebuilt
+        """
+        pending, version = {(): graph}, None # relative path -> cached folder whose contents have to be compared
+        while pending:
+            with self.request() as conn:
+                with conn.batch():
+                    conn.send_code(NT_Code.REQ_DIR_TREE)
+                    conn.send_str(remote_dir)
+                    conn.send_obj([(parts, folder.tree_hash) for parts, folder in pending.items()])
+                summaries, reply_version = conn.recv_obj()
+            if False in summaries: return None
+            version = version or reply_version # changes after the first request are sent again next time
+            self.logger.debug(f"Receive {sum(summary is not None for summary in summaries)} changed folders")
+            changed = {}
+            for (parts, folder), summary in zip(pending.items(), summaries):
+                if summary is not None: 
+                    changed.update({(*parts, name): folder.folders[name] for name in folder.graft(summary)})
+            pending = changed
+        self.remote_versions[remote_dir] = version
+        return graph
     
     def queue_sync(self, local_dir, remote_dir, conflict_policy, default_resolve, bi_directional_sync, priority=-1): #priority: -1: queue at last, 0: queue first
         self.logger.debug(f"Add to queue: sync local directory '{local_dir}' with remote directory '{remote_dir}'")
@@ -223,55 +679,160 @@ class Client(Socket):
     def _sync(self, local_dir, remote_dir, conflict_policy, default_resolve, bi_directional_sync):
         self.logger.info(f"Now syncing local directory '{local_dir}' with remote directory '{remote_dir}'")
         
-        if ret:=self._init_sync(local_dir, remote_dir) is not True: return ret
+        if (ret := self._init_sync(local_dir, remote_dir)) is not True: return ret
+        try: ret = self._sync_locked(local_dir, remote_dir, conflict_policy, default_resolve)
+        finally: self._end_sync(local_dir, remote_dir) # also if the sync failed, otherwise the directories would stay locked
+        if ret != SYNC_RET_CODE.SUCCESS: return ret
+        
+        if bi_directional_sync: # the remote queues the sync back, it does not wait for it to reply (see Server._sync_back)
+            self.logger
+            with self.request() as conn:
+                with conn.batch():
+                    conn.send_code(NT_Code.REQ_SYNC)
+                    conn.send_str(remote_dir)
+                    conn.send_str(local_dir)
+                if (code := conn.recv_code()) != NT_Code.END_SYNC: raise Exception("expected NT_Code.END_SYNC, got ", code)
+        
+        self.sessions.add_sync(self.remote_uuid, local_dir, remote_dir)
+        if self.codec: self.logger.debug(f"Compression: {self.compression_stats}")
+        self.logger.info("Sync Done")  
+        
+        return SYNC_RET_CODE.SUCCESS
+    
+    def _sync_locked(self, local_dir, remote_dir, conflict_policy, default_resolve):
+        """ syncs *local_dir* with *remote_dir* while both are locked (see _init_sync and _end_sync) """
+        self.open_lanes()
 
         self.file_tracker[local_dir].update()
-        local_graph = copy.deepcopy(self.file_tracker[local_dir].root)
+        with self.file_tracker[local_dir].lock:
+            local_graph = copy.deepcopy(self.file_tracker[local_dir].root)
         remote_graph = self.req_dir_graph(remote_dir)
         last_sync_time = self.sessions.last_sync(self.remote_uuid, local_dir, remote_dir)
         
         self.conflicts.new_sync(local_dir, remote_dir)
-        local_graph.merge(remote_graph, last_sync_time, self._create_conflict_handler(local_dir, remote_dir, conflict_policy, default_resolve))
+        result = local_graph.merge(remote_graph, last_sync_time, self._create_conflict_handler(local_dir, remote_dir, conflict_policy, default_resolve))
         if not self.conflicts.has_unresolved_conflicts(local_dir, remote_dir):
-            self._end_sync(local_dir, remote_dir)
             self.logger.info(f"Aborted Sync due to: {str(SYNC_RET_CODE.HAS_CONFLICT)}")
             return SYNC_RET_CODE.HAS_CONFLICT
+        self._move(local_dir, remote_dir, result.moved)
         
+        downloads = [] # small/new files are downloaded together after the folder structure has been created
+        large = [] # large new files, downloaded after the others since other peers might have them too (see src/Swarm.py)
+        deletions = {} # full path -> deleted file/folder, trashed after the downloads since their chunks might be needed
+        def trash(path):
+            node = deletions.pop(path)
+            if not path.exists(): return
+            send2trash(str(path))
+            self.logger.info(f"Delete {'folder' if isinstance(node, Folder) else 'file'} '{node.location()}' in '{local_dir}'")
         def create(graph): # graph = merged graph; this is how the directory being synced should look like
+            # the deletions of a level are recorded first since a file may replace a deleted folder with the same name and vice versa
+            for file in graph.files.values():
+                if not file.exists and file.full_path.is_file(): deletions[file.full_path] = file
+            for folder in graph.folders.values():
+                if not folder.exists and folder.full_path.is_dir(): deletions[folder.full_path] = folder
             for file in graph.files.values():
+                if file.exists and file.full_path in deletions: trash(file.full_path) # replaces a deleted folder
+                # files the merge took from the remote side have no hash yet (hash 0), their contents must match the remote file
+                remote_file = remote_graph.get_node(file._parts()) if file.exists and not file.hash else None
+                wanted = remote_file.hash if remote_file is not None else file.hash
                 # if doesnt exist yet or contents are different, download file
-                if file.exists and (not file.full_path.exists() or hashfile(file.full_path) != file.hash):
-                    self.req_file(remote_dir, file.location(), local_dir, file.location())
-                elif not file.exists and file.full_path.exists():
-                    send2trash(str(file.full_path))
-                    self.logger.info(f"Delete file '{file.location()}' in '{local_dir}'")
+                if file.exists and (not file.full_path.exists() or self.file_tracker[local_dir].hash_of(file._parts()) != wanted):
+                    copies = self.file_tracker[local_dir].paths_with_hash(wanted) if wanted else [] # local files with the same contents
+                    remote_node = remote_file or remote_graph.get_node(file._parts())
+                    size = remote_node.size if remote_node is not None else file.size
+                    if self._copy(local_dir, remote_dir, copies, file.location(), wanted, size): continue
+                    if self.swarm is not None and not copies and not file.full_path.exists() and remote_node is not None and remote_node.hash == wanted \
+                            and (remote_node.size or 0) >= MIN_RANGED_SIZE:
+                        large.append((file, remote_node))
+                    elif self.use_chunks and remote_file is not None and (remote_file.size or 0) >= MIN_CHUNKED_SIZE: # only download missing chunks
+                        candidates = [os.path.join(local_dir, *parts) for parts in copies]
+                        self.req_file_chunks(remote_dir, file.location(), local_dir, file.location(), candidates)
+                    elif file.full_path.exists() and file.full_path.stat().st_size >= MIN_DELTA_SIZE: # only download changed blocks
+                        if not self.req_file_delta(remote_dir, file.location(), local_dir, file.location()): downloads.append(file.location()) # whole
+                    else: downloads.append(file.location())
             for folder in graph.folders.values():
                 if folder.exists:
+                    if folder.full_path in deletions: trash(folder.full_path) # replaces a deleted file
                     if not folder.full_path.exists():
                         folder.full_path.mkdir()
                         self.logger.info(f"Created folder '{folder.location()}' in '{local_dir}'")
                     create(folder)
-                elif folder.full_path.exists():
-                    send2trash(str(folder.full_path))
-                    self.logger.info(f"Delete folder '{folder.location()}' in '{local_dir}'")
         create(local_graph)
-        self.file_tracker[local_dir].update(callback=True)
+        swarm = self.swarm.start(self, local_dir, remote_dir, remote_graph) if self.swarm is not None and (downloads or large) else None
+        for file, remote_file in large:
+            if self.use_chunks and (swarm is None or not swarm.has_mirror(remote_file)): self.req_file_chunks(remote_dir, file.location(), local_dir, file.location())
+            else: downloads.append(file.location()) # in ranges from all peers that have it
+        if swarm is not None: swarm.download(downloads)
+        else: self.download_files(remote_dir, downloads, local_dir)
+        for path in list(deletions): trash(path)
+        if flushed := self.staging.flush(local_dir): self.logger.debug(f"Flushed {flushed} received files in '{local_dir}' to disk")
+        self.file_tracker[local_dir].update(callback=True) # the received files are not hashed again (see src/Staging.py)
         self.conflicts.reset_sync_conflicts(local_dir, remote_dir)
-        
-        self._end_sync(local_dir, remote_dir)
-        
-        if bi_directional_sync:
-            self.logger
-            self.send_code(NT_Code.REQ_SYNC)
-            self.send_str(remote_dir)
-            self.send_str(local_dir)
-            if code:=self.recv_code() != NT_Code.END_SYNC: raise Exception("expected NT_Code.END_SYNC, got ", code)
-        
-        self.sessions.add_sync(self.remote_uuid, local_dir, remote_dir)
-        self.logger.info("Sync Done")  
-        
         return SYNC_RET_CODE.SUCCESS
     
+    def _move(self, local_dir, remote_dir, moves):
+        """ 
+        renames the local files/folders that have been moved/renamed on the remote side (see MergeResult.moved) instead of downloading them.
+        Moved files that imohash only samples are checked with a delta afterwards (see _copy)
+        """
+        directory, moved, verify = self.file_tracker[local_dir], [], []
+        for source, target in self._split_moves(directory, local_dir, moves):
+            source_path, target_path = Path(local_dir, *source), Path(local_dir, *target)
+            if not source_path.exists() or target_path.exists(): continue # downloaded as usual
+            try:
+                target_path.parent.mkdir(parents=True, exist_ok=True)
+                os.rename(source_path, target_path)
+            except OSError as e:
+                self.logger.warning(f"Failed to move '{Path(*source)}' to '{Path(*target)}' in '{local_dir}': {e}")
+                continue
+            self.logger.info(f"Move '{Path(*source)}' to '{Path(*target)}' in '{local_dir}'")
+            moved.extend((Path(*source), Path(*target)))
+            verify.append(target_path)
+        for target_path in verify:
+            for path in ([target_path] if target_path.is_file() else target_path.rglob("*")):
+                if path.is_file() and path.stat().st_size >= SAMPLE_THRESHOLD:
+                    location = str(path.relative_to(local_dir))
+                    self.req_file_delta(remote_dir, location, local_dir, location)
+        if moved: directory.update_paths(moved) # so the moved files can be found by their hash (see _copy)
+        
+    @staticmethod
+    def _split_moves(directory, local_dir, moves):
+        """ folder moves whose folder contains ignored entries are split into moves of their tracked files, the ignored ones stay where they are """
+        ignore = directory.root.ctx.ignore
+        for source, target in moves:
+            source_path = os.path.join(local_dir, *source)
+            node = directory.root.get_node(source) if os.path.isdir(source_path) else None
+            if node is None or not any(ignore.match((*source, *Path(folder).relative_to(source_path).parts, name)) 
+                                       for folder, folders, files in os.walk(source_path) for name in (*folders, *files)): 
+                yield source, target
+            else: yield from (((*source, *parts), (*target, *parts)) for parts, _ in contents(node))
+    
+    def _copy(self, local_dir, remote_dir, copies, local_file, hash, size) -> bool:
+        """ 
+        copies a local file with the contents *hash* and *size* (one of *copies*) to *local_file* instead of downloading it. Returns whether it did.
+        imohash only samples large files, so they might differ from the remote file where it does not look. Those are created with a delta
+        of the remote file instead, the local file is the basis (only blocks that differ are downloaded)
+        """
+        local_path = os.path.join(local_dir, local_file)
+        for parts in copies:
+            source = os.path.join(local_dir, *parts)
+            if source == local_path or not os.path.isfile(source) or os.path.getsize(source) != size or hashfile(source) != hash: continue # changed since it was tracked
+            if size >= SAMPLE_THRESHOLD:
+                if not self.req_file_delta(remote_dir, local_file, local_dir, local_file, basis=source): return False
+                self.logger.info(f"Copy '{Path(*parts)}' to '{local_file}' in '{local_dir}' (checked with a delta)")
+                return True
+            temp_path = part_path(local_path)
+            try:
+                shutil.copy2(source, temp_path)
+                self.staging.replace(local_dir, temp_path, local_path, hash)
+            except OSError as e:
+                if os.path.exists(temp_path): os.remove(temp_path)
+                self.logger.warning(f"Failed to copy '{Path(*parts)}' to '{local_file}' in '{local_dir}': {e}")
+                continue
+            self.logger.info(f"Copy '{Path(*parts)}' to '{local_file}' in '{local_dir}'")
+            return True
+        return False
+    
     def _init_sync(self, local_dir, remote_dir):
         # check if local_dir is available for syncing
         if not self.directory_locks[local_dir].acquire(timeout=3): 
@@ -279,10 +840,14 @@ class Client(Socket):
             return SYNC_RET_CODE.LOCAL_DIR_IN_USE
         
         # check if remote dir is available for syncing
-        self.send_code(NT_Code.REQ_SYNC_START) 
-        self.send_str(remote_dir)
-        self.send_str(local_dir)
-        if not self.recv_int():
+        with self.request() as conn:
+            with conn.batch():
+                conn.send_code(NT_Code.REQ_SYNC_START)
+                conn.send_str(remote_dir)
+                conn.send_str(local_dir)
+            locked = conn.recv_int()
+        if not locked:
+            self.directory_locks[local_dir].release()
             self.logger.info(f"Aborted Sync due to: {SYNC_RET_CODE.REMOTE_DIR_IN_USE}")
             return SYNC_RET_CODE.REMOTE_DIR_IN_USE
         
@@ -290,11 +855,14 @@ class Client(Socket):
         return True
     
     def _end_sync(self, local_dir, remote_dir):
-        self.send_code(NT_Code.END_SYNC)
-        self.send_str(remote_dir)
-        self.send_str(local_dir)
-        self.directory_locks[local_dir].release()
-        self.sync_status_callback(self.remote_uuid, local_dir, remote_dir, SYNC_STATUS.NOT_SYNCING)
+        try:
+            with self.request() as conn, conn.batch():
+                conn.send_code(NT_Code.END_SYNC)
+                conn.send_str(remote_dir)
+                conn.send_str(local_dir)
+        finally: # the connection might be gone
+            self.directory_locks[local_dir].release()
+            self.sync_status_callback(self.remote_uuid, local_dir, remote_dir, SYNC_STATUS.NOT_SYNCING)
         
     def _create_conflict_handler(self, local_dir, remote_dir, conflict_policy, default_resolve): # local and remote are the folders being synced    
         def handle_conflict(local_folder, remote_folder, name, remote_obj, is_dir, conflict_type): # local_dir and remote_dir are the folders where the conflict is happening    
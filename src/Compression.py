@@ -0,0 +1,113 @@
+import os
+import zlib
+from threading import Lock
+
+from src.Config import get_logger
+
+logger_name, logger = get_logger(__name__)
+
+try: import zstandard
+except ImportError: zstandard = None
+try: import lz4.frame
+except ImportError: lz4 = None
+
+
+MIN_COMPRESS_SIZE = 1024 # smaller messages are not worth compressing
+CHUNK_SIZE = 256 * 1024 # files are compressed in chunks of this size
+SAMPLE_SIZE = 64 * 1024 # files are only compressed if their first bytes compress well
+MAX_SAMPLE_RATIO = 0.9
+
+# file types that are compressed already
+COMPRESSED_EXTENSIONS = {
+    ".7z", ".apk", ".avi", ".br", ".bz2", ".docx", ".epub", ".flac", ".gif", ".gz", ".heic", ".jar", ".jpeg", ".jpg", ".lz4", ".lzma",
+    ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".odt", ".ogg", ".opus", ".png", ".pptx", ".rar", ".tgz", ".webm", ".webp", ".whl", ".xlsx",
+    ".xz", ".zip", ".zst"
+}
+COMPRESSED_MAGIC = (
+    b"PK\x03\x04", b"\x1f\x8b", b"BZh", b"\xfd7zXZ\x00", b"7z\xbc\xaf\x27\x1c", b"\x28\xb5\x2f\xfd", b"\x04\x22\x4d\x18", b"Rar!",
+    b"\x89PNG", b"\xff\xd8\xff", b"GIF8", b"ID3", b"OggS", b"fLaC"
+)
+
+
+
+class Codec:
+    """ one shot (messages) and streaming (files) compression. Subclasses wrap a compression library """
+    name = None
+    def compress(self, data): raise NotImplementedError
+    def decompress(self, data): raise NotImplementedError
+    def compressor(self): raise NotImplementedError # object with compress(chunk) and flush()
+    def decompressor(self): raise NotImplementedError # object with decompress(chunk)
+
+
+class ZlibCodec(Codec):
+    name = "zlib"
+    def compress(self, data): return zlib.compress(data, 6)
+    def decompress(self, data): return zlib.decompress(data)
+    def compressor(self): return zlib.compressobj(6)
+    def decompressor(self): return zlib.decompressobj()
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    def compress(self, data): return zstandard.ZstdCompressor(level=3).compress(data)
+    def decompress(self, data): return zstandard.ZstdDecompressor().decompress(data)
+    def compressor(self): return zstandard.ZstdCompressor(level=3).compressobj()
+    def decompressor(self): return zstandard.ZstdDecompressor().decompressobj()
+
+
+class Lz4Codec(Codec):
+    name = "lz4"
+    class Compressor:
+        def __init__(self):
+            self.compressor = lz4.frame.LZ4FrameCompressor()
+            self.started = False
+
+        def compress(self, data):
+            head = b"" if self.started else self.compressor.begin()
+            self.started = True
+            return head + self.compressor.compress(data)
+
+        def flush(self):
+            return (b"" if self.started else self.compressor.begin()) + self.compressor.flush()
+
+    def compress(self, data): return lz4.frame.compress(data)
+    def decompress(self, data): return lz4.frame.decompress(data)
+    def compressor(self): return self.Compressor()
+    def decompressor(self): return lz4.frame.LZ4FrameDecompressor()
+
+
+# available codecs in order of preference (fastest first)
+CODECS = {codec.name: codec for codec in [ZstdCodec() if zstandard else None, Lz4Codec() if lz4 else None, ZlibCodec()] if codec is not None}
+
+
+
+def choose_codec(preferred, offered):
+    """ first codec of *preferred* that is offered by the other side and installed here """
+    return next((CODECS[name] for name in preferred if name in offered and name in CODECS), None)
+
+
+def worth_compressing(codec, path, sample:bytes) -> bool:
+    """ *sample* are the first bytes of the file. Skips compressed file types (by extension and magic number) and incompressible data """
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS: return False
+    if sample.startswith(COMPRESSED_MAGIC) or sample[4:8] == b"ftyp": return False # ftyp: mp4/mov/heic
+    return len(codec.compress(sample)) <= MAX_SAMPLE_RATIO * len(sample)
+
+
+
+class CompressionStats:
+    """ bytes before and after compression of everything that has been considered for compression """
+    def __init__(self):
+        self.raw = 0
+        self.sent = 0
+        self.lock = Lock() # lanes share the stats of their peer
+
+    def add(self, raw, sent):
+        with self.lock:
+            self.raw += raw
+            self.sent += sent
+
+    @property
+    def ratio(self): return self.sent / self.raw if self.raw else 1.0
+
+    def __repr__(self):
+        return f"{self.raw} bytes compressed to {self.sent} bytes (ratio {self.ratio:.2f})"
@@ -5,7 +5,7 @@ import os
 import socket
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
-from threading import Event
+from threading import Event, RLock
 from uuid import uuid1
 
 from src.utils import hash_word, now, update_with_nested_dict
@@ -46,6 +46,23 @@ CFG_GLOB_IGN_KEY = "global_ign_patterns"
 CFG_SYNC_RATE_KEY = "default_sync_rate"
 CFG_PING_RATE_KEY = "default_ping_rate"
 CFG_SYNC_OK_TIMEOUT_KEY = "check_sync_ok_timeout"
+CFG_WATCH_KEY = "watch_directories"
+CFG_HASH_WORKERS_KEY = "hash_workers"
+CFG_HASH_QUEUE_KEY = "hash_queue_depth"
+CFG_HASH_PROCESSES_KEY = "hash_use_processes"
+CFG_DOWNLOAD_WINDOW_KEY = "download_window"
+CFG_LANES_KEY = "transfer_lanes"
+CFG_COMPRESSION_KEY = "compression"
+CFG_CHUNKS_KEY = "dedupe_chunks"
+CFG_SERVER_WORKERS_KEY = "server_workers"
+CFG_SYNC_WORKERS_KEY = "sync_workers"
+CFG_MAX_SYNCS_KEY = "max_syncs"
+CFG_UPLOAD_RATE_KEY = "max_upload_rate"
+CFG_DOWNLOAD_RATE_KEY = "max_download_rate"
+CFG_DISK_READ_RATE_KEY = "max_disk_read_rate"
+CFG_DISK_WRITE_RATE_KEY = "max_disk_write_rate"
+CFG_AUTO_SYNC_DELAY_KEY = "auto_sync_delay"
+CFG_DURABILITY_KEY = "durability"
 
 
 
@@ -122,6 +139,7 @@ class JSON_File(DictWrapper):
         super().__init__(auto_save=auto_save)
         self.save_event = Event()  # event for signaling saving in progress
         self.save_event.set()
+        self.lock = RLock() # syncs running at the same time save concurrently
         self.path = path
         
         # if path does not exist or is empty create and write {}
@@ -132,12 +150,13 @@ class JSON_File(DictWrapper):
         self._content = JSON_Data(json.load(self.file), self, self.auto_save)
     
     def save(self):
-        if self.save_event.isSet: # save_event is true when file is being saved
-            self.save_event.clear()
-            self.file.seek(0) #reset file position to the beginning
-            self.file.write(json.dumps(self.to_dict(), indent=4, sort_keys=True))
-            self.file.truncate() # remove remaining part
-            self.save_event.set()
+        with self.lock:
+            if self.save_event.isSet: # save_event is true when file is being saved
+                self.save_event.clear()
+                self.file.seek(0) #reset file position to the beginning
+                self.file.write(json.dumps(self.to_dict(), indent=4, sort_keys=True))
+                self.file.truncate() # remove remaining part
+                self.save_event.set()
 
    
    
@@ -246,12 +265,13 @@ class Sessions(JSON_File):
         self.save() # list wont trigger auto_save
         
     def add_sync(self, uuid, local_dir, remote_dir):
-        try:
-            self[uuid][0][SESS_SYNCED_KEY][local_dir][remote_dir].insert(0, now().strftime(DATE_TIME_FORMAT))
-        except KeyError: # first time remote_dir and local_dir are syncing
-            update_with_nested_dict([SESS_SYNCED_KEY, local_dir, remote_dir], self[uuid][0])
-            self[uuid][0][SESS_SYNCED_KEY][local_dir][remote_dir] = [now().strftime(DATE_TIME_FORMAT)]
-        self.save() # list wont trigger auto_save
+        with self.lock:
+            try:
+                self[uuid][0][SESS_SYNCED_KEY][local_dir][remote_dir].insert(0, now().strftime(DATE_TIME_FORMAT))
+            except KeyError: # first time remote_dir and local_dir are syncing
+                update_with_nested_dict([SESS_SYNCED_KEY, local_dir, remote_dir], self[uuid][0])
+                self[uuid][0][SESS_SYNCED_KEY][local_dir][remote_dir] = [now().strftime(DATE_TIME_FORMAT)]
+            self.save() # list wont trigger auto_save
                
     def last_sync(self, uuid, local_dir, remote_dir):
         for session in self[uuid]:
@@ -322,6 +342,31 @@ class Config(JSON_File):
         self.sync_ok_timeout = self[CFG_SYNC_OK_TIMEOUT_KEY]
         
         self.global_ign_patterns = self[CFG_GLOB_IGN_KEY]
+        self.watch_directories = self[CFG_WATCH_KEY] if CFG_WATCH_KEY in self else False # real time change detection
+        
+        # parallel hashing of files during directory scans. 0 workers = hash on the scanning thread
+        self.hash_workers = self[CFG_HASH_WORKERS_KEY] if CFG_HASH_WORKERS_KEY in self else min(8, os.cpu_count() or 1)
+        self.hash_queue_depth = self[CFG_HASH_QUEUE_KEY] if CFG_HASH_QUEUE_KEY in self else None
+        self.hash_use_processes = self[CFG_HASH_PROCESSES_KEY] if CFG_HASH_PROCESSES_KEY in self else False
+        
+        # number of files requested ahead during syncs (pipelining)
+        self.download_window = self[CFG_DOWNLOAD_WINDOW_KEY] if CFG_DOWNLOAD_WINDOW_KEY in self else 256
+        self.transfer_lanes = self[CFG_LANES_KEY] if CFG_LANES_KEY in self else 2 # extra connections per peer for file transfers
+        from src.Compression import CODECS # avoid circular import
+        self.compression = self[CFG_COMPRESSION_KEY] if CFG_COMPRESSION_KEY in self else list(CODECS) # codecs in order of preference, [] = off
+        self.server_workers = self[CFG_SERVER_WORKERS_KEY] if CFG_SERVER_WORKERS_KEY in self else 16 # threads handling the requests of all peers
+        self.dedupe_chunks = self[CFG_CHUNKS_KEY] if CFG_CHUNKS_KEY in self else False # only transfer chunks of files that are not available locally
+        self.sync_workers = self[CFG_SYNC_WORKERS_KEY] if CFG_SYNC_WORKERS_KEY in self else 4 # max number of syncs with a peer running at the same time
+        self.max_syncs = self[CFG_MAX_SYNCS_KEY] if CFG_MAX_SYNCS_KEY in self else 8 # max number of syncs running at the same time (all peers)
+        
+        # rates in bytes per second shared fairly by all peers, 0 = unlimited
+        self.max_upload_rate = self[CFG_UPLOAD_RATE_KEY] if CFG_UPLOAD_RATE_KEY in self else 0
+        self.max_download_rate = self[CFG_DOWNLOAD_RATE_KEY] if CFG_DOWNLOAD_RATE_KEY in self else 0
+        self.max_disk_read_rate = self[CFG_DISK_READ_RATE_KEY] if CFG_DISK_READ_RATE_KEY in self else 0 # files that are sent
+        self.max_disk_write_rate = self[CFG_DISK_WRITE_RATE_KEY] if CFG_DISK_WRITE_RATE_KEY in self else 0 # files that are received
+        self.auto_sync_delay = self[CFG_AUTO_SYNC_DELAY_KEY] if CFG_AUTO_SYNC_DELAY_KEY in self else 2 # seconds a directory has to be quiet before it is synced automatically
+        # when received files are flushed to disk: "none", "sync" (at the end of every sync) or "file" (before every file replaces its old version)
+        self.durability = self[CFG_DURABILITY_KEY] if CFG_DURABILITY_KEY in self else "sync"
             
 
 
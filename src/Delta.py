@@ -0,0 +1,125 @@
+import mmap
+import os
+import zlib
+from hashlib import md5
+from math import isqrt
+
+from src.Config import get_logger
+
+logger_name, logger = get_logger(__name__)
+
+
+# rsync style delta transfer:
+#   1. the receiver splits its (old) copy of a file into blocks and sends a weak (adler32) and a strong (md5) checksum of every block
+#   2. the sender looks for these blocks at every offset of its (new) copy using a rolling checksum and sends back
+#      operations: bytes (literal data) and tuples (first block, number of blocks) referencing blocks of the old copy
+#   3. the receiver rebuilds the new copy from the operations and its old copy
+
+MIN_DELTA_SIZE = 256 * 1024 # smaller files are sent whole
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+MAX_LITERAL_SIZE = 1024 * 1024 # max size of a single literal operation
+MAX_ROLL = 4 * 1024 * 1024 # after this many bytes without a match only every block_size bytes is checked (rolling in python is slow)
+ADLER_MOD = 65521
+
+
+
+def block_size_for(size:int) -> int:
+    """ block size grows with the square root of the file size (like rsync) """
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, isqrt(size) & ~1023))
+
+
+def signature(path, block_size:int) -> tuple:
+    """ returns the size of the file at *path* and (weak, strong) checksums for every block of it """
+    blocks, size = [], 0
+    with open(path, "rb") as file:
+        while block := file.read(block_size):
+            blocks.append((zlib.adler32(block), md5(block).digest()))
+            size += len(block)
+    return size, blocks
+
+
+def delta(path, basis_size:int, blocks:list, block_size:int):
+    """ yields the operations needed to turn the old copy (with signature *basis_size*, *blocks*) into the file at *path* """
+    last, short_last = len(blocks) - 1, basis_size % block_size != 0 # a short last block can only match at the end of the file
+    weak_index = {}
+    for i, (weak, _) in enumerate(blocks):
+        if i != last or not short_last: weak_index.setdefault(weak, []).append(i)
+
+    copy = [] # pending copy operation [first, count] (consecutive blocks are merged)
+    def copied(i):
+        if copy and copy[0] + copy[1] == i:
+            copy[1] += 1
+            return
+        if copy: yield tuple(copy)
+        copy[:] = [i, 1]
+    def literal(data, start, end):
+        if copy: yield tuple(copy)
+        copy.clear()
+        for offset in range(start, end, MAX_LITERAL_SIZE):
+            yield data[offset:min(end, offset + MAX_LITERAL_SIZE)]
+
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0: return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            L = block_size
+            literal_start = pos = misses = 0
+            weak = None
+            while pos + L <= size:
+                if weak is None:
+                    weak = zlib.adler32(data[pos:pos + L])
+                    a, b = weak & 0xffff, weak >> 16
+                match = None
+                if weak in weak_index:
+                    strong = md5(data[pos:pos + L]).digest()
+                    match = next((i for i in weak_index[weak] if blocks[i][1] == strong), None)
+
+                if match is not None:
+                    if literal_start < pos: yield from literal(data, literal_start, pos)
+                    yield from copied(match)
+                    pos += L
+                    literal_start, weak, misses = pos, None, 0
+                elif misses >= MAX_ROLL:
+                    pos += L
+                    weak = None
+                else:
+                    if pos + L < size: # roll the checksum one byte further
+                        out, new = data[pos], data[pos + L]
+                        a = (a - out + new) % ADLER_MOD
+                        b = (b - L * out + a - 1) % ADLER_MOD
+                        weak = (b << 16) | a
+                    pos += 1
+                    misses += 1
+
+            # the file ends with the (short) last block of the old copy
+            if short_last and blocks:
+                start = size - basis_size % L
+                if start >= literal_start and zlib.adler32(data[start:]) == blocks[last][0] and md5(data[start:]).digest() == blocks[last][1]:
+                    if literal_start < start: yield from literal(data, literal_start, start)
+                    yield from copied(last)
+                    literal_start = size
+            yield from literal(data, literal_start, size)
+
+
+def patch(basis, operations, out_file, block_size:int) -> None:
+    """ writes the file described by *operations* to *out_file*. *basis* is the opened old copy """
+    for operation in operations:
+        if isinstance(operation, tuple):
+            first, count = operation
+            basis.seek(first * block_size)
+            out_file.write(basis.read(count * block_size))
+        else:
+            out_file.write(operation)
+
+
+def batches(operations, max_size=MAX_LITERAL_SIZE, max_operations=1024):
+    """ groups *operations* into lists so they can be sent as few messages """
+    batch, size = [], 0
+    for operation in operations:
+        batch.append(operation)
+        if not isinstance(operation, tuple): size += len(operation)
+        if size >= max_size or len(batch) >= max_operations:
+            yield batch
+            batch, size = [], 0
+    if batch: yield batch
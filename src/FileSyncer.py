@@ -4,9 +4,12 @@ from enum import IntEnum
 from pathlib import Path
 from threading import Thread, Lock
 from src.Client import Conflicts
+from src.Chunks import ChunkStore
 
 from src.Config import get_logger, ConnectionsList, DirectoriesList, Sessions, Config, get_uuid, CFG_GLOB_IGN_KEY, CONN_AUTO_CONNECT_KEY
 from src.FileTracker import FileTracker
+from src.Limits import Limits
+from src.Scheduler import Scheduler
 from src.Server import Server, Callbacks
 from src.ui import UiBackend, UI_Code
 from src.utils import RepeatedJob
@@ -23,7 +26,6 @@ class Conflict:
 
 
 # TODO: add encryption 
-# TODO: sync optimization; check if files have been moved/renamed etc
 # TODO: add timeout to recv. When timeout is hit, connection is marked as disconnected.
 # TODO: standardize codes/flags between web part and python backend part
 #? What to do if a directory is no longer being tracked but a sync still references it?
@@ -40,13 +42,21 @@ class FileSyncer(Config):
         self.will_shut_down = False
         
         self.file_tracker = FileTracker(self.directories_list, self.logging_settings, self.data_path, \
-            self.global_ign_patterns, self.update_directory_graph_callback, self.new_directory_callback)
+            self.global_ign_patterns, self.update_directory_graph_callback, self.new_directory_callback, \
+            self.watch_directories, self.hash_workers, self.hash_queue_depth, self.hash_use_processes)
         
+        self.chunk_store = ChunkStore(self.data_path/"chunks.pickle") if self.dedupe_chunks else None
+        
+        self.limits = Limits(self.max_upload_rate, self.max_download_rate, self.max_disk_read_rate, self.max_disk_write_rate)
         server_callbacks = Callbacks(self.update_status_callback, self.update_sync_status_callback, self.new_conflict_callback, self.delete_conflict_callback)
         self.server = Server(self.hostname, self.ip, self.port, self.uuid, self.file_tracker, self.sessions, \
-            self.connections_list, self.logging_settings, server_callbacks, self.data_path)
+            self.connections_list, self.logging_settings, server_callbacks, self.data_path, self.download_window, self.transfer_lanes, self.compression, \
+            self.chunk_store, self.server_workers, self.sync_workers, self.max_syncs, self.limits, self.durability)
         self.server_thread = Thread(target=self.server.start_server, name ="server_thread") 
         
+        self.scheduler = Scheduler(self.server, self.connections_list, self.auto_sync_delay)
+        self.file_tracker.subscribe(self.scheduler.directory_changed)
+        
         self.auto_connect_thread = RepeatedJob(self.auto_connect_rate, target=self._auto_connect, name="auto_connect_thread")  
         
         self.ui = UiBackend(self.ui_port, {
@@ -64,6 +74,7 @@ class FileSyncer(Config):
             UI_Code.UUID_DEL_SYNC : self.delete_sync,
             UI_Code.UUID_RESOLVE_CONFLICT : self.resolve_conflict,
             UI_Code.UUID_REQ_CONFLICTS : self.get_conflicts,
+            UI_Code.REQ_SYNC_STATS : self.get_sync_stats,
             
             UI_Code.REQ_DIRS : self.get_directories,
             UI_Code.REQ_DIR_INFO : self.get_directory_info,
@@ -88,10 +99,12 @@ class FileSyncer(Config):
     
     def shut_down(self):
         self.will_shut_down = True
+        self.stop_auto_sync()
         self.server.shut_down()
         self.stop_auto_connect()
         self.server_thread.join()
         self.file_tracker.shut_down()
+        if self.chunk_store is not None: self.chunk_store.save()
         self.ui.shut_down() # is called last incase ui callbacks are triggered while shutting down
         logger.info("Filesyncer end")
         
@@ -109,11 +122,12 @@ class FileSyncer(Config):
         self.auto_connect_thread.stop()
         self.auto_connect_thread.join()
                   
-    def start_auto_sync(self, exclude):
-        raise NotImplementedError
+    def start_auto_sync(self, exclude=()):
+        """ syncs the directories of the syncs that have auto_sync set (uuids in *exclude* are left out) """
+        self.scheduler.start(exclude)
     
     def stop_auto_sync(self):
-        raise NotImplementedError
+        self.scheduler.stop()
         
         
     # query uuids          
@@ -151,6 +165,9 @@ class FileSyncer(Config):
     def sync(self, uuid, local_dir, remote_dir, conflict_policy=CONFLICT_POLICY.PROCEED_AND_RECORD, default_resolve=RESOLVE_POLICY.KEEP_ALL, bidirectional=True, priority=-1, block_backsync=True): 
         return self.server.clients[uuid].queue_sync(local_dir, remote_dir, conflict_policy, default_resolve, bidirectional, priority)
     
+    def get_sync_stats(self):
+        return self.scheduler.stats()
+    
     def get_conflicts(self, uuid, local_dir, remote_dir):
         if uuid not in self.server.clients: # cannot load conflicts beforehand as there might be temporary uuids flying around
             return Conflicts(self.data_path / f"Conflicts_{uuid}.pickle").get_conflicts(local_dir, remote_dir)
@@ -1,98 +1,269 @@
 
+import copy
 import datetime
 import glob
 import json
 import logging
 import os
 import pickle
+import stat
+import struct
 import time
-from hashlib import sha1
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from hashlib import blake2b, sha1
 from pathlib import Path
-from threading import Thread
+from threading import RLock, Thread
 
 from imohash import hashfile
 
 from src.Config import DATE_TIME_FORMAT, DEFAULT_TIME, DIR_IGNORE_KEY, get_logger
-from src.utils import hash_word, now, rel_path
+from src.utils import from_micros, hash_word, now, ns_to_micros, rel_path, to_micros
 from src.Codes import CONFLICT_TYPE, RESOLVE_POLICY
+from src.Ignore import IgnoreMatcher
+from src.Snapshot import is_snapshot, load_snapshot, save_snapshot
+from src.Watcher import create_watcher
 
 logger_name, logger = get_logger(__name__)
 
 
 
+STAT_SIGNATURE = struct.Struct("<qqQq") # size, mtime_ns, inode, ctime_ns
+TREE_ENTRY = struct.Struct("<Bqqq") # kind (0 = file, 1 = folder), created, modified, deleted
+CHANGELOG_SIZE = 100_000 # number of changes a Directory remembers (peers that are further behind get the whole graph)
 
-class DirectoryElement:
-    """ Base class for file/folder """
-    def __init__(self, rel_path:Path, dir_path:Path):
+def stat_signature(st:os.stat_result) -> bytes:
+    """ the parts of a stat result that change when the contents of a file change (packed to save memory) """
+    return STAT_SIGNATURE.pack(st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns)
+
+def entry_stat(entry:os.DirEntry) -> os.stat_result:
+    """ stat result of a scandir entry (cached by the entry). On Windows entries have no inode number -> stat the path to get the same signature """
+    return entry.stat() if os.name != "nt" else os.stat(entry.path)
+
+
+
+class HashPool:
+    """ pool of workers shared by all directory scans for hashing files in parallel """
+    def __init__(self, workers, queue_depth=None, use_processes=False):
+        self.executor = (ProcessPoolExecutor if use_processes else ThreadPoolExecutor)(workers)
+        self.queue_depth = queue_depth if queue_depth else 4 * workers # max number of files being hashed at once per scan
+        
+    def shut_down(self):
+        self.executor.shutdown()
+
+
+
+class ScanStats:
+    """ counts the work done by a (incremental) directory scan and hashes the files that need hashing """
+    def __init__(self, hash_pool=None, trusted=None):
+        self.stated = 0 # number of stat calls
+        self.hashed = 0 # number of files that had to be hashed
+        self.trusted = 0 # number of files whose hash was known already (see Directory.trust)
+        self.skipped = 0 # number of files/folders whose contents were not looked at again since their stats did not change
+        self.changed = [] # relative paths of files/folders that have been created, modified or deleted
+        self.hash_pool = hash_pool
+        self.trusted_hashes = trusted if trusted is not None else {} # full path -> (stat signature, hash) of files received by syncs
+        self.in_flight = deque() # (file, stat result, future) in submission order
+        
+    def hash(self, file, st):
+        """ hashes *file*, either right away or (if there is a hash pool) in the background. In that case join() must be called after the scan """
+        trusted = self.trusted_hashes.pop(str(file.full_path), None)
+        if trusted is not None and trusted[0] == stat_signature(st): # not changed since it was received
+            self.trusted += 1
+            file.set_hash(trusted[1], st, self)
+            return
+        self.hashed += 1
+        if self.hash_pool is None: 
+            self._apply(file, st, lambda: hashfile(file.full_path))
+            return
+        self.in_flight.append((file, st, self.hash_pool.executor.submit(hashfile, file.full_path)))
+        if len(self.in_flight) >= self.hash_pool.queue_depth: self._apply_next()
+    
+    def join(self):
+        while self.in_flight: self._apply_next()
+        
+    def _apply_next(self):
+        # results are applied on the scanning thread in submission order, so the graph is updated the same way as without a pool
+        file, st, future = self.in_flight.popleft()
+        self._apply(file, st, future.result)
+        
+    def _apply(self, file, st, get_hash):
+        """ stores the hash *get_hash* returns for *file* (same handling of files that can't be read with and without a pool) """
+        try: 
+            file.set_hash(get_hash(), st, self)
+        except OSError as e:
+            # deleted while waiting to be hashed or can't be read (e.g. locked by another program, it is hashed again during the next
+            # scan since its stat signature is only stored with a hash). A file that has never been hashed is not tracked until then
+            if not isinstance(e, FileNotFoundError): 
+                file.ctx.logger.warning(f"Failed to hash '{file.location()}': {e}")
+                if file.hash: return
+                file.parent._mtime_ns = None # lists the folder again during the next scan
+            file._stat = None
+            file.deleted()
+            self.changed.append(file.location())
+        
+    def __repr__(self):
+        return f"stated: {self.stated}, hashed: {self.hashed}, trusted: {self.trusted}, skipped: {self.skipped}"
+
+
+
+class DirectoryContext:
+    """ state shared by all files/folders of a directory (instead of storing it in every node) """
+    __slots__ = ("dir_path", "logger", "ignore")
+    
+    def __init__(self, dir_path:Path, ign_ptn):
         self.dir_path = dir_path
-        self.locations = {DEFAULT_TIME:rel_path} # will be used later for when file movement detection is implemented
         self.logger = logging.getLogger(f"{logger_name}.{hash_word(dir_path)}")
-        self._deleted = DEFAULT_TIME
-        self._modified = DEFAULT_TIME
-        self._created = DEFAULT_TIME
+        self.ignore_patterns = ign_ptn
+        
+    @property
+    def ignore_patterns(self): return self.ignore.patterns
+    
+    @ignore_patterns.setter
+    def ignore_patterns(self, ign_ptn): self.ignore = IgnoreMatcher(ign_ptn) # compiled once, new cache
+
+
+
+class DirectoryElement:
+    """ 
+    Base class for file/folder. Only the name is stored, paths are derived from the parent links.
+    Timestamps are stored as integers (microseconds since DEFAULT_TIME, see utils.to_micros), 0 = DEFAULT_TIME
+    """
+    __slots__ = ("name", "parent", "ctx", "_deleted", "_modified", "_created", "hash")
+    
+    def __init__(self, name:str, parent, ctx:DirectoryContext=None):
+        self.name = name
+        self.parent = parent
+        self.ctx = parent.ctx if ctx is None else ctx
+        self._deleted = 0
+        self._modified = 0
+        self._created = 0
         self.hash = 0
+        if parent is not None: parent._invalidate()
 
-    def location(self, time=now(), prev=False) -> Path:
-        """returns location at *time* (relative to dir_path)"""
-        times = sorted(list(self.locations.keys()) + [time])
-        return self.locations[times[times.index(time)-(1+int(prev))]]
+    def location(self) -> Path:
+        """returns location relative to dir_path"""
+        return self.rel_path
     
-    def created(self, time=now()) -> None:
-        self._deleted = DEFAULT_TIME
-        self._created = time
-        self._modified = time
+    def created(self, time=None) -> None:
+        self._deleted = 0
+        self._created = self._modified = to_micros(now() if time is None else time)
+        self._invalidate()
     
-    def deleted(self, time=now()) -> None:
-        self._deleted = time # maybe use whatchdog to get a more acurate deletion time 
-        self._created = DEFAULT_TIME
-        self._modified = DEFAULT_TIME
+    def deleted(self, time=None) -> None:
+        self._deleted = to_micros(now() if time is None else time) # maybe use whatchdog to get a more acurate deletion time 
+        self._created = 0
+        self._modified = 0
+        self._invalidate()
+        
+    def _invalidate(self) -> None:
+        """ 
+        clears the cached tree hashes and aggregates of the folders containing self (see Folder.tree_hash, Folder._aggregate). 
+        Invariant: the ancestors of a folder without tree hash/aggregates have none either -> stop at the first folder without both
+        """
+        node = self if isinstance(self, Folder) else self.parent
+        while node is not None and (node._tree_hash is not None or node._aggregates is not None):
+            node._tree_hash = node._aggregates = None
+            node = node.parent
+            
+    def _copy(self, parent):
+        """ copy of this node without children, used to send parts of a graph """
+        node = copy.copy(self)
+        node.parent, node.ctx = parent, None
+        return node
         
     # only when this function is called, will there be any queres to the os
     def update(self): raise NotImplementedError # to override
     
-    def is_modified(self): raise NotImplementedError # to override
+    def is_modified(self, time) -> bool:
+        """ returns boolean value wether self has been modified during the time span between now and *time*"""
+        return self._is_modified(to_micros(time))
+    
+    def _is_modified(self, time:int): raise NotImplementedError # to override
+    
+    def _parts(self) -> list:
+        parts, node = [], self
+        while node.parent is not None:
+            parts.append(node.name)
+            node = node.parent
+        return parts[::-1]
     
     @property
-    def rel_path(self) -> Path: return self.location()
-        
+    def dir_path(self) -> Path: return self.ctx.dir_path
+    
     @property
-    def last_modif_time(self) -> datetime.datetime: raise NotImplementedError # to override
+    def logger(self): return self.ctx.logger
     
     @property
-    def full_path(self) -> Path: return self.dir_path / self.location()
+    def rel_path(self) -> Path: return Path(*self._parts())
+        
+    @property
+    def last_modif_time(self) -> datetime.datetime: return from_micros(self._last_modif_time())
+    
+    def _last_modif_time(self) -> int: raise NotImplementedError # to override
     
     @property
-    def exists(self) -> bool: return self._deleted == DEFAULT_TIME
+    def full_path(self) -> Path: return self.ctx.dir_path.joinpath(*self._parts())
     
     @property
-    def name(self) -> str: return self.__repr__()
+    def exists(self) -> bool: return self._deleted == 0
     
     def __repr__(self):
-        return self.full_path.name
+        return self.name
+    
+    def __setstate__(self, state):
+        if isinstance(state, dict): # graphs pickled by older versions (regular objects with datetime timestamps), see Folder._upgrade
+            for key in ("_deleted", "_modified", "_created"): state[key] = to_micros(state[key])
+            rel_path = next(iter(state.pop("locations").values()))
+            state.update(name=rel_path.name, parent=None, ctx=DirectoryContext(state.pop("dir_path"), state.pop("ignore_patterns", [])))
+            state.pop("logger")
+            if state.get("_stat"): state["_stat"] = STAT_SIGNATURE.pack(*state["_stat"])
+        else: 
+            state = state[1]
+        for key in type(self).__slots__: state.setdefault(key, None) # attributes added since
+        for key, value in state.items(): setattr(self, key, value)
     
     
     
 class File(DirectoryElement):
-    def __init__(self, rel_path, dir_path, update_on_creation=True):
-        super().__init__(rel_path, dir_path)
+    __slots__ = ("_stat",) # packed stat signature at the time of the last hash
+    
+    def __init__(self, name:str, parent, ctx:DirectoryContext=None, update_on_creation=True):
+        super().__init__(name, parent, ctx)
+        self._stat = None
         if update_on_creation: self.update()
-        
-    @property
-    def last_modif_time(self) -> datetime.datetime: 
+    
+    def _last_modif_time(self) -> int: 
         return max(self._modified, self._created)
     
-    def update(self) -> None:
+    @property
+    def size(self) -> int: return STAT_SIGNATURE.unpack(self._stat)[0] if self._stat else None # at the time of the last hash
+    
+    def update(self, stats=None, st=None) -> None:
+        """ rehashes the file if its stat signature changed. *st* can be passed if the file has already been stat'ed """
+        if stats is None: stats = ScanStats()
+        if st is None: 
+            st = self.full_path.stat()
+            stats.stated += 1
         if not self.exists: self.created()
+        
+        if stat_signature(st) == self._stat:
+            stats.skipped += 1
+            return
+        stats.hash(self, st) # the signature is stored with the hash (see set_hash), a file that can't be hashed is tried again next time
+            
+    def set_hash(self, new_hash, st, stats) -> None:
+        self._stat = stat_signature(st)
         # update hash if file has been modified since last update
-        if (new_hash := hashfile(self.full_path)) != self.hash:
+        if new_hash != self.hash:
             self.hash = new_hash
             # indented so only when contents of file are actually modified, it will be recorded
-            self._modified = datetime.datetime.utcfromtimestamp(self.full_path.stat().st_mtime) 
+            self._modified = ns_to_micros(st.st_mtime_ns)
+            stats.changed.append(self.rel_path)
+            self._invalidate()
             
-    def is_modified(self, time) -> bool:
-        """ returns boolean value wether file has been modified during the time span between now and *time*"""
-        if self.full_path.exists(): return self.last_modif_time > time # should prob be self.exists
-        else: return False 
+    def _is_modified(self, time:int) -> bool:
+        return self.exists and self._last_modif_time() > time
             
    
    
@@ -104,141 +275,280 @@ class File(DirectoryElement):
 #       FOLDER
 #######################
 class Folder(DirectoryElement):
-    def __init__(self, rel_path:Path, dir_path:Path, ign_ptn, update_on_creation=True):
-        super().__init__(rel_path, dir_path)
-        self.ignore_patterns = ign_ptn
+    # folders/files are keyed by name. _mtime_ns: folder mtime at the time of the last listing. _tree_hash: see tree_hash, _aggregates: see _aggregate
+    __slots__ = ("folders", "files", "_mtime_ns", "_tree_hash", "_aggregates")
+    
+    def __init__(self, name:str, parent, ctx:DirectoryContext=None, update_on_creation=True):
+        self._tree_hash = self._aggregates = None
+        super().__init__(name, parent, ctx)
         self.folders = {}
         self.files = {}
+        self._mtime_ns = None
         if update_on_creation: self.update()
+        
+    @classmethod
+    def root(cls, dir_path:Path, ign_ptn, update_on_creation=True):
+        return cls(dir_path.name, None, DirectoryContext(dir_path, ign_ptn), update_on_creation)
+    
+    def _upgrade(self):
+        """ links the nodes of a graph that has been pickled by an older version (keyed by relative paths, no parent links) """
+        for elements in (self.files, self.folders):
+            for key in list(elements):
+                element = elements.pop(key)
+                element.parent, element.ctx = self, self.ctx
+                elements[element.name] = element
+        for folder in self.folders.values(): folder._upgrade()
+    
+    @property
+    def ignore_patterns(self): return self.ctx.ignore_patterns
+    
+    @property
+    def tree_hash(self) -> bytes:
+        """ 
+        hash over the state (hash, timestamps) of all files/folders in this folder (Merkle tree). Two folders with the same tree hash
+        merge the same way, so unchanged subtrees don't have to be sent. Cached until something in the folder changes (see _invalidate)
+        """
+        if self._tree_hash is None:
+            tree_hash = blake2b(digest_size=16)
+            for name in sorted(self.files):
+                file = self.files[name]
+                tree_hash.update(TREE_ENTRY.pack(0, file._created, file._modified, file._deleted))
+                tree_hash.update(file.hash if isinstance(file.hash, bytes) else b"")
+                tree_hash.update(name.encode() + b"\0")
+            for name in sorted(self.folders):
+                folder = self.folders[name]
+                tree_hash.update(TREE_ENTRY.pack(1, folder._created, folder._modified, folder._deleted))
+                tree_hash.update(folder.tree_hash)
+                tree_hash.update(name.encode() + b"\0")
+            self._tree_hash = tree_hash.digest()
+        return self._tree_hash
+    
+    def get_folder(self, parts):
+        """ returns the tracked (sub)folder at the relative path *parts* or None """
+        folder = self
+        for part in parts:
+            folder = folder.folders.get(part)
+            if folder is None: return None
+        return folder
+    
+    def get_node(self, parts):
+        """ returns the tracked file/folder at the relative path *parts* or None """
+        if not parts: return self
+        folder = self.get_folder(parts[:-1])
+        if folder is None: return None
+        return folder.files.get(parts[-1], folder.folders.get(parts[-1]))
+    
+    def subtree(self, parent=None):
+        """ copy of this folder and everything in it, detached from the rest of the graph """
+        node = self._copy(parent)
+        node.files = {name: file._copy(node) for name, file in self.files.items()}
+        node.folders = {name: folder.subtree(node) for name, folder in self.folders.items()}
+        return node
+    
+    def attach(self, parent):
+        """ links a detached subtree (see subtree) into *parent* """
+        self.parent, self.ctx = parent, parent.ctx
+        for file in self.files.values(): file.parent, file.ctx = self, self.ctx
+        for folder in self.folders.values(): folder.attach(self)
+    
+    def summary(self):
+        """ copy of this folder that contains copies of its files and subfolders. The subfolders are empty but keep their tree hash """
+        summary = self._copy(None)
+        summary._tree_hash = self.tree_hash
+        summary.files = {name: file._copy(summary) for name, file in self.files.items()}
+        summary.folders = {}
+        for name, folder in self.folders.items():
+            summary.folders[name] = folder._copy(summary)
+            summary.folders[name].files, summary.folders[name].folders = {}, {}
+        return summary
+    
+    def graft(self, summary) -> list:
+        """ takes over the files and subfolder states of *summary* (see summary). Returns the names of the subfolders whose contents differ """
+        self.files = {}
+        for name, file in summary.files.items():
+            file.parent, file.ctx = self, self.ctx
+            self.files[name] = file
+        folders, changed = {}, []
+        for name, stub in summary.folders.items():
+            folder = folders[name] = self.folders[name] if name in self.folders else Folder(name, self, update_on_creation=False)
+            folder._created, folder._modified, folder._deleted, folder.hash = stub._created, stub._modified, stub._deleted, stub.hash
+            folder._aggregates = None
+            if folder.tree_hash != stub._tree_hash: changed.append(name)
+        self.folders = folders
+        self._invalidate()
+        return changed
     
     def is_in_ignore(self, path:Path, is_file=None) -> bool:  # is_file currently not in use
-        rel = rel_path(path, self.dir_path)
-        for pattern in self.ignore_patterns:
-            if rel.match(pattern): return True
-        return False
+        return self.ctx.ignore.match(rel_path(path, self.ctx.dir_path).parts)
     
     def deleted(self) -> None:
         super().deleted()
         for file in self.files.values(): file.deleted()
         for folder in self.folders.values(): folder.deleted()
         
+    def _aggregate(self) -> tuple:
+        """ 
+        (last modification time, last modification time of the existing files, number of existing files/folders) of the subtree.
+        Cached until something in the folder changes (see _invalidate)
+        """
+        if self._aggregates is None:
+            last_modif = live_modif = self._created # creating a folder also counts as modifying it
+            live_entries = 0
+            for file in self.files.values():
+                file_modif = file._last_modif_time()
+                last_modif = max(last_modif, file_modif)
+                if file.exists: live_modif, live_entries = max(live_modif, file_modif), live_entries + 1
+            for folder in self.folders.values():
+                folder_last_modif, folder_live_modif, folder_live_entries = folder._aggregate()
+                last_modif, live_modif = max(last_modif, folder_last_modif), max(live_modif, folder_live_modif)
+                live_entries += folder_live_entries + folder.exists
+            self._aggregates = (last_modif, live_modif, live_entries)
+        return self._aggregates
+    
     @property
-    def last_modif_time(self) -> datetime.datetime: 
-        return max(self._created, *[obj.last_modif_time for obj in {**self.folders, **self.files}.values()])
+    def live_entries(self) -> int: return self._aggregate()[2]
     
-    def is_modified(self, time) -> bool:
-        # creating a folder also counts as modifying it
-        if self._created > time: return True
-        # check if any subfolders  or files have been modified
-        for dir_element in {**self.folders, **self.files}.values():
-            if dir_element.is_modified(time): return True
-        return False 
+    def _last_modif_time(self) -> int: 
+        return self._aggregate()[0]
+    
+    def _is_modified(self, time:int) -> bool:
+        # modified if the folder has been created or any file in it has been modified since *time*
+        return self._aggregate()[1] > time
     
     def update_ign_ptn(self, ign_ptn):
-        self.ignore_patterns = ign_ptn
-        for _, folder in self.folders.items():
-            folder.update_ign_ptn(ign_ptn)
+        self.ctx.ignore_patterns = ign_ptn
     
-    def update(self):
-        """ updates state (= _created, _deleted) of self and folders/files"""
+    def update(self, stats=None, full=False, st=None):
+        """ 
+        updates state (= _created, _deleted) of self and folders/files
+        
+        Parameters:
+            stats (ScanStats): counts the work done by the scan
+            full (bool): if False, the entries of folders whose mtime did not change are not listed again (only the tracked ones are checked)
+            st (os.stat_result): stat result of the folder if it is known already (from listing the parent folder)
+        """
+        if stats is None: stats = ScanStats()
         # check if file self been created
         if not self.exists: self.created()
         
-        # check if file/folder has been deleted from disk but has not been registered yet
-        for dir_element in {**self.folders, **self.files}.values():
-            if not dir_element.full_path.exists() and dir_element.exists:
+        full_path = self.full_path
+        if st is None:
+            st = os.stat(full_path)
+            stats.stated += 1
+        if not full and st.st_mtime_ns == self._mtime_ns:
+            # no entries have been added/removed/renamed in this folder -> only check tracked entries for modifications
+            stats.skipped += 1
+            for file in self.files.values():
+                if file.exists: self._update_file(file, os.path.join(full_path, file.name), stats)
+            for folder in self.folders.values():
+                if folder.exists: folder.update(stats, full)
+            return
+        
+        # list entries once (scandir knows the type of the entries without stat'ing them) and check which tracked files/folders are no longer on disk
+        with os.scandir(full_path) as listing: entries = {entry.name:entry for entry in listing}
+        parts, ignore = tuple(self._parts()), self.ctx.ignore
+        for dir_element in (*self.folders.values(), *self.files.values()):
+            entry = entries.get(dir_element.name)
+            # a folder that has been replaced by a file with the same name (or the other way around) has been deleted too
+            if dir_element.exists and (entry is None or (entry.is_dir() if isinstance(dir_element, File) else not entry.is_dir())):
                 dir_element.deleted()
-                self.logger.info(f"'{dir_element.location()}' deleted")
+                stats.changed.append(dir_element.rel_path)
+                self.logger.info(f"'{dir_element.rel_path}' deleted")
         
         # update files    
-        for file in filter(lambda f: f.is_file(), self.full_path.iterdir()):
-            rel_path = self.location() / file.name
-            if not self.is_in_ignore(file):
-                if rel_path in self.files:  
-                    self.files[rel_path].update()
-                else:  
-                    self.files[rel_path] = File(rel_path, self.dir_path) 
-                    self.logger.info(f"File '{rel_path}' created")
-            elif rel_path in self.files:
-                del self.files[rel_path]
-                self.logger.info(f"File '{rel_path}' is now ignored")
+        for name, file in entries.items():
+            if not file.is_file(): continue
+            if not ignore.match((*parts, name)):
+                if name not in self.files:  
+                    self.files[name] = File(name, self, update_on_creation=False) 
+                    stats.changed.append(self.files[name].rel_path)
+                    self.logger.info(f"File '{self.files[name].rel_path}' created")
+                self._update_file(self.files[name], file, stats) # the only stat of the file
+            elif name in self.files:
+                self.logger.info(f"File '{self.files.pop(name).rel_path}' is now ignored")
+                self._invalidate()
         
         # update folders
-        for folder in filter(lambda f: f.is_dir(), self.full_path.iterdir()):
-            rel_path = self.location() / folder.name
-            if not self.is_in_ignore(folder): 
-                if rel_path in self.folders:  
-                    self.folders[rel_path].update()
+        for name, folder in entries.items():
+            if not folder.is_dir(): continue
+            if not ignore.match((*parts, name)): 
+                st_folder = entry_stat(folder)
+                stats.stated += 1
+                if name in self.folders:  
+                    self.folders[name].update(stats, full, st_folder)
                 else:
-                    self.folders[rel_path] = Folder(rel_path, self.dir_path, self.ignore_patterns)
-            elif rel_path in self.folders:
-                del self.folders[rel_path]
-                self.logger.info(f"Folder '{rel_path}' is now ignored")
+                    self.folders[name] = Folder(name, self, update_on_creation=False)
+                    self.folders[name].update(stats, full, st_folder)
+                    stats.changed.append(self.folders[name].rel_path)
+            elif name in self.folders:
+                self.logger.info(f"Folder '{self.folders.pop(name).rel_path}' is now ignored")
+                self._invalidate()
+        self._mtime_ns = st.st_mtime_ns
+        
+    def update_entry(self, name, stats):
+        """ updates a single entry of this folder without listing the folder (used for targeted updates by the Watcher) """
+        tracked = self.folders.get(name, self.files.get(name))
+        path = self.full_path / name
+        try: 
+            st = os.stat(path)
+            stats.stated += 1
+        except FileNotFoundError:
+            if tracked is not None and tracked.exists:
+                tracked.deleted()
+                stats.changed.append(tracked.rel_path)
+                self.logger.info(f"'{tracked.rel_path}' deleted")
+            return
+        
+        if self.ctx.ignore.match((*self._parts(), name)): return
+        replaced = self.files.get(name) if stat.S_ISDIR(st.st_mode) else self.folders.get(name) # by an entry of the other kind
+        if replaced is not None and replaced.exists:
+            replaced.deleted()
+            stats.changed.append(replaced.rel_path)
+            self.logger.info(f"'{replaced.rel_path}' deleted")
+        if stat.S_ISDIR(st.st_mode):
+            if new_folder := name not in self.folders or not self.folders[name].exists:
+                if name not in self.folders: self.folders[name] = Folder(name, self, update_on_creation=False)
+                stats.changed.append(self.folders[name].rel_path)
+            self.folders[name].update(stats, full=new_folder)
+        elif stat.S_ISREG(st.st_mode):
+            if name not in self.files:  
+                self.files[name] = File(name, self, update_on_creation=False) 
+                stats.changed.append(self.files[name].rel_path)
+                self.logger.info(f"File '{self.files[name].rel_path}' created")
+            self.files[name].update(stats, st)
+        
+    def _update_file(self, file, path, stats):
+        """ *path* is the path of the file or its scandir entry """
+        try: 
+            st = entry_stat(path) if isinstance(path, os.DirEntry) else os.stat(path)
+            stats.stated += 1
+        except FileNotFoundError: # deleted since the folder has been listed
+            file.deleted()
+            stats.changed.append(file.rel_path)
+            self.logger.info(f"'{file.rel_path}' deleted")
+            return
+        file.update(stats, st)
                         
-    def merge(self, other, last_time_synced, conflict_callback) -> None:
+    def merge(self, other, last_time_synced, conflict_callback):
         """
-        Merges this folder and another folder
+        Merges this folder and another folder. Files/folders that have to be downloaded are added with hash 0 (see Merge)
         
         Parameters:
             other (Folder): folder to be merged with this folder (=self)
             last_time_synced (datetime.datetime): last time self and other were synced 
             conflict_callback (function): function called when there is a conflict
+            
+        Returns:
+            MergeResult: the decisions taken
         """   
-        # update_on_creation is set to false since the files/folders must be downloaded first
-        for file in other.files:
-            if not self.is_in_ignore(file, is_file=True):
-                other_file = File(other.files[file].rel_path, self.dir_path, False)
-                if other.files[file].exists:                    
-                    if file not in self.files:
-                        # self does not contain *file*
-                        self.files[file] = other_file
-                        
-                    elif self.files[file].hash != other.files[file].hash and other.files[file].is_modified(last_time_synced): 
-                        # self contains *file* but their contents are different and other.file has been modified since last sync
-                        if self.files[file].is_modified(last_time_synced):
-                            # both have been modifed since last sync -> conflict
-                           conflict_callback(self, other, file, other_file, False, CONFLICT_TYPE.MODIF_CONFLICT) 
-                        elif not self.files[file].exists:
-                            # self.file has been deleted but the other.file exists -> conflict 
-                            conflict_callback(self, other, file, other_file, False, CONFLICT_TYPE.DELETE_CONFLICT)
-                        else:
-                            self.files[file] = other_file
-                            
-                else: # other.file has been deleted
-                    if file in self.files:
-                        if self.files[file].is_modified(last_time_synced):
-                            # other.file has been deleted but self.file has been modified -> conflict
-                            conflict_callback(self, other, file, other_file, False, CONFLICT_TYPE.DELETE_CONFLICT)
-                        else:
-                            self.files[file].deleted()
-                            
-        for folder in other.folders:
-            if not self.is_in_ignore(folder, is_file=False):
-                other_folder = Folder(other.folders[folder].location(), self.dir_path, self.ignore_patterns,False)
-                if other.folders[folder].exists:
-                    if folder not in self.folders:
-                        # self does not contain *folder*
-                        self.folders[folder] = other_folder
-                    if not self.folders[folder].exists:
-                        # self.folder has been deleted but the other.folder exists -> conflict 
-                        conflict_callback(self, other, folder, other_folder, True, CONFLICT_TYPE.DELETE_CONFLICT)
-                    
-                    # merge subfolders aswell
-                    self.folders[folder].merge(other.folders[folder], last_time_synced, conflict_callback)
-                    
-                else: # other.folder has been deleted
-                    if folder in self.folders: 
-                        if self.folders[folder].is_modified(last_time_synced):
-                            # other.folder has been deleted but self.folder has been modified -> conflict
-                            conflict_callback(self, other, folder, other_folder, True, CONFLICT_TYPE.DELETE_CONFLICT)
-                        else:
-                            self.folders[folder].deleted()
+        from src.Merge import merge # Merge builds on File/Folder
+        return merge(self, other, last_time_synced, conflict_callback)
                             
     def to_dict(self):
         return {
             "name": self.name,
-            "files":{str(path):file.name for path, file in self.files.items() if file.exists},
-            "folders":{str(path):folder.to_dict() for path, folder in self.folders.items() if folder.exists}
+            "files":{str(file.rel_path):file.name for file in self.files.values() if file.exists},
+            "folders":{str(folder.rel_path):folder.to_dict() for folder in self.folders.values() if folder.exists}
         }
                             
 
@@ -248,35 +558,182 @@ class Folder(DirectoryElement):
 #     DIRECTORY
 #######################
 class Directory():
-    def __init__(self, path:Path, save_folder:Path, dir_ignore, glob_ignore, logging_settings, update_callback):
+    def __init__(self, path:Path, save_folder:Path, dir_ignore, glob_ignore, logging_settings, update_callback, hash_pool=None):
         self.path = path  # location of the directory on disk
         self.hash = hash_word(self.path)
         self.save_file = save_folder / self.hash  # file where directory Graph is stored
         self.dir_ign_patterns = dir_ignore 
         self.glob_ign_patterns = glob_ignore
+        self.ignore_patterns = list(dict.fromkeys(self.dir_ign_patterns + self.glob_ign_patterns))
         self.logger = logging_settings.create_logger(f"{logger_name}.{self.hash}", f"{self.hash}.log")
         self.update_callback = update_callback
+        self.hash_pool = hash_pool
+        self.subscribers = [] # change stream: called with (dir path, changed relative paths) after every update that changed something
+        self.load_callbacks = [] # called once the graph has been loaded (see when_loaded)
+        self.lock = RLock() # the watcher and syncs update the graph from different threads
         
-        if self.save_file.exists():
-            self.root = pickle.loads(self.save_file.read_bytes())
-            self.root.update_ign_ptn(self.ignore_patterns)
-        else:
-            self.root = Folder(Path(), self.path, self.ignore_patterns)
-        self.save()
+        # every change gets a sequence number so peers can ask for the changes since the last version they have seen (see changes_since)
+        self.epoch = os.urandom(8).hex() # changes when the changelog restarts (e.g. after a restart of the program)
+        self.seq = 0
+        self.changelog = deque(maxlen=CHANGELOG_SIZE) # (seq, relative path parts)
+        self._hash_index = None # hash -> relative paths (parts) of the files with that hash, built when it is first needed (see paths_with_hash)
+        self.trusted = {} # full path -> (stat signature, hash) of files whose hash is known without reading them (see trust)
+        
+        # saved graphs are only loaded when they are first needed, see self.root 
+        self._root = None
+        if not self.save_file.exists():
+            self._root = Folder.root(self.path, self.ignore_patterns, False)
+            self.update()
+            self.save()
+            
+    @property
+    def root(self) -> Folder:
+        """ the directory graph. It is loaded from disk (and brought up to date) the first time it is accessed """
+        if self._root is None:
+            with self.lock:
+                if self._root is None: self._load()
+        return self._root
+    
+    def _load(self):
+        start = time.perf_counter()
+        if is_snapshot(self.save_file):
+            self._root = load_snapshot(self.save_file, self.path, self.ignore_patterns)
+        else: # save files of older versions are pickled graphs
+            self._root = pickle.loads(self.save_file.read_bytes())
+            self._root._upgrade()
+            self._root.name = self.path.name
+            self._root.update_ign_ptn(self.ignore_patterns)
+        self.logger.debug(f"Loaded directory graph of {self.path} in {time.perf_counter() - start:.3f}s")
+        self.update()
+        callbacks, self.load_callbacks = self.load_callbacks, []
+        for callback in callbacks: callback()
+    
+    def when_loaded(self, callback):
+        """ calls *callback()* once the graph has been loaded (right away if it has been loaded already), without loading it """
+        with self.lock:
+            if self._root is None: 
+                self.load_callbacks.append(callback)
+                return
+        callback()
     
     def update_ign_patterns(self, dir_ign=None, glob_ign=None):
         if dir_ign is not None: self.dir_ign_patterns = dir_ign
         if glob_ign is not None: self.glob_ign_patterns = glob_ign
-        self.root.update_ign_ptn(self.ignore_patterns)
-        self.update(callback=True)
+        self.ignore_patterns = list(dict.fromkeys(self.dir_ign_patterns + self.glob_ign_patterns))
+        self.root.update_ign_ptn(self.ignore_patterns) # new matcher -> the cached decisions are dropped
+        self.update(callback=True, full=True) # previously ignored entries must be listed again
+        with self.lock: # newly ignored entries are removed from the graph without being recorded -> peers need the whole graph
+            self.epoch, self.seq = os.urandom(8).hex(), 0
+            self.changelog.clear()
         
-    def update(self, callback=False):
+    def update(self, callback=False, full=False):
         self.logger.debug(f"Updating directory {self.path}")
-        self.root.update()
+        stats = ScanStats(self.hash_pool, self.trusted)
+        start = time.perf_counter()
+        with self.lock:
+            self.root.update(stats, full)
+            stats.join()
+            self._record(stats)
+            self.trusted.clear() # every file has been looked at, what is left is outdated
+        self.logger.debug(f"Updated directory {self.path} in {time.perf_counter() - start:.3f}s ({stats})")
+        self._publish(stats)
         if callback: self.update_callback(str(self.path))
+        return stats
+    
+    def update_paths(self, rel_paths, callback=False):
+        """ targeted update of the given relative paths, only their parent folders are looked at """
+        stats = ScanStats(self.hash_pool, self.trusted)
+        with self.lock:
+            for rel_path in rel_paths:
+                if self.root.ctx.ignore.match_any(Path(rel_path).parts): continue # changes in ignored folders are not tracked
+                # find the tracked folder containing rel_path. If it is not tracked (yet), update the closest tracked ancestor
+                *parents, name = Path(rel_path).parts or ("",)
+                folder = self.root
+                for part in parents:
+                    sub_folder = folder.folders.get(part)
+                    if sub_folder is None or not sub_folder.exists: 
+                        name = ""
+                        break
+                    folder = sub_folder
+                if name: folder.update_entry(name, stats)
+                else: folder.update(stats)
+            stats.join()
+            self._record(stats)
+        self.logger.debug(f"Updated {len(rel_paths)} paths in directory {self.path} ({stats})")
+        self._publish(stats)
+        if callback and stats.changed: self.update_callback(str(self.path))
+        return stats
+    
+    def hash_of(self, parts):
+        """ 
+        hash of the file at the relative path *parts*: the tracked (or trusted) one if the stat of the file did not change since, 
+        otherwise the file is hashed 
+        """
+        path = self.path.joinpath(*parts)
+        signature = stat_signature(os.stat(path))
+        with self.lock:
+            node = self.root.get_node(parts)
+            if isinstance(node, File) and node.exists and node.hash and node._stat == signature: return node.hash
+            trusted = self.trusted.get(os.path.normpath(path))
+            if trusted is not None and trusted[0] == signature: return trusted[1]
+        return hashfile(path)
+    
+    def trust(self, path, hash, st):
+        """ 
+        the file at *path* (full path) has the contents *hash* (e.g. computed while it was received). The next scan uses it instead of
+        hashing the file, unless the stat result of the file is not *st* anymore
+        """
+        with self.lock: self.trusted[os.path.normpath(path)] = (stat_signature(st), hash)
+    
+    def _record(self, stats):
+        for path in stats.changed:
+            self.seq += 1
+            self.changelog.append((self.seq, path.parts))
+            if self._hash_index is not None and isinstance(node := self.root.get_node(path.parts), File) and node.exists:
+                self._hash_index.setdefault(node.hash, set()).add(path.parts)
+    
+    def paths_with_hash(self, hash) -> list:
+        """ 
+        relative paths (parts) of the existing files with *hash*. The index only grows when files change, entries whose file has been
+        deleted or changed since they were indexed are dropped when they are looked up
+        """
+        with self.lock:
+            if self._hash_index is None:
+                self._hash_index, pending = {}, [(self.root, ())]
+                while pending:
+                    folder, parts = pending.pop()
+                    for name, file in folder.files.items():
+                        if file.exists: self._hash_index.setdefault(file.hash, set()).add((*parts, name))
+                    pending.extend((sub_folder, (*parts, name)) for name, sub_folder in folder.folders.items() if sub_folder.exists)
+            paths = self._hash_index.get(hash, set())
+            for parts in list(paths):
+                node = self.root.get_node(parts)
+                if not isinstance(node, File) or not node.exists or node.hash != hash: paths.discard(parts)
+            if not paths: self._hash_index.pop(hash, None)
+            return list(paths)
+            
+    @property
+    def version(self): return (self.epoch, self.seq)
+    
+    def changes_since(self, version):
+        """ relative paths (parts) of the entries that changed since *version* or None if the changes are not known (anymore) """
+        epoch, seq = version
+        with self.lock:
+            if epoch != self.epoch or seq > self.seq or (self.changelog and self.changelog[0][0] > seq + 1): return None
+            return list(dict.fromkeys(parts for change_seq, parts in self.changelog if change_seq > seq))
+        
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+        
+    def _publish(self, stats):
+        if stats.changed:
+            changed = list(dict.fromkeys(stats.changed)) # created files are also reported as modified
+            for callback in self.subscribers: callback(str(self.path), changed)
         
     def save(self):
-        self.save_file.write_bytes(pickle.dumps(self.root))
+        if self._root is None: return # never loaded -> nothing has changed
+        with self.lock:
+            save_snapshot(self.save_file, self._root)
         logger.info(f"Save directory tracker @ {self.path}")
     
     def to_dict(self):
@@ -285,10 +742,6 @@ class Directory():
     def is_in_ignore(self, f):
         return self.root.is_in_ignore(Path(f))
     
-    @property
-    def ignore_patterns(self): 
-        return list(set(self.dir_ign_patterns + self.glob_ign_patterns))
-    
     
     
 
@@ -298,7 +751,7 @@ class Directory():
 #######################
 class FileTracker:
     """Stores tracked/manages tracked directories"""
-    def __init__ (self, directories, logging_settings, data_path, glob_ign_ptn, update_callback, new_dir_callback):
+    def __init__ (self, directories, logging_settings, data_path, glob_ign_ptn, update_callback, new_dir_callback, watch=False, hash_workers=0, hash_queue_depth=None, hash_use_processes=False):
         logger.info("Filetracker online")
         self.directories_list = directories # data on directories to track
         self.logging_settings = logging_settings
@@ -306,19 +759,28 @@ class FileTracker:
         self.update_callback = update_callback
         self.new_dir_callback = new_dir_callback
         self.global_ign_patterns = glob_ign_ptn
+        self.subscribers = []
+        self.hash_pool = HashPool(hash_workers, hash_queue_depth, hash_use_processes) if hash_workers > 0 else None
     
         self.directories = {} 
         for dir_path, dir_props in self.directories_list.items():
-            self.directories[str(dir_path)] = Directory(Path(dir_path), self.save_path, dir_props[DIR_IGNORE_KEY], self.global_ign_patterns, self.logging_settings, update_callback)
+            self.directories[str(dir_path)] = Directory(Path(dir_path), self.save_path, dir_props[DIR_IGNORE_KEY], self.global_ign_patterns, self.logging_settings, update_callback, self.hash_pool)
+        # directories load and update their graphs once they are first used (see Directory.root)
         
-        for _, directory in self.directories.items():
-            directory.update()
+        # real time change detection, see Watcher.py
+        self.watcher = None
+        if watch:
+            self.watcher = create_watcher()
+            for directory in self.directories.values(): self.watcher.watch(directory)
+            self.watcher.start()
         
     def add_directory(self, path:Path,  name:str, dir_ign_patterns:list) -> None:
         if path in self.directories: raise Exception(f"Already tracking {path}")
         
-        self.directories[str(path)] = Directory(Path(path), self.save_path, dir_ign_patterns, self.global_ign_patterns, self.logging_settings, self.update_callback)
+        self.directories[str(path)] = Directory(Path(path), self.save_path, dir_ign_patterns, self.global_ign_patterns, self.logging_settings, self.update_callback, self.hash_pool)
+        for callback in self.subscribers: self.directories[str(path)].subscribe(callback)
         self.directories_list.add_directory(path, name, dir_ign_patterns)
+        if self.watcher is not None: self.watcher.watch(self.directories[str(path)])
         self.new_dir_callback(str(path))
         
         logger.info(f"Tracking directory {path}") 
@@ -336,8 +798,15 @@ class FileTracker:
             self.directories_list.update(directory.path, directory.dir_ign_patterns, directory.hash)
             directory.save()
     
+    def subscribe(self, callback):
+        """ *callback(dir_path, changed_rel_paths)* is called whenever a change in any tracked directory has been detected """
+        for directory in self.directories.values(): directory.subscribe(callback)
+        self.subscribers.append(callback)
+    
     def shut_down(self): 
+        if self.watcher is not None: self.watcher.stop()
         self.save()
+        if self.hash_pool is not None: self.hash_pool.shut_down()
         logger.info("FileTracker offline")
         
     def __contains__(self, path:os.PathLike) -> bool:
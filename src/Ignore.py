@@ -0,0 +1,60 @@
+import fnmatch
+import os
+import re
+from pathlib import PurePath
+
+
+MAGIC = re.compile(r"[*?[]") # patterns without these characters match names literally
+MAX_CACHE_SIZE = 16 * 1024 # decisions cached per directory (the cache starts over when it is full)
+
+
+
+class IgnoreMatcher:
+    """
+    Matches relative paths against ignore patterns the way PurePath.match does (patterns match from the right, e.g. "*.tmp", "build/*").
+    The patterns are compiled once: literal names are looked up in a set, the other single component patterns are combined into one regex
+    for the name and only patterns with several components are matched component by component. If there are such patterns, decisions are
+    cached by path (matching a name is as fast as a cache lookup)
+    """
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.names = set() # literal single component patterns
+        single = [] # regexes of the other single component patterns
+        self.multi = [] # patterns with several components: regex per component (last first)
+        for pattern in self.patterns:
+            pure = PurePath(pattern)
+            if pure.anchor or not pure.parts: continue # absolute patterns never match relative paths, empty patterns match nothing
+            parts = [os.path.normcase(part) for part in pure.parts]
+            if len(parts) > 1: self.multi.append([re.compile(fnmatch.translate(part)) for part in reversed(parts)])
+            elif MAGIC.search(parts[0]): single.append(fnmatch.translate(parts[0]))
+            else: self.names.add(parts[0])
+        self.regex = re.compile("|".join(single)) if single else None
+        self.cache = {} # relative path (tuple of names) -> ignored
+
+    def __reduce__(self): # the compiled patterns and the cache are not pickled with the graph
+        return (IgnoreMatcher, (self.patterns,))
+
+    def __bool__(self): return bool(self.names or self.regex or self.multi)
+
+    def match(self, parts) -> bool:
+        """ whether the relative path *parts* (tuple of names) is ignored """
+        if not self.multi: return self._match(parts)
+        ignored = self.cache.get(parts)
+        if ignored is None:
+            ignored = self._match(parts)
+            if len(self.cache) >= MAX_CACHE_SIZE: self.cache.clear()
+            self.cache[parts] = ignored
+        return ignored
+
+    def match_any(self, parts) -> bool:
+        """ whether the relative path *parts* or one of the folders containing it is ignored """
+        return any(self.match(parts[:i]) for i in range(1, len(parts) + 1))
+
+    def _match(self, parts) -> bool:
+        if not parts: return False
+        name = os.path.normcase(parts[-1])
+        if name in self.names or (self.regex is not None and self.regex.match(name)): return True
+        for regexes in self.multi:
+            if len(regexes) <= len(parts) and all(regex.match(os.path.normcase(part)) for regex, part in zip(regexes, reversed(parts))):
+                return True
+        return False
@@ -0,0 +1,71 @@
+import time
+from collections import OrderedDict, deque
+from threading import Condition
+
+
+MIN_BURST = 64 * 1024 # bytes that can always be taken at once (even if the rate is lower)
+
+
+
+class TokenBucket:
+    """
+    limits a rate in bytes per second (0 = unlimited). Up to *burst* bytes can be taken at once, larger amounts are taken in parts.
+    Users (peers) that have to wait take turns, so each gets an equal share of the rate no matter how many transfers it runs
+    """
+    def __init__(self, rate=0, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate // 4, MIN_BURST)
+        self.tokens = self.burst
+        self.time = time.monotonic()
+        self.waiting = OrderedDict() # user -> tickets of its takers that wait, the first user is next
+        self.waited = 0.0 # seconds takers have waited in total
+        self.cond = Condition()
+
+    def take(self, n, user=None):
+        """ blocks until *n* bytes may be transferred """
+        if not self.rate: return
+        while n > 0:
+            part = min(n, self.burst)
+            self._take(part, user)
+            n -= part
+
+    def _take(self, n, user):
+        with self.cond:
+            start, ticket = time.monotonic(), object()
+            tickets = self.waiting.setdefault(user, deque())
+            tickets.append(ticket)
+            while True:
+                self._refill()
+                if next(iter(self.waiting)) != user or tickets[0] is not ticket: self.cond.wait() # not our turn
+                elif self.tokens < n: self.cond.wait((n - self.tokens) / self.rate)
+                else: break
+            self.tokens -= n
+            tickets.popleft()
+            if tickets: self.waiting.move_to_end(user) # the other users go first
+            else: del self.waiting[user]
+            self.waited += time.monotonic() - start
+            self.cond.notify_all()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+
+    def stats(self) -> dict:
+        with self.cond: return {"rate": self.rate, "waiting": sum(map(len, self.waiting.values())), "waited": self.waited}
+
+
+
+class Limits:
+    """ rates (bytes per second, 0 = unlimited) shared by all connections, each rate is shared fairly among the peers (see TokenBucket) """
+    def __init__(self, upload=0, download=0, disk_read=0, disk_write=0):
+        self.upload = TokenBucket(upload)
+        self.download = TokenBucket(download)
+        self.disk_read = TokenBucket(disk_read) # files that are sent
+        self.disk_write = TokenBucket(disk_write) # files that are received
+
+    def stats(self) -> dict:
+        return {name: bucket.stats() for name, bucket in vars(self).items()}
+
+
+UNLIMITED = Limits()
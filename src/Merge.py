@@ -0,0 +1,205 @@
+from src.Config import get_logger
+from src.Codes import CONFLICT_TYPE
+from src.FileTracker import File, Folder
+from src.utils import to_micros
+
+logger_name, logger = get_logger(__name__)
+
+
+# Merges two directory graphs by flattening both into columns sorted by path and joining them, instead of walking them object by object.
+# Keys sort in pre-order: the files of a folder, then every subfolder followed by its contents. This is the order in which the decisions
+# are applied, so parents always exist before their contents are merged and the subtree of a folder can be skipped in one step.
+
+FILE, FOLDER, SEPARATOR = "\x01", "\x02", "\x00" # separator sorts before every character allowed in names
+
+
+
+class Entries:
+    """ flat columns of a graph in key order """
+    __slots__ = ("keys", "parts", "nodes", "is_dir", "exists", "hashes", "modified", "ends")
+
+    def __init__(self, folder:Folder, time:int):
+        self.keys = [] # sortable path keys
+        self.parts = [] # relative paths (tuple of names)
+        self.nodes = []
+        self.is_dir = []
+        self.exists = []
+        self.hashes = []
+        self.modified = [] # whether the entry has been modified since *time* (see DirectoryElement.is_modified)
+        self.ends = [] # folders: index after the last entry of its subtree
+        self._flatten(folder, "", (), time)
+
+    def __len__(self): return len(self.keys)
+
+    def _add(self, key, parts, node, is_dir):
+        self.keys.append(key)
+        self.parts.append(parts)
+        self.nodes.append(node)
+        self.is_dir.append(is_dir)
+        self.exists.append(node._deleted == 0)
+        self.hashes.append(node.hash)
+        self.modified.append(False)
+        self.ends.append(len(self.keys))
+
+    def _flatten(self, folder, prefix, parts, time) -> bool:
+        """ adds the contents of *folder*, returns whether any of them has been modified since *time* """
+        names = sorted(folder.files)
+        files = [folder.files[name] for name in names]
+        start = len(self.keys)
+        # the files of a folder are added column by column
+        self.keys.extend([prefix + FILE + name for name in names])
+        self.parts.extend([(*parts, name) for name in names])
+        self.nodes.extend(files)
+        self.is_dir.extend([False] * len(files))
+        self.exists.extend([file._deleted == 0 for file in files])
+        self.hashes.extend([file.hash for file in files])
+        self.modified.extend([file._deleted == 0 and max(file._modified, file._created) > time for file in files])
+        self.ends.extend(range(start + 1, start + len(files) + 1))
+        modified = any(self.modified[start:])
+        
+        for name in sorted(folder.folders):
+            sub_folder, i = folder.folders[name], len(self.keys)
+            self._add(prefix + FOLDER + name, (*parts, name), sub_folder, True)
+            sub_modified = self._flatten(sub_folder, self.keys[i] + SEPARATOR, self.parts[i], time)
+            self.modified[i] = sub_folder._created > time or sub_modified
+            self.ends[i] = len(self.keys)
+            modified = modified or self.modified[i]
+        return modified
+
+
+
+class MergeResult:
+    """ decisions taken by a merge (relative paths as tuples of names) """
+    def __init__(self):
+        self.added = [] # only on the remote side
+        self.updated = [] # replaced by the remote version
+        self.deleted = [] # deleted on the remote side
+        self.conflicts = [] # (path, CONFLICT_TYPE) passed to the conflict callback
+        self.moved = [] # (deleted path, added path) with the same contents -> the local file/folder can be renamed instead of downloaded
+
+    def __repr__(self):
+        return f"added: {len(self.added)}, updated: {len(self.updated)}, deleted: {len(self.deleted)}, moved: {len(self.moved)}, conflicts: {len(self.conflicts)}"
+
+
+
+def merge(local:Folder, remote:Folder, last_time_synced, conflict_callback) -> MergeResult:
+    """ merges *remote* into *local* with the same decisions and conflict callbacks as merging folder by folder (see Folder.merge) """
+    result, deleted, added = MergeResult(), [], []
+    _merge(local, remote, to_micros(last_time_synced), conflict_callback, result, (), deleted, added)
+    result.moved = moves(deleted, added)
+    logger.debug(f"Merged {remote.rel_path}: {result}")
+    return result
+
+
+def _merge(local, remote, time, conflict_callback, result, base, deleted, added):
+    """ *deleted*: (path, is folder, contents) of deleted entries, *added*: (path, remote node) of added entries (see moves) """
+    L, R = Entries(local, time), Entries(remote, time)
+    folders = {(): local} # relative path (from *local*) -> folder of the merged graph
+    local_parts, ignore = tuple(local._parts()), local.ctx.ignore
+    
+    def conflict(parent, parts, remote_obj, conflict_type):
+        result.conflicts.append(((*base, *parts), conflict_type))
+        conflict_callback(parent, remote.get_folder(parts[:-1]), parts[-1], remote_obj, isinstance(remote_obj, Folder), conflict_type)
+    
+    i = j = 0
+    n_local, n_remote = len(L), len(R)
+    while j < n_remote:
+        key, parts = R.keys[j], R.parts[j]
+        while i < n_local and L.keys[i] < key: i += 1 # entries that only exist locally stay as they are
+        k = i if i < n_local and L.keys[i] == key else None # matching local entry
+        parent, name, path = folders[parts[:-1]], parts[-1], (*base, *parts)
+        
+        if not R.is_dir[j]:
+            if R.exists[j]: changed = k is None or (L.hashes[k] != R.hashes[j] and R.modified[j])
+            else: changed = k is not None
+            # the ignore patterns are only checked for files that would change (most files are the same on both sides)
+            if changed and not (ignore and ignore.match((*local_parts, *parts))):
+                # update_on_creation is False since the files must be downloaded first
+                if not R.exists[j]:
+                    if L.modified[k]: conflict(parent, parts, File(name, parent, update_on_creation=False), CONFLICT_TYPE.DELETE_CONFLICT)
+                    else:
+                        deleted.append((path, False, [((), L.hashes[k])]))
+                        parent.files[name].deleted()
+                        result.deleted.append(path)
+                elif k is None:
+                    parent.files[name] = File(name, parent, update_on_creation=False)
+                    result.added.append(path)
+                    added.append((path, R.nodes[j]))
+                elif L.modified[k]: conflict(parent, parts, File(name, parent, update_on_creation=False), CONFLICT_TYPE.MODIF_CONFLICT)
+                elif not L.exists[k]: conflict(parent, parts, File(name, parent, update_on_creation=False), CONFLICT_TYPE.DELETE_CONFLICT)
+                else:
+                    parent.files[name] = File(name, parent, update_on_creation=False)
+                    result.updated.append(path)
+            j += 1
+            continue
+        
+        if ignore and ignore.match((*local_parts, *parts)): # ignored folders are skipped with their contents
+            j = R.ends[j]
+            continue
+        
+        if not R.exists[j]: # deleted on the remote side -> its contents are not merged
+            if k is not None:
+                if L.modified[k]: conflict(parent, parts, Folder(name, parent, update_on_creation=False), CONFLICT_TYPE.DELETE_CONFLICT)
+                else:
+                    deleted.append((path, True, contents(L.nodes[k]))) # before its contents are marked as deleted
+                    parent.folders[name].deleted()
+                    result.deleted.append(path)
+            j = R.ends[j]
+            continue
+        
+        if k is None:
+            parent.folders[name] = Folder(name, parent, update_on_creation=False)
+            result.added.append(path)
+            added.append((path, R.nodes[j]))
+        elif not L.exists[k]:
+            conflict(parent, parts, Folder(name, parent, update_on_creation=False), CONFLICT_TYPE.DELETE_CONFLICT)
+            if parent.folders[name] is not L.nodes[k]: # replaced by the callback -> the local entries of its subtree don't apply anymore
+                _merge(parent.folders[name], R.nodes[j], time, conflict_callback, result, path, deleted, added)
+                j = R.ends[j]
+                continue
+        folders[parts] = parent.folders[name]
+        j += 1
+
+
+
+def contents(folder:Folder, parts=()) -> list:
+    """ (relative path, hash) of the existing files in *folder* and its subfolders """
+    files = [((*parts, name), file.hash) for name, file in folder.files.items() if file.exists]
+    for name, sub_folder in folder.folders.items():
+        if sub_folder.exists: files.extend(contents(sub_folder, (*parts, name)))
+    return files
+
+
+def moves(deleted, added) -> list:
+    """ 
+    pairs deleted local entries with added remote entries that have the same contents: whole folders first (same files with the same hashes,
+    the folders of deleted folders included), then single files by hash (the files of deleted folders that have not been moved as a whole)
+    """
+    moved, moved_folders, gone = [], set(), set() # added folders that are moved as a whole, deleted folders they are moved from
+    def inside(path, folders): return any(path[:i] in folders for i in range(1, len(path) + 1))
+    
+    added_folders = [(path, node) for path, node in added if isinstance(node, Folder)]
+    if added_folders and any(is_dir for _, is_dir, _ in deleted):
+        sources = {} # contents -> deleted folders
+        for path, is_dir, files in deleted:
+            if not is_dir: continue
+            folders = {} # relative path of the folder and its subfolders -> their contents
+            for parts, hash in files:
+                for i in range(len(parts)): folders.setdefault(parts[:i], []).append((parts[i:], hash))
+            for parts, files in folders.items(): sources.setdefault(tuple(sorted(files)), []).append((*path, *parts))
+        for path, node in added_folders: # parents before their subfolders
+            if inside(path, moved_folders) or not (files := tuple(sorted(contents(node)))): continue
+            candidates = [source for source in sources.get(files, ()) if not inside(source, gone) and not any(folder[:len(source)] == source for folder in gone)]
+            if candidates:
+                moved.append((candidates[0], path))
+                moved_folders.add(path)
+                gone.add(candidates[0])
+    
+    sources = {} # hash -> deleted files
+    for path, _, files in deleted:
+        for parts, hash in files:
+            if hash and not inside(file := (*path, *parts), gone): sources.setdefault(hash, []).append(file)
+    for path, node in added:
+        if isinstance(node, File) and sources.get(node.hash) and not inside(path, moved_folders):
+            moved.append((sources[node.hash].pop(), path))
+    return moved
@@ -2,21 +2,54 @@ import socket
 import datetime
 import pickle
 import io
+import os
+import struct
+from contextlib import contextmanager
 from math import ceil, log2
 from enum import IntEnum
 
 from src.Config import get_logger, DATE_TIME_FORMAT, DEFAULT_TIME
 import src.utils as utils
+from src.Compression import CHUNK_SIZE, MIN_COMPRESS_SIZE, SAMPLE_SIZE, CompressionStats, worth_compressing
+from src.Limits import UNLIMITED
+from src.Staging import StreamHash
 
 
 HEADER_SIZE = 8
-MAX_RECV_SIZE = 4096
+RECV_BUFFER_SIZE = 64 * 1024 # size of the reusable buffer messages are received into
+FILE_BUFFER_SIZE = 256 * 1024 # size of the reusable buffer files are received into
+MIN_SENDMSG_SIZE = 16 * 1024 # smaller frames are joined and sent with sendall
 CODE_SIZE = 1  # one byte
 ENCODING = "utf-8"
+FRAME_HEADER = struct.Struct(">BQ") # message type + payload length (CODE_SIZE + HEADER_SIZE bytes)
+END_MSG = bytes(CODE_SIZE) # NT_Code.END_MSG, ends every frame
+END_CHANGED_FILE = (1).to_bytes(CODE_SIZE, byteorder="big") # NT_Code.END_CHANGED_FILE
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg") # not on Windows
+
+COMPRESSED_FLAG = 0x10 # set in the message type if the payload is compressed with the codec negotiated for the connection
+CHUNK_HEADER = struct.Struct(">I") # length of a chunk of a compressed file
+
+# capabilities exchanged during the handshake
+CAP_LANES = "lanes" # max number of extra transfer connections
+CAP_COMPRESSION = "compression" # greeting: codecs the server supports, introduction: codec the client chose
+CAP_CHUNKS = "chunks" # whether files can be sent as chunks (see src/Chunks.py)
+CAP_STREAMS = "streams" # whether requests are sent on streams of the main connection (see src/Streams.py)
+CAP_RANGES = "ranges" # whether parts of files can be requested (see src/Swarm.py)
 
 
 logger_name, logger = get_logger(__name__)
 
+
+class ProtocolError(ConnectionError):
+    """ the peer sent something else than expected, the connection can't be used anymore """
+    
+
+
+class FileChangedError(Exception):
+    """ the file being received changed while the peer sent it, what has been received is not the file """
+    
+    
+
 class NT_Enum(IntEnum):
     def __str__(self):
         return self.name
@@ -26,14 +59,22 @@ class NT_Enum(IntEnum):
 
 class NT_Code(NT_Enum): # (NT = Network)
     END_MSG = 0
+    END_CHANGED_FILE = 1 # ends a file frame instead of END_MSG if the file changed while it was sent (the payload is not the file)
     END_CONN = 10
     REQ_DIR_LST = 110
     REQ_DIR_ATTR = 120
     REQ_DIR_GRAPH = 130
+    REQ_DIR_TREE = 131
+    REQ_DIR_CHANGES = 132
     REQ_FILE = 140
+    REQ_FILES = 141
+    REQ_FILE_DELTA = 145
+    REQ_FILE_CHUNKS = 146
+    REQ_FILE_RANGE = 147
     REQ_SYNC = 150
     REQ_SYNC_START = 160
     END_SYNC = 170
+    REQ_LANE = 180
     
 class NT_MSG_TYPE(NT_Enum):
     UNDEF = 0xFF
@@ -45,13 +86,33 @@ class NT_MSG_TYPE(NT_Enum):
     
     
     
+def part_path(store_path):
+    """ temporary file files are received into before they replace *store_path* """
+    head, tail = os.path.split(store_path)
+    return os.path.join(head, f".{tail}.part") # hidden files are ignored by default
+
+
+
 # TODO: add timeout to receive.
 
 class Socket:
+    """ 
+    Framing: type (1 byte) + payload length (HEADER_SIZE bytes) + payload + END_MSG. Data is received into a reusable buffer with as few 
+    recv calls as possible (a header and small payloads usually arrive with the same call, several messages too). Payloads that don't fit 
+    into the buffer are received directly into their own bytearray. Frames are sent without concatenating header and payload (sendmsg) 
+    """
     def __init__(self, sock=None):
         if sock is None:  self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         else: self.socket = sock
-        self._recv_msg_type = False
+        self._buffer = None # receive buffer, allocated on first receive
+        self._start = self._end = 0 # received data that has not been read yet: self._buffer[self._start:self._end]
+        self._batch = None # frames to send at once (see batch)
+        self._file_buffer = None # allocated on first recv_file
+        self._compressed = False # whether the message being received is compressed
+        self.codec = None # compression codec (negotiated during handshake)
+        self.compression_stats = CompressionStats() # shared by all connections to the same peer
+        self.limits = UNLIMITED # transfer rates shared by all connections (see src/Limits.py)
+        self.peer = None # uuid of the peer, the limits are shared fairly among the peers
         
     def bind(self, ip, port): self.socket.bind((ip, port))    
     def listen(self): self.socket.listen()
@@ -59,11 +120,56 @@ class Socket:
     def connect(self, host, port): self.socket.connect((host, port)) 
     def close(self): self.socket.close()
     
-    def _send(self, type, bytes): 
-        self.socket.sendall(type.bytes() + 
-                            len(bytes).to_bytes(HEADER_SIZE, byteorder="big") + 
-                            bytes + 
-                            NT_Code.END_MSG.bytes())
+    def pending(self) -> bool: 
+        """ whether data has been received that has not been read yet (the socket itself does not become readable for it) """
+        return self._end > self._start
+    
+    def inherit(self, conn):
+        """ uses the compression and limits of *conn* (another connection to the same peer) """
+        self.codec, self.compression_stats = conn.codec, conn.compression_stats
+        self.limits, self.peer = conn.limits, conn.peer
+        
+    def take_pending(self) -> bytes:
+        """ hands the data that has been received but not read yet over (e.g. to a Multiplexer that takes over the connection) """
+        data = bytes(self._buffer[self._start:self._end]) if self.pending() else b""
+        self._start = self._end = 0
+        return data
+    
+    
+    # sending
+    def _send(self, type, bytes, compress=False): 
+        if compress and self.codec is not None and len(bytes) >= MIN_COMPRESS_SIZE:
+            compressed = self.codec.compress(bytes)
+            self.compression_stats.add(len(bytes), min(len(bytes), len(compressed)))
+            if len(compressed) < len(bytes): bytes, type = compressed, type | COMPRESSED_FLAG
+        self._send_buffers(FRAME_HEADER.pack(type, len(bytes)), bytes, END_MSG)
+        
+    def _send_buffers(self, *buffers):
+        """ sends *buffers* in order. Small frames are joined (one copy is cheaper than building a sendmsg call), large ones are sent as they are """
+        if self._batch is not None: 
+            self._batch.extend(buffers)
+            return
+        self.limits.upload.take(sum(map(len, buffers)), self.peer)
+        if not HAS_SENDMSG or sum(map(len, buffers)) <= MIN_SENDMSG_SIZE: 
+            self.socket.sendall(b"".join(buffers))
+            return
+        views = [memoryview(buffer).cast("B") for buffer in buffers if len(buffer)]
+        while views:
+            sent = self.socket.sendmsg(views)
+            while views and sent >= len(views[0]): sent -= len(views.pop(0))
+            if sent: views[0] = views[0][sent:]
+            
+    @contextmanager
+    def batch(self):
+        """ the messages sent within the with block are sent together once it ends (e.g. a request code and its arguments) """
+        if self._batch is not None: # nested
+            yield
+            return
+        self._batch = []
+        try: yield
+        finally:
+            buffers, self._batch = self._batch, None
+        self._send_buffers(*buffers)
         
     def send_code(self, code):
         self._send(NT_MSG_TYPE.CODE, code.bytes())
@@ -76,11 +182,56 @@ class Socket:
         
     def send_obj(self, obj, pickle_obj=True):
         if pickle_obj: obj = pickle.dumps(obj)
-        self._send(NT_MSG_TYPE.OBJ, obj)
+        self._send(NT_MSG_TYPE.OBJ, obj, compress=True)
 
     def send_file(self, path):
+        """ streams the file at *path* (zero copy via sendfile where the os supports it) """
         with open(path, "rb") as file:
-            self._send(NT_MSG_TYPE.FILE, file.read())
+            self.send_opened_file(file)
+            
+    def send_opened_file(self, file, offset=0, size=None):
+        """ sends *size* bytes of the file from *offset* on (the rest of the file by default, no more than the file has) """
+        available = max(0, os.fstat(file.fileno()).st_size - offset)
+        size = available if size is None else min(size, available)
+        if self.codec is not None and size >= MIN_COMPRESS_SIZE:
+            file.seek(offset)
+            sample = file.read(SAMPLE_SIZE)
+            file.seek(offset)
+            if worth_compressing(self.codec, file.name, sample): return self._send_compressed_file(file, size)
+        self.socket.sendall(FRAME_HEADER.pack(NT_MSG_TYPE.FILE, size))
+        if self.limits.upload.rate or self.limits.disk_read.rate: sent = self._send_file_limited(file, offset, size)
+        else: sent = self.socket.sendfile(file, offset, size) if size else 0
+        if sent < size: # file has been truncated while sending -> pad so the receiver does not lose track of the message boundaries
+            self.socket.sendall(bytes(size - sent))
+        self.socket.sendall(END_MSG if sent == size else END_CHANGED_FILE)
+        
+    def _send_file_limited(self, file, offset, size):
+        """ sends the file in parts as fast as the limits allow, returns the number of bytes sent """
+        sent = 0
+        while sent < size:
+            n = min(FILE_BUFFER_SIZE, size - sent)
+            self.limits.disk_read.take(n, self.peer)
+            self.limits.upload.take(n, self.peer)
+            if not (k := self.socket.sendfile(file, offset + sent, n)): break
+            sent += k
+        return sent
+        
+    def _send_compressed_file(self, file, size):
+        """ streams *size* bytes of the file (from its position on) as compressed chunks (chunk length + data), the end is marked by an empty chunk """
+        self.socket.sendall(FRAME_HEADER.pack(NT_MSG_TYPE.FILE | COMPRESSED_FLAG, size))
+        compressor, raw, sent = self.codec.compressor(), 0, 0
+        def send_chunk(chunk):
+            nonlocal sent
+            if chunk: 
+                self._send_buffers(CHUNK_HEADER.pack(len(chunk)), chunk)
+                sent += len(chunk)
+        while raw < size and (chunk := file.read(min(CHUNK_SIZE, size - raw))):
+            self.limits.disk_read.take(len(chunk), self.peer)
+            send_chunk(compressor.compress(chunk))
+            raw += len(chunk)
+        send_chunk(compressor.flush())
+        self.socket.sendall(CHUNK_HEADER.pack(0) + (END_MSG if raw == size else END_CHANGED_FILE))
+        self.compression_stats.add(raw, sent)
     
     def send(self, msg):
         assert(not isinstance(msg, io.IOBase))
@@ -90,28 +241,70 @@ class Socket:
         else: self.send_obj(msg)
         
     def send_multi(self, *msgs):
-        for msg in msgs: 
-            self.send(msg)
-        self.send_code(NT_Code.END_MSG)
-        
+        with self.batch():
+            for msg in msgs: 
+                self.send(msg)
+            self.send_code(NT_Code.END_MSG)
+    
+    
+    # receiving
+    def _fill(self, n):
+        """ makes sure at least *n* (<= RECV_BUFFER_SIZE) bytes have been received """
+        if self._buffer is None: self._buffer = memoryview(bytearray(RECV_BUFFER_SIZE))
+        if self._end - self._start >= n: return
+        if self._start + n > RECV_BUFFER_SIZE: # move the unread data to the front
+            self._buffer[:self._end - self._start] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, self._end - self._start
+        while self._end - self._start < n:
+            k = self.socket.recv_into(self._buffer[self._end:])
+            if k == 0: raise ConnectionResetError("Connection closed while receiving")
+            self.limits.download.take(k, self.peer)
+            self._end += k
+            
+    def _read(self, n):
+        """ the next *n* bytes. Slices of the buffer are only valid until the next read """
+        if n <= RECV_BUFFER_SIZE:
+            self._fill(n)
+            self._start += n
+            return self._buffer[self._start - n:self._start]
+        data = bytearray(n) # too large for the buffer -> received directly into its own bytearray
+        buffered = self._end - self._start
+        data[:buffered] = self._buffer[self._start:self._end]
+        self._start = self._end = 0
+        self._recv_exact_into(memoryview(data)[buffered:])
+        return data
+    
+    def _recv_exact_into(self, view):
+        received = 0
+        while received < len(view):
+            k = self.socket.recv_into(view[received:])
+            if k == 0: raise ConnectionResetError("Connection closed while receiving")
+            self.limits.download.take(k, self.peer)
+            received += k
+    
     def _recv_header(self, expected_type):
-        if self._recv_msg_type is True: msg_type = NT_MSG_TYPE(int.from_bytes(self.socket.recv(CODE_SIZE), "big"))
-        else:  msg_type = NT_MSG_TYPE.UNDEF
-        assert(expected_type & msg_type, f"Wrong message type! Expected {expected_type}, got {msg_type}")
-        msg_len = int.from_bytes(self.socket.recv(HEADER_SIZE), "big")
+        msg_type, msg_len = FRAME_HEADER.unpack(self._read(FRAME_HEADER.size))
+        self._compressed = bool(msg_type & COMPRESSED_FLAG)
+        msg_type = NT_MSG_TYPE(msg_type & ~COMPRESSED_FLAG)
+        if not expected_type & msg_type: raise ProtocolError(f"Wrong message type! Expected {expected_type}, got {msg_type}")
         return msg_len
 
-    def _recv_data(self, msglen, file=None): # data should be written to file if specified
-        #? maybe use select module
-        data = []
-        bytes_received = 0
-        while bytes_received < msglen:
-            receive_size = MAX_RECV_SIZE if msglen - bytes_received > MAX_RECV_SIZE else msglen - bytes_received
-            data.append(self.socket.recv(receive_size))
-            bytes_received += len(data[-1])
-            if file is not None: file.write(data[-1])
-        assert(int.from_bytes(self.socket.recv(CODE_SIZE), "big") == NT_Code.END_MSG)
-        return b''.join(data)
+    def _recv_data(self, msglen):
+        data = self._read(msglen)
+        if self._compressed:
+            data = self.codec.decompress(data)
+            self.compression_stats.add(len(data), msglen)
+        else: data = bytes(data) # the buffer is reused
+        self._recv_end()
+        return data
+    
+    def _recv_end(self):
+        if self._read(CODE_SIZE)[0] != NT_Code.END_MSG: raise ProtocolError("Message is not terminated")
+        
+    def _recv_file_end(self):
+        code = self._read(CODE_SIZE)[0]
+        if code == NT_Code.END_CHANGED_FILE: raise FileChangedError("File changed while it was sent")
+        if code != NT_Code.END_MSG: raise ProtocolError("File is not terminated")
     
     def recv_code(self):
         msg_len = self._recv_header(NT_MSG_TYPE.CODE)
@@ -129,21 +322,84 @@ class Socket:
         msg_len = self._recv_header(NT_MSG_TYPE.OBJ)
         return pickle.loads(self._recv_data(msg_len)) if unpickle else self._recv_data(msg_len)
         
-    def recv_file(self, store_path):
+    def recv_file(self, store_path, fsync=False):
+        """ 
+        receives a file into a temporary file next to *store_path* which replaces *store_path* once it is complete (and flushed to disk
+        if *fsync*). Returns the imohash of the file (computed while receiving it) or None if it did not have the announced size.
+        Raises FileChangedError (and keeps the old file) if the file changed while it was sent
+        """
+        msg_len = self._recv_header(NT_MSG_TYPE.FILE)
+        temp_path = part_path(store_path)
+        hash = StreamHash(msg_len)
+        try:
+            with open(temp_path, "wb") as file:
+                self._recv_file_data(msg_len, file, hash)
+                if fsync:
+                    file.flush()
+                    os.fsync(file.fileno())
+            os.replace(temp_path, store_path)
+        except BaseException:
+            if os.path.exists(temp_path): os.remove(temp_path)
+            raise
+        return hash.digest()
+            
+    def recv_opened_file(self, file) -> int:
+        """ 
+        receives a file (or part of one, see send_opened_file) and writes it to *file* from its position on, returns its size. 
+        Raises FileChangedError if the file changed while it was sent
+        """
         msg_len = self._recv_header(NT_MSG_TYPE.FILE)
-        with open(store_path, "wb") as file:
-            self._recv_data(msg_len, file)
+        self._recv_file_data(msg_len, file)
+        return msg_len
+        
+    def _recv_file_data(self, msg_len, file, hash=None):
+        if self._compressed: self._recv_compressed_into_file(file, hash)
+        else: self._recv_into_file(msg_len, file, hash)
+        
+    def _recv_into_file(self, msglen, file, hash=None):
+        """ 
+        receives *msglen* bytes into a reusable buffer and writes them to *file* (and *hash*, a StreamHash), memory usage does not 
+        depend on the file size 
+        """
+        buffered = min(msglen, self._end - self._start) # part of the file that has been received with the header
+        self.limits.disk_write.take(buffered, self.peer)
+        if buffered: 
+            data = self._read(buffered)
+            file.write(data)
+            if hash is not None: hash.update(data)
+        if self._file_buffer is None: self._file_buffer = memoryview(bytearray(FILE_BUFFER_SIZE))
+        bytes_received = buffered
+        while bytes_received < msglen:
+            n = self.socket.recv_into(self._file_buffer, min(FILE_BUFFER_SIZE, msglen - bytes_received))
+            if n == 0: raise ConnectionResetError("Connection closed while receiving file")
+            self.limits.download.take(n, self.peer)
+            self.limits.disk_write.take(n, self.peer)
+            file.write(self._file_buffer[:n])
+            if hash is not None: hash.update(self._file_buffer[:n])
+            bytes_received += n
+        self._recv_file_end()
+    
+    def _recv_compressed_into_file(self, file, hash=None):
+        decompressor, raw, received = self.codec.decompressor(), 0, 0
+        while n := CHUNK_HEADER.unpack(self._read(CHUNK_HEADER.size))[0]:
+            data = decompressor.decompress(self._read(n))
+            self.limits.disk_write.take(len(data), self.peer)
+            file.write(data)
+            if hash is not None: hash.update(data)
+            raw += len(data)
+            received += n
+        self.compression_stats.add(raw, received)
+        self._recv_file_end()
     
     def recv(self):
-        self._recv_msg_type = False
-        msg_type = int.from_bytes(self.socket.recv(CODE_SIZE), byteorder="big")
+        self._fill(CODE_SIZE) # peek at the type of the message
+        msg_type = self._buffer[self._start] & ~COMPRESSED_FLAG
         data = {
                 NT_MSG_TYPE.CODE : self.recv_code,
                 NT_MSG_TYPE.INT : self.recv_int,
                 NT_MSG_TYPE.STR : self.recv_str,
                 NT_MSG_TYPE.OBJ : self.recv_obj
             }[msg_type]()
-        self._recv_msg_type = True
         return data
         
     def recv_multi(self):
@@ -153,5 +409,3 @@ class Socket:
            if data == NT_Code.END_MSG: break
            else: ret.append(data)
         return ret
-
-    
\ No newline at end of file
@@ -0,0 +1,69 @@
+import time
+from threading import Lock
+
+from src.Config import CONN_SYNCS_KEY, SYNC_AUTO_KEY, SYNC_BIDIR_KEY, SYNC_CONFLICT_POLICY_KEY, SYNC_RESOLVE_POLICY_KEY, get_logger
+from src.utils import RepeatedJob
+
+logger_name, logger = get_logger(__name__)
+
+
+TICK = 1 # seconds between two checks for syncs that are due
+
+
+
+class Scheduler:
+    """
+    queues the automatic syncs of all connected peers (the auto_sync value of a sync: < 0 off, 0 after local changes, > 0 also every that
+    many seconds). Changes are collected until the directory has been quiet for *change_delay* seconds. Changes made during a sync are
+    kept since they can't be told apart from the sync's own (at worst this queues one more sync that finds nothing to do). The queued syncs
+    share the sync slots and limits of the server (see SyncQueue and src/Limits.py), so no peer can take all of them
+    """
+    def __init__(self, server, connections, change_delay=2):
+        self.server = server
+        self.connections = connections
+        self.change_delay = change_delay
+        self.changed = {} # local dir -> time of the last change that has not been synced yet
+        self.last_sync = {} # (uuid, local dir, remote dir) -> time the sync was last queued
+        self.exclude = set() # uuids that are not synced automatically
+        self.lock = Lock()
+        self.job = None
+
+    def start(self, exclude=()):
+        self.exclude = set(exclude)
+        self.job = RepeatedJob(TICK, target=self._tick, name="auto_sync_thread")
+        self.job.start()
+
+    def stop(self):
+        if self.job is not None: self.job.stop()
+        self.job = None
+
+    def directory_changed(self, directory, rel_paths):
+        """ change stream of the FileTracker """
+        with self.lock: self.changed[directory] = time.monotonic()
+
+    def _tick(self):
+        now = time.monotonic()
+        with self.lock: due = {directory for directory, changed in self.changed.items() if now - changed >= self.change_delay}
+        for uuid, client in list(self.server.clients.items()):
+            if uuid in self.exclude or not client.connected or uuid not in self.connections: continue
+            for local_dir, remotes in list(self.connections[uuid][CONN_SYNCS_KEY].items()):
+                for remote_dir, sync in list(remotes.items()):
+                    auto, key = sync[SYNC_AUTO_KEY], (uuid, local_dir, remote_dir)
+                    if auto < 0: continue
+                    if local_dir not in due and not (auto > 0 and now - self.last_sync.get(key, -auto) >= auto): continue
+                    self.last_sync[key] = now
+                    logger.debug(f"Auto sync of '{local_dir}' with '{remote_dir}' of {uuid}")
+                    client.queue_sync(local_dir, remote_dir, sync[SYNC_CONFLICT_POLICY_KEY], sync[SYNC_RESOLVE_POLICY_KEY], sync[SYNC_BIDIR_KEY])
+        with self.lock:
+            for directory in due:
+                if self.changed.get(directory, now) <= now - self.change_delay: del self.changed[directory] # not changed again since
+
+    def stats(self) -> dict:
+        """ queue depth and wait times of the syncs of every peer, free sync slots and the state of the limits """
+        return {
+            "peers": {uuid: client.sync_queue.stats() for uuid, client in list(self.server.clients.items())},
+            "free_slots": self.server.sync_slots.free,
+            "changed": len(self.changed),
+            "limits": self.server.limits.stats(),
+            "throughput": self.server.swarm.stats() # bytes per second the peers sent during the last swarm downloads
+        }
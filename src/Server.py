@@ -1,13 +1,22 @@
 import os
-import select
+import pickle
+import selectors
 import socket
-import threading
+from concurrent.futures import ThreadPoolExecutor
 from threading import Lock
 
-from src.Client import Client, Conflicts
+from src.Client import Client, Conflicts, SyncSlots
 from src.Config import CONN_HOSTNAME_KEY, CONN_PORT_KEY, DATE_TIME_FORMAT, get_logger, temp_uuid
 from src.Codes import SYNC_STATUS
-from src.Network import NT_Code, Socket
+from src.Chunks import MAX_BATCH_SIZE, offsets
+from src.Delta import batches, delta
+from src.FileTracker import Folder
+from src.Limits import UNLIMITED
+from src.Compression import CODECS, CompressionStats
+from src.Network import CAP_CHUNKS, CAP_COMPRESSION, CAP_LANES, CAP_RANGES, CAP_STREAMS, NT_Code, Socket
+from src.Staging import DURABILITY_SYNC, Staging
+from src.Streams import Multiplexer
+from src.Swarm import Swarm
 
 logger_name, logger = get_logger(__name__)
 
@@ -24,13 +33,22 @@ class Callbacks:
         
 
 class Server():
-    def __init__(self, hostname, ip, port, uuid, file_tracker, sessions, connections, log_settings, callbacks, data_path):
+    def __init__(self, hostname, ip, port, uuid, file_tracker, sessions, connections, log_settings, callbacks, data_path, download_window=256, lanes=0, compression=(), \
+            chunk_store=None, workers=16, sync_workers=4, max_syncs=8, limits=UNLIMITED, durability=DURABILITY_SYNC):
         self.file_tracker = file_tracker
         self.sessions = sessions    
         self.connections = connections # connection data
         self.logging_settings = log_settings
         self.callbacks = callbacks
         self.data_path = data_path
+        self.download_window = download_window
+        self.lanes = lanes
+        self.compression = compression # codecs offered to clients
+        self.compression_stats = {} # uuid -> CompressionStats (of the connections the clients opened)
+        self.chunk_store = chunk_store # index of the chunks of local files (None = files are not sent as chunks)
+        self.sync_workers = sync_workers # max number of syncs with a peer running at the same time
+        self.sync_slots = SyncSlots(max_syncs) # syncs running at the same time with all peers
+        self.limits = limits # bandwidth and disk rates shared by all connections (see src/Limits.py)
         
         self.hostname = hostname
         self.ip = ip
@@ -39,58 +57,132 @@ class Server():
         
         self.connections_in_progress = set()
         self.clients = {}
-        self.client_threads = {}
-        self.active_syncs = {}
+        self.client_conns = {} # uuid -> main connection the peer opened (Multiplexer if its requests are sent on streams)
+        self.lane_conns = {} # uuid -> extra transfer connections the peer opened
+        self.active_syncs = {} # uuid -> local directories the peer is syncing with
+        self.swarm = Swarm(self.clients, self.connections) # downloads from all peers that have a copy of the directory being synced
+        self.staging = Staging(self.file_tracker, durability) # received files of all syncs (see src/Staging.py)
         self.directory_locks = {directory:Lock() for directory in self.file_tracker.keys()} 
         
         self.will_shut_down = False
         self.socket = Socket()
         self.socket.bind(self.ip, self.port)
         
+        # requests are handled by a pool of workers instead of a thread per connection (see start_server)
+        self.selector = selectors.DefaultSelector()
+        self.workers = ThreadPoolExecutor(workers, thread_name_prefix="server")
+        self._wakeup = socket.socketpair() # wakes the server loop up to watch connections again/shut down
+        self._ready = [] # (serve, uuid, conn) of connections whose request has been handled
+        self._lock = Lock()
+        
+        self.handlers = { # requests of the main connection
+            NT_Code.REQ_DIR_LST     : self._fetch_dir_list,
+            NT_Code.REQ_DIR_GRAPH   : self._fetch_dir_graph,
+            NT_Code.REQ_DIR_TREE    : self._fetch_dir_tree,
+            NT_Code.REQ_DIR_CHANGES : self._fetch_dir_changes,
+            NT_Code.REQ_FILE        : self._fetch_file,
+            NT_Code.REQ_FILES       : self._fetch_files,
+            NT_Code.REQ_FILE_DELTA  : self._fetch_file_delta,
+            NT_Code.REQ_FILE_CHUNKS : self._fetch_file_chunks,
+            NT_Code.REQ_FILE_RANGE  : self._fetch_file_range,
+            NT_Code.REQ_SYNC_START  : self._start_sync,
+            NT_Code.REQ_SYNC        : self._sync_back,
+            NT_Code.END_SYNC        : self._end_sync,
+            NT_Code.END_CONN        : self._close_connection
+        }
+        
         
     def start_server(self):
-        """Start server loop for accepting connections"""
+        """ 
+        Server loop: a single thread waits for new connections and for requests on all open connections (selector). Whenever a connection 
+        is readable, it is handed to a worker of the pool which handles one request and then gives it back (see _serve). Multiplexed
+        connections stay with the loop, it hands their frames to the streams and every new stream to a worker (see _feed)
+        """
         self.will_shut_down = False
         self.socket.listen()
+        self.selector.register(self.socket.socket, selectors.EVENT_READ)
+        self.selector.register(self._wakeup[0], selectors.EVENT_READ)
         logger.info(f"Server online on port {self.port}")
         
         while not self.will_shut_down:
-            try:
-                # accept incoming connection
-                conn = Socket(self.socket.accept()[0]) 
-                try:             
-                    conn.send_multi(self.uuid, self.file_tracker.dir_info()) 
-                    uuid, hostname, port = conn.recv_multi() # recv introduction
-                    logger.info(f"Server accepted connection from {uuid}")
-                except socket.error as e: # TODO should disconnect client
-                    logger.info(f"Failed bilateral connection to {uuid} @ ({hostname}, {port}): {e}")
-                    uuid = False
-                    
-                if uuid: # connection successfully accepted
-                    if uuid not in self.clients: # if this server not connected to uuid
-                        
-                        # if uuid is not known update or create new entry
-                        if uuid not in self.connections:
-                            if temp_uuid(hostname, port) not in self.connections: # connection has also not been entered by the user 
-                                self.connections.new_connection(hostname, port, uuid=uuid) 
-                            else: # connection is only known by temporary uuid
-                                self.connections.update(temp_uuid(hostname, port), new_uuid=uuid)
-                                
-                        self.connections.update(uuid, new_hostname=hostname, new_port=port)
-                        
-                        # establish bilateral connection: connect back to uuid
-                        if not self._connect(uuid, hostname, port):
-                            pass # bilateral connection was not successful -> TODO: disconnect or smth
-                        
-                    if uuid not in self.client_threads or not self.client_threads[uuid].is_alive():
-                        self.client_threads[uuid] = threading.Thread(target=self.handle_client, args=(uuid,conn), name=str(uuid))
-                        self.client_threads[uuid].start()
-                        logger.info(f"Start thread {uuid}")
+            for key, _ in self.selector.select():
+                if self.will_shut_down: break # the workers are shut down
+                if key.fileobj is self.socket.socket: # incoming connection
+                    try: conn = Socket(self.socket.accept()[0])
+                    except OSError: continue
+                    self.workers.submit(self._accept, conn)
+                elif key.fileobj is self._wakeup[0]: self._wakeup[0].recv(4096)
+                elif isinstance(key.data[2], Multiplexer): # receiving does not block, the socket is readable
+                    serve, uuid, mux = key.data
+                    if not serve(uuid, mux):
+                        self.selector.unregister(key.fileobj)
+                        if not self.will_shut_down: self.workers.submit(self._drop, uuid, mux) # closed by shut_down otherwise
+                else: # request on a connection, the connection is not watched until the request has been handled
+                    self.selector.unregister(key.fileobj)
+                    self.workers.submit(self._serve, *key.data)
+            with self._lock:
+                ready, self._ready = self._ready, []
+            for serve, uuid, conn in ready:
+                if conn.socket.fileno() != -1: self.selector.register(conn.socket, selectors.EVENT_READ, (serve, uuid, conn))
+        self.selector.close()
+        logger.info("Server offline")
+        
+    def _accept(self, conn):
+        """ handshake of a new connection (on a worker) """
+        try:             
+            conn.send_multi(self.uuid, self.file_tracker.dir_info(), {CAP_LANES: self.lanes, CAP_COMPRESSION: list(self.compression), \
+                CAP_CHUNKS: self.chunk_store is not None, CAP_STREAMS: True, CAP_RANGES: True}) 
+            introduction = conn.recv_multi()
+            if introduction[0] == NT_Code.REQ_LANE: # extra transfer connection of an already connected client
+                self._use_caps(introduction[1], conn, introduction[2])
+                self._start_lane(introduction[1], conn)
+                return
+            uuid, hostname, port, caps = introduction
+            self._use_caps(uuid, conn, caps)
+            logger.info(f"Server accepted connection from {uuid}")
+        except (socket.error, ValueError) as e: # TODO should disconnect client
+            logger.info(f"Failed handshake of incoming connection: {e}")
+            conn.close()
+            return
+            
+        if uuid not in self.clients: # if this server not connected to uuid
+            
+            # if uuid is not known update or create new entry
+            if uuid not in self.connections:
+                if temp_uuid(hostname, port) not in self.connections: # connection has also not been entered by the user 
+                    self.connections.new_connection(hostname, port, uuid=uuid) 
+                else: # connection is only known by temporary uuid
+                    self.connections.update(temp_uuid(hostname, port), new_uuid=uuid)
                     
-            except socket.error:
-                logger.info("Server socket has been closed")
-                logger.info("Server offline")
-                self.will_shut_down = True        
+            self.connections.update(uuid, new_hostname=hostname, new_port=port)
+            
+            # establish bilateral connection: connect back to uuid
+            if not self._connect(uuid, hostname, port):
+                pass # bilateral connection was not successful -> TODO: disconnect or smth
+            
+        if caps.get(CAP_STREAMS): conn = self._multiplex(uuid, conn) # once the connection back exists, the handlers use it
+        with self._lock:
+            if uuid in self.client_conns and self.client_conns[uuid].socket.fileno() != -1: 
+                conn.close() # already served
+                return
+            self.client_conns[uuid] = conn
+        self._watch(self._feed if isinstance(conn, Multiplexer) else self._serve_client, uuid, conn)
+        logger.info(f"Serve connection of {uuid}")
+        
+    def _watch(self, serve, uuid, conn):
+        """ (re)registers *conn* with the server loop, its next request is handled by *serve* """
+        if conn.pending(): # the next request has already been received with the last one
+            self.workers.submit(self._serve, serve, uuid, conn)
+            return
+        with self._lock: self._ready.append((serve, uuid, conn))
+        self._wakeup[1].send(b"\0")
+        
+    def _serve(self, serve, uuid, conn):
+        try:
+            if serve(uuid, conn): self._watch(serve, uuid, conn)
+        except Exception:
+            logger.exception(f"Failed to handle request of {uuid}")
+            conn.close()
                 
         
     def connect(self, uuid): 
@@ -113,15 +205,19 @@ class Server():
         try:
             # establish connection
             client = Client(self.uuid, self.sessions, self.file_tracker, self.logging_settings, self.directory_locks, \
-                self.callbacks.sync_status_change, self.callbacks.new_conflict, self.data_path)
+                self.callbacks.sync_status_change, self.callbacks.new_conflict, self.data_path, self.download_window, self.lanes, self.compression, self.chunk_store, \
+                self.sync_workers, self.sync_slots, self.limits, self.swarm, self.staging)
             server_uuid, dir_info = client.connect(hostname, port)
-            
-            # tell connection who we are
-            client.send_multi(self.uuid, self.hostname, self.port) # send introduction
             self.clients[server_uuid] = client
             
-            # update info on connection
+            # update info on connection (before the introduction, the peer connects back right after it and would update it too, see _accept)
             self.connections.update(uuid, new_uuid=server_uuid, new_dir_info=dir_info)
+            
+            # tell connection who we are
+            try: client.introduce(self.uuid, self.hostname, self.port)
+            except socket.error:
+                self.clients.pop(server_uuid, None)
+                raise
             logger.info(f"Client connected to {client.conn_str()}")
                 
             self.callbacks.status_change(server_uuid)
@@ -140,41 +236,115 @@ class Server():
     def shut_down(self):
         self.will_shut_down = True
         logger.debug(f"Active connections at shutdown: {self.clients.keys()}")
-        logger.debug(f"Active Threads: {threading.enumerate()}")
         
         for uuid in list(self.clients.keys()): # need to parse to list otherwise "dictionary changed size during iteration" error eccours
             self.close_connection(uuid)
-            self.client_threads.pop(uuid).join()
-            
+        with self._lock: conns = [*self.client_conns.values(), *(lane for lanes in self.lane_conns.values() for lane in lanes)]
+        for conn in conns: # wakes up workers that are waiting for data
+            try: conn.socket.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+            if isinstance(conn, Multiplexer): conn.close() # the loop might not see the end of the connection anymore
         self.socket.close()
+        self._wakeup[1].send(b"\0")
+        self.workers.shutdown()
         
     
-    def handle_client(self, uuid, conn):  
-        while True:
-            if uuid not in self.clients or self.clients[uuid].connected is False: 
-                logger.info(f"Close thread {uuid}")
-                break      
-            select.select([conn.socket], [], []) # block until until new message
-            try:
+    def _serve_client(self, uuid, conn) -> bool:
+        """ handles one request on the main connection of a peer, returns whether the connection is still open """
+        if uuid not in self.clients or self.clients[uuid].connected is False: 
+            logger.info(f"Stop serving {uuid}")
+            self._drop(uuid, conn)
+            return False
+        try:
+            code = conn.recv_code()
+            self.handlers[code](uuid, conn)
+        except ConnectionResetError:
+            if uuid in self.clients: self.clients[uuid].logger.info(f"An existing connection was forcibly closed by the remote host @ {uuid}")
+            self._drop(uuid, conn)
+            return False
+        except OSError:
+            if uuid in self.clients: self.clients[uuid].logger.exception(f"OSError in Server._serve_client @ {uuid}")
+            self._drop(uuid, conn)
+            return False
+        except (KeyError, ValueError): # connection closed without END_CONN (empty message code)
+            logger.info(f"Connection of {uuid} has been closed")
+            self._drop(uuid, conn)
+            return False
+        if code == NT_Code.END_CONN: 
+            self._drop(uuid, conn)
+            return False
+        return True
+    
+    def _multiplex(self, uuid, conn):
+        """ the peer sends its requests on streams of the connection, each is handled by a worker of its own (see src/Streams.py) """
+        def on_stream(stream):
+            stream_conn = Socket(stream)
+            stream_conn.inherit(conn)
+            self.workers.submit(self._serve_stream, uuid, stream_conn)
+        return Multiplexer(conn, on_stream)
+        
+    def _feed(self, uuid, mux) -> bool:
+        """ receives the frames of a multiplexed connection that are available (in the server loop), returns whether the connection is still open """
+        if uuid not in self.clients or self.clients[uuid].connected is False: 
+            logger.info(f"Stop serving {uuid}")
+            return False
+        try: return mux.feed()
+        except OSError: return False
+        
+    def _serve_stream(self, uuid, conn):
+        """ handles the requests sent on a stream (usually one) until the client closes it """
+        try:
+            while True:
                 code = conn.recv_code()
+                self.handlers[code](uuid, conn)
+                if code == NT_Code.END_CONN: return
+        except ConnectionResetError: pass # stream has been closed
+        except Exception:
+            logger.exception(f"Failed to handle request of {uuid}")
+        finally: conn.close()
+    
+    def _drop(self, uuid, conn):
+        conn.close()
+        with self._lock:
+            if self.client_conns.get(uuid) is conn: del self.client_conns[uuid]
+        self.close_connection(uuid)
+        
+    def _use_caps(self, uuid, conn, caps):
+        """ applies the capabilities the client chose from the ones offered in the greeting """
+        if caps.get(CAP_COMPRESSION) in self.compression: conn.codec = CODECS.get(caps[CAP_COMPRESSION])
+        conn.compression_stats = self.compression_stats.setdefault(uuid, CompressionStats())
+        conn.limits, conn.peer = self.limits, uuid
+        
+    def _start_lane(self, uuid, conn):
+        with self._lock:
+            lanes = self.lane_conns.setdefault(uuid, set())
+            if len(lanes) >= self.lanes: 
+                logger.info(f"Refused transfer lane of {uuid}")
+                conn.close()
+                return
+            lanes.add(conn)
+        self._watch(self._serve_lane, uuid, conn)
+        logger.info(f"Serve transfer lane of {uuid}")
+        
+    def _serve_lane(self, uuid, conn) -> bool:
+        """ handles one file request on an extra transfer connection, returns whether the lane is still open """
+        try:
+            code = conn.recv_code()
+            if code != NT_Code.END_CONN:
                 {
-                    NT_Code.REQ_DIR_LST     : self._fetch_dir_list,
-                    NT_Code.REQ_DIR_GRAPH   : self._fetch_dir_graph,
                     NT_Code.REQ_FILE        : self._fetch_file,
-                    NT_Code.REQ_SYNC_START  : self._start_sync,
-                    NT_Code.REQ_SYNC        : self._sync_back,
-                    NT_Code.END_SYNC        : self._end_sync,
-                    NT_Code.END_CONN        : self._close_connection
+                    NT_Code.REQ_FILES       : self._fetch_files,
+                    NT_Code.REQ_FILE_DELTA  : self._fetch_file_delta,
+                    NT_Code.REQ_FILE_CHUNKS : self._fetch_file_chunks,
+                    NT_Code.REQ_FILE_RANGE  : self._fetch_file_range,
                 }[code](uuid, conn)
-            except ConnectionResetError:
-                self.clients[uuid].logger.info(f"An existing connection was forcibly closed by the remote host @ {uuid}. Will terminate thread")
-                break
-            except OSError:
-                self.clients[uuid].logger.exception(f"OSError in Server.handle_connection @ {uuid}. Will terminate thread")
-                break
-        self.close_connection(uuid)
-            
-                
+                return True
+        except (OSError, KeyError, ValueError): # ValueError/KeyError: connection closed without END_CONN (empty message code)
+            logger.info(f"Transfer lane of {uuid} has been closed")
+        conn.close()
+        with self._lock: self.lane_conns[uuid].discard(conn)
+        logger.info(f"Close transfer lane of {uuid}")
+        return False
     
     def _close_connection(self, uuid, conn):
         conn.close() # must be closed before client closed connection
@@ -189,7 +359,7 @@ class Server():
         locked = self.directory_locks[local_dir].acquire(timeout=3)
         if locked: 
             self.callbacks.sync_status_change(uuid, local_dir, remote_dir, SYNC_STATUS.SYNCING)
-            self.active_syncs[uuid] = local_dir
+            self.active_syncs.setdefault(uuid, set()).add(local_dir)
         conn.send_int(locked)
     
     def _end_sync(self, uuid, conn):
@@ -197,7 +367,8 @@ class Server():
         remote_dir = conn.recv_str()
         self.callbacks.sync_status_change(uuid, local_dir, remote_dir, SYNC_STATUS.NOT_SYNCING)
         self.directory_locks[local_dir].release()
-        del self.active_syncs[uuid]
+        self.active_syncs[uuid].discard(local_dir)
+        if conn.codec: self.clients[uuid].logger.debug(f"Compression of data sent to {uuid}: {conn.compression_stats}")
         
     def _sync_back(self, uuid, conn):
         local_dir = conn.recv_str()
@@ -208,7 +379,9 @@ class Server():
         
         policy = self.connections.get_sync_conflict_policy(uuid, local_dir, remote_dir)
         resolve = self.connections.get_sync_conflict_resolve(uuid, local_dir, remote_dir)
-        self.clients[uuid].queue_sync(local_dir, remote_dir, policy, resolve, False, priority=0).wait()
+        # queued like any other sync of the peer. Waiting for it would hold this worker, while the sync needs the workers of the peer
+        # (which might be waiting for syncs of their own the same way)
+        self.clients[uuid].queue_sync(local_dir, remote_dir, policy, resolve, False, priority=0)
         
         conn.send_code(NT_Code.END_SYNC)
             
@@ -219,15 +392,153 @@ class Server():
     def _fetch_dir_graph(self, uuid, conn):
         directory = conn.recv_str()
         self.file_tracker[directory].update()
-        conn.send_obj(self.file_tracker[directory].root)
+        with self.file_tracker[directory].lock: # pickle under lock since the watcher might change the graph concurrently
+            graph = pickle.dumps(self.file_tracker[directory].root)
+            version = self.file_tracker[directory].version
+        conn.send_obj(graph, pickle_obj=False)
+        conn.send_obj(version) # the client can ask for the changes since this version during the next sync
         self.clients[uuid].logger.debug(f"Send directory graph of '{directory}' to {uuid}")
         
+    def _fetch_dir_tree(self, uuid, conn):
+        """ 
+        answers a list of (relative folder path, tree hash the client knows) with None if the folder did not change,
+        a summary of the folder (see Folder.summary) if it did or False if the folder is not tracked. The replies are sent
+        together with the version of the graph
+        """
+        directory = conn.recv_str()
+        requests = conn.recv_obj()
+        if any(len(parts) == 0 for parts, _ in requests): self.file_tracker[directory].update() # root is only requested once per sync
+        with self.file_tracker[directory].lock:
+            replies = []
+            for parts, tree_hash in requests:
+                folder = self.file_tracker[directory].root.get_folder(parts)
+                if folder is None: replies.append(False)
+                elif folder.tree_hash == tree_hash: replies.append(None)
+                else: replies.append(folder.summary())
+            data = pickle.dumps((replies, self.file_tracker[directory].version))
+        conn.send_obj(data, pickle_obj=False)
+        self.clients[uuid].logger.debug(f"Send {sum(reply is not None for reply in replies)} of {len(requests)} requested folder summaries of '{directory}' to {uuid}")
+        
+    def _fetch_dir_changes(self, uuid, conn):
+        """ 
+        answers the version of the graph the client has with the entries that changed since as (relative path, copy of the entry or None if it
+        is gone), the current version and the current tree hash of the root. Answers None if the changes are not known (anymore)
+        """
+        directory = conn.recv_str()
+        version = conn.recv_obj()
+        tracker = self.file_tracker[directory]
+        tracker.update()
+        with tracker.lock:
+            changes = tracker.changes_since(version)
+            if changes is None or () in changes: data = pickle.dumps(None)
+            else:
+                entries, folders = [], set()
+                for parts in sorted(changes): # parents before their contents
+                    if any(parts[:i] in folders for i in range(1, len(parts))): continue # part of a folder that is sent whole
+                    node = tracker.root.get_node(parts)
+                    if isinstance(node, Folder): 
+                        folders.add(parts)
+                        node = node.subtree()
+                    elif node is not None: node = node._copy(None)
+                    entries.append((parts, node))
+                data = pickle.dumps((entries, tracker.version, tracker.root.tree_hash))
+        conn.send_obj(data, pickle_obj=False)
+        self.clients[uuid].logger.debug(f"Send {'no' if changes is None else len(changes)} changes of '{directory}' to {uuid}")
+        
+    def _shared_path(self, directory, file):
+        """ 
+        full path of *file* (relative path sent by a peer) in the tracked *directory*. Raises PermissionError for paths that lead out of 
+        the directory (checked lexically, files linked into the directory are tracked and shared) and for ignored files
+        """
+        rel_path = os.path.normpath(file)
+        if os.path.isabs(rel_path) or os.path.splitdrive(rel_path)[0] or rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep) \
+                or self.file_tracker[directory].is_in_ignore(rel_path):
+            raise PermissionError(f"'{file}' is not shared in '{directory}'")
+        return os.path.join(directory, rel_path)
+        
     def _fetch_file(self, uuid, conn):
         directory = conn.recv_str()
         file = conn.recv_str()
-        if not self.file_tracker[directory].is_in_ignore(file): #little saftey precaution
-            conn.send_file(os.path.join(directory, file))
-            self.clients[uuid].logger.debug(f"Send file '{file}' to {uuid}")
-
-
-
+        try: path = self._shared_path(directory, file) #little saftey precaution
+        except PermissionError as e:
+            self.clients[uuid].logger.warning(f"Refused to send file to {uuid}: {e}")
+            return
+        conn.send_file(path)
+        self.clients[uuid].logger.debug(f"Send file '{file}' to {uuid}")
+            
+    def _fetch_files(self, uuid, conn):
+        directory = conn.recv_str()
+        files = conn.recv_obj()
+        for file in files: # every file is preceded by a flag whether it is available
+            try: opened = open(self._shared_path(directory, file), "rb")
+            except OSError:
+                conn.send_int(False)
+                continue
+            with opened:
+                conn.send_int(True)
+                conn.send_opened_file(opened)
+        self.clients[uuid].logger.debug(f"Send {len(files)} files to {uuid}")
+        
+    def _fetch_file_range(self, uuid, conn):
+        """ sends *length* bytes of a file from *offset* on (less if the file is shorter), preceded by a flag whether it is available """
+        directory = conn.recv_str()
+        file = conn.recv_str()
+        offset = conn.recv_int()
+        length = conn.recv_int()
+        try: opened = open(self._shared_path(directory, file), "rb")
+        except OSError:
+            conn.send_int(False)
+            return
+        with opened:
+            conn.send_int(True)
+            conn.send_opened_file(opened, offset, length)
+        
+    def _fetch_file_delta(self, uuid, conn):
+        directory = conn.recv_str()
+        file = conn.recv_str()
+        block_size, basis_size, blocks = conn.recv_obj()
+        try: path = self._shared_path(directory, file)
+        except PermissionError: path = None
+        if path is None or not os.path.isfile(path):
+            conn.send_int(False)
+            return
+        conn.send_int(True)
+        for batch in batches(delta(path, basis_size, blocks, block_size)):
+            conn.send_obj(batch)
+        conn.send_code(NT_Code.END_MSG)
+        self.clients[uuid].logger.debug(f"Send delta of file '{file}' to {uuid}")
+        
+    def _fetch_file_chunks(self, uuid, conn):
+        """ 
+        sends the recipe of a file (see src/Chunks.py) or None if it is not available, then the chunks the client asks for 
+        (indices into the recipe) in batches. If the file can't be read anymore, None is sent instead of the remaining batches
+        """
+        directory = conn.recv_str()
+        file = conn.recv_str()
+        try:
+            if self.chunk_store is None: raise PermissionError(file)
+            path = self._shared_path(directory, file)
+            recipe = self.chunk_store.recipe(path)
+        except OSError:
+            conn.send_obj(None)
+            return
+        conn.send_obj(recipe)
+        wanted = conn.recv_obj()
+        starts = offsets(recipe)
+        try:
+            with open(path, "rb") as opened: # chunks are verified by the client, the file might have changed since it was chunked
+                batch, size = [], 0
+                for i in wanted:
+                    opened.seek(starts[i])
+                    self.limits.disk_read.take(recipe[i][1], uuid)
+                    batch.append(opened.read(recipe[i][1]))
+                    size += recipe[i][1]
+                    if size >= MAX_BATCH_SIZE:
+                        conn.send_obj(batch)
+                        batch, size = [], 0
+                if batch: conn.send_obj(batch)
+        except OSError as e: # deleted or locked since the recipe has been sent
+            self.clients[uuid].logger.warning(f"Failed to send the chunks of file '{file}' to {uuid}: {e}")
+            conn.send_obj(None)
+        conn.send_code(NT_Code.END_MSG)
+        self.clients[uuid].logger.debug(f"Send {len(wanted)} of {len(recipe)} chunks of file '{file}' to {uuid}")
@@ -0,0 +1,103 @@
+import mmap
+import os
+import struct
+from pathlib import Path
+
+from src.Config import get_logger
+
+logger_name, logger = get_logger(__name__)
+
+
+# Layout of a snapshot file (all integers little endian):
+#   header:  magic, number of names, number of records, size of the name blob
+#   names:   offsets (uint32, one more than there are names) followed by the utf-8 encoded names.
+#            Every file/folder name is stored once, no matter how often it is used
+#   records: one fixed width record per file/folder in depth first order (parents come before their children)
+MAGIC = b"FSSNAP01"
+HEADER = struct.Struct("<8sIII")
+OFFSET = struct.Struct("<I")
+RECORD = struct.Struct("<iIBB2x16s32sqqqq") # parent, name, kind, flags, hash, stat signature, created, modified, deleted, folder mtime_ns
+
+KIND_FILE = 0
+KIND_FOLDER = 1
+
+FLAG_HASH = 0x1 # record has a hash
+FLAG_STAT = 0x2 # record has a stat signature (files) or a listing mtime (folders)
+
+
+
+def is_snapshot(path:Path) -> bool:
+    with open(path, "rb") as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def save_snapshot(path:Path, root) -> None:
+    """ writes the graph starting at *root* to *path*. The file is replaced atomically """
+    names, name_ids, records = [], {}, []
+
+    def add(element, parent, kind):
+        if element.name not in name_ids:
+            name_ids[element.name] = len(names)
+            names.append(element.name.encode())
+        flags, signature, mtime_ns = 0, b"", 0
+        if isinstance(element.hash, bytes): flags |= FLAG_HASH
+        if kind == KIND_FILE and element._stat is not None: flags, signature = flags | FLAG_STAT, element._stat
+        if kind == KIND_FOLDER and element._mtime_ns is not None: flags, mtime_ns = flags | FLAG_STAT, element._mtime_ns
+        index = len(records)
+        records.append(RECORD.pack(parent, name_ids[element.name], kind, flags, element.hash if flags & FLAG_HASH else b"", signature,
+            element._created, element._modified, element._deleted, mtime_ns))
+        if kind == KIND_FOLDER:
+            for file in element.files.values(): add(file, index, KIND_FILE)
+            for folder in element.folders.values(): add(folder, index, KIND_FOLDER)
+    add(root, -1, KIND_FOLDER)
+
+    offsets, position = [], 0
+    for name in names:
+        offsets.append(OFFSET.pack(position))
+        position += len(name)
+    offsets.append(OFFSET.pack(position))
+
+    temp = path.with_name(path.name + ".tmp")
+    with open(temp, "wb") as file:
+        file.write(HEADER.pack(MAGIC, len(names), len(records), position))
+        file.write(b"".join(offsets))
+        file.write(b"".join(names))
+        file.write(b"".join(records))
+    os.replace(temp, path)
+
+
+def load_snapshot(path:Path, dir_path:Path, ign_ptn):
+    """ rebuilds the graph stored in *path*. Nodes are created without running their constructors (no disk access) """
+    from src.FileTracker import DirectoryContext, File, Folder # avoid circular import
+
+    ctx = DirectoryContext(dir_path, ign_ptn)
+    # records are decoded straight from the mapping (through a memoryview, slicing the mmap would copy them)
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer, memoryview(buffer) as view:
+        _, n_names, n_records, names_size = HEADER.unpack_from(view, 0)
+        position = HEADER.size
+        offsets = struct.unpack_from(f"<{n_names + 1}I", view, position)
+        position += OFFSET.size * (n_names + 1)
+        names = [str(view[position + offsets[i]:position + offsets[i+1]], "utf-8") for i in range(n_names)]
+        position += names_size
+
+        nodes = []
+        new_file, new_folder = File.__new__, Folder.__new__
+        for parent, name, kind, flags, digest, signature, created, modified, deleted, mtime_ns \
+                in RECORD.iter_unpack(view[position:position + RECORD.size * n_records]):
+            parent = nodes[parent] if parent != -1 else None
+            name = names[name]
+            if kind == KIND_FILE:
+                node = new_file(File)
+                node._stat = signature if flags & FLAG_STAT else None
+                parent.files[name] = node
+            else:
+                node = new_folder(Folder)
+                node.folders, node.files = {}, {}
+                node._mtime_ns = mtime_ns if flags & FLAG_STAT else None
+                node._tree_hash = node._aggregates = None
+                if parent is not None: parent.folders[name] = node
+            node.name, node.parent, node.ctx = name, parent, ctx
+            node._created, node._modified, node._deleted = created, modified, deleted
+            node.hash = digest if flags & FLAG_HASH else 0
+            nodes.append(node)
+    return nodes[0]
@@ -0,0 +1,94 @@
+import os
+from threading import Lock
+
+import mmh3
+import varint
+from imohash.imohash import SAMPLE_SIZE, SAMPLE_THRESHOLD
+
+
+# Files a sync receives are written to a temporary file next to their destination (see part_path in src/Network.py) that replaces the
+# destination once it is complete, so a failed transfer never leaves a truncated file behind. How durable the received files are is
+# configurable (durability):
+#   "none": nothing is flushed to disk, the os writes the files back whenever it likes (after a crash they might be empty)
+#   "sync": the files a sync received and their folders are flushed at the end of the sync, before it is recorded as done (default)
+#   "file": every file is flushed before it replaces its destination (slowest, a crash never loses a file that has been received)
+# The content hash of a received file is computed from the data while it is written (StreamHash). The directory tracker trusts it as
+# long as the file's stat does not change (see Directory.trust), so received files are not read from disk again to be hashed.
+
+DURABILITY_NONE, DURABILITY_SYNC, DURABILITY_FILE = "none", "sync", "file"
+DURABILITIES = (DURABILITY_NONE, DURABILITY_SYNC, DURABILITY_FILE)
+
+
+def fsync_path(path, directory=False):
+    """ flushes the file (or the entries of the folder) at *path* to disk """
+    if directory and os.name == "nt": return # folders can't be opened on Windows (their entries are flushed with the files)
+    fd = os.open(path, os.O_RDONLY if directory else os.O_RDWR)
+    try: os.fsync(fd)
+    finally: os.close(fd)
+
+
+
+class StreamHash:
+    """ imohash of a file computed from its data while it is written, same as imohash.hashfile without reading the file again """
+    # mirrors the sampling and digest of imohash 1.0.4 (pinned in requirements.txt), must be updated with it
+    def __init__(self, size):
+        self.size = size # size announced by the sender, the samples depend on it
+        self.written = 0
+        if size < SAMPLE_THRESHOLD: self.regions = [(0, size)] # small files are hashed completely
+        else: self.regions = [(0, SAMPLE_SIZE), (size // 2, size // 2 + SAMPLE_SIZE), (size - SAMPLE_SIZE, size)]
+        self.samples = [bytearray(end - start) for start, end in self.regions]
+
+    def update(self, data):
+        """ *data* has been written after the data passed before """
+        start, end = self.written, self.written + len(data)
+        for (region_start, region_end), sample in zip(self.regions, self.samples):
+            lo, hi = max(start, region_start), min(end, region_end)
+            if lo < hi: sample[lo - region_start:hi - region_start] = data[lo - start:hi - start]
+        self.written = end
+
+    def digest(self):
+        """ the hash or None if the file did not have the announced size (changed while it was sent) """
+        if self.written != self.size: return None
+        hash = mmh3.hash_bytes(b"".join(self.samples))
+        hash = hash[7::-1] + hash[16:7:-1]
+        size = varint.encode(self.size)
+        return size + hash[len(size):]
+
+
+
+class Staging:
+    """ records the files the syncs of the local directories received (shared by all clients and lanes) and makes them durable """
+    def __init__(self, file_tracker, durability=DURABILITY_SYNC):
+        if durability not in DURABILITIES: raise ValueError(f"Unknown durability '{durability}', expected one of {DURABILITIES}")
+        self.file_tracker = file_tracker
+        self.durability = durability
+        self.per_file = durability == DURABILITY_FILE # whether received files are flushed before they replace their destination
+        self.received_files = {} # local dir -> full paths of the files received since the last flush
+        self.lock = Lock()
+
+    def replace(self, local_dir, temp_path, path, hash=None):
+        """ replaces *path* (in *local_dir*) with the complete temporary file *temp_path* (*hash*: its contents if known) """
+        if self.per_file: fsync_path(temp_path)
+        os.replace(temp_path, path)
+        self.received(local_dir, path, hash)
+
+    def received(self, local_dir, path, hash=None):
+        """ *path* (in *local_dir*) has been replaced with a received file (*hash*: its contents if known) """
+        if hash is not None:
+            try: self.file_tracker[local_dir].trust(path, hash, os.stat(path))
+            except (KeyError, FileNotFoundError): pass # not tracked (anymore) / replaced since
+        if self.durability == DURABILITY_NONE: return
+        if self.per_file: fsync_path(os.path.dirname(path), directory=True) # the rename
+        else:
+            with self.lock: self.received_files.setdefault(local_dir, []).append(path)
+
+    def flush(self, local_dir):
+        """ flushes the files received in *local_dir* since the last flush and the folders they are in (durability "sync") """
+        with self.lock: paths = self.received_files.pop(local_dir, [])
+        folders = set()
+        for path in paths:
+            try: fsync_path(path)
+            except FileNotFoundError: continue # deleted/replaced since
+            folders.add(os.path.dirname(path))
+        for folder in folders: fsync_path(folder, directory=True)
+        return len(paths)
@@ -0,0 +1,240 @@
+import socket
+import struct
+from collections import deque
+from threading import Condition, Lock
+
+from src.Config import get_logger
+
+logger_name, logger = get_logger(__name__)
+
+
+# Multiplexing: a connection carries any number of streams, each behaves like a connection of its own (Stream is socket-like and is
+# wrapped in a Network.Socket). The client opens a stream per request, so the server can handle requests of the same peer at the same
+# time and answers them in any order.
+#
+# Frames: stream id + kind + length (STREAM_FRAME) + payload (DATA frames only). Data is cut into frames of at most MAX_FRAME_SIZE bytes
+# and a sender only queues its next frame once the last one has been sent, so busy streams take turns and a small request waits for at
+# most one frame per busy stream instead of a whole file. A stream only sends as much as the receiver granted (STREAM_WINDOW, CREDIT
+# frames), so a stream that is read slowly does not hold up the others.
+
+STREAM_FRAME = struct.Struct(">IBI") # stream id + kind + payload length (granted bytes for CREDIT frames)
+MAX_FRAME_SIZE = 64 * 1024
+STREAM_WINDOW = 1024 * 1024 # bytes a stream may send before the receiver grants more
+RECV_SIZE = 256 * 1024
+
+DATA, CLOSE, CREDIT = 0, 1, 2
+
+
+
+class Stream:
+    """ socket-like stream of a Multiplexer. Is opened by sending on it and closed by either side (the other side reads what has been sent before and then the end) """
+    def __init__(self, mux, id):
+        self.mux = mux
+        self.id = id
+        self._chunks = deque() # received data that has not been read yet
+        self._offset = 0 # bytes of the first chunk that have been read
+        self._credit = STREAM_WINDOW # bytes that may still be sent
+        self._consumed = 0 # bytes read since credit was last granted
+        self._closed = False
+        self._remote_closed = False
+        self._cond = Condition()
+
+    def fileno(self):
+        return -1 if self._closed else self.mux.socket.fileno()
+
+    def shutdown(self, how):
+        self.close()
+
+    def close(self):
+        with self._cond:
+            if self._closed: return
+            self._closed = True
+            self._cond.notify_all()
+        self.mux._close(self)
+
+
+    # sending
+    def sendall(self, data):
+        view = memoryview(data).cast("B")
+        while view:
+            with self._cond:
+                while self._credit <= 0 and not (self._closed or self._remote_closed): self._cond.wait()
+                if self._closed or self._remote_closed: raise ConnectionResetError(f"Stream {self.id} has been closed")
+                n = min(len(view), MAX_FRAME_SIZE, self._credit)
+                self._credit -= n
+            self.mux._send(STREAM_FRAME.pack(self.id, DATA, n), view[:n])
+            view = view[n:]
+
+    def sendmsg(self, buffers):
+        for buffer in buffers: self.sendall(buffer)
+        return sum(map(len, buffers))
+
+    def sendfile(self, file, offset=0, count=None):
+        """ no zero copy: the file is read in frames so other streams can send in between """
+        file.seek(offset)
+        sent = 0
+        while count is None or sent < count:
+            data = file.read(MAX_FRAME_SIZE if count is None else min(MAX_FRAME_SIZE, count - sent))
+            if not data: break
+            self.sendall(data)
+            sent += len(data)
+        return sent
+
+
+    # receiving
+    def recv_into(self, buffer, nbytes=0):
+        """ blocks until data is available, returns 0 once the stream has been closed """
+        view = memoryview(buffer).cast("B")
+        n = nbytes or len(view)
+        with self._cond:
+            while not self._chunks and not (self._closed or self._remote_closed): self._cond.wait()
+            received = 0
+            while self._chunks and received < n:
+                chunk = self._chunks[0]
+                k = min(n - received, len(chunk) - self._offset)
+                view[received:received + k] = chunk[self._offset:self._offset + k]
+                received += k
+                self._offset += k
+                if self._offset == len(chunk):
+                    self._chunks.popleft()
+                    self._offset = 0
+            self._consumed += received
+            grant = 0
+            if self._consumed >= STREAM_WINDOW // 2 and not self._remote_closed:
+                grant, self._consumed = self._consumed, 0
+        if grant: self.mux._send(STREAM_FRAME.pack(self.id, CREDIT, grant))
+        return received
+
+    def _receive(self, data):
+        with self._cond:
+            self._chunks.append(data)
+            self._cond.notify_all()
+
+    def _grant(self, n):
+        with self._cond:
+            self._credit += n
+            self._cond.notify_all()
+
+    def _end(self):
+        with self._cond:
+            self._remote_closed = True
+            self._cond.notify_all()
+
+
+
+
+class Multiplexer:
+    """
+    carries the streams of a connection (see above). *conn* is the Network.Socket of the connection after the handshake, data it has
+    already received is taken over. *on_stream* is called with every stream the other side opens (in the thread that receives)
+    """
+    def __init__(self, conn, on_stream=None):
+        self.socket = conn.socket
+        self.on_stream = on_stream
+        self.streams = {} # id -> open stream
+        self._last_id = 0 # highest id of a stream that has been opened
+        self._lock = Lock() # streams
+        self._buffer = bytearray(conn.take_pending()) # received data that is not a complete frame yet
+
+        self._send_cond = Condition()
+        self._queue = [] # frames waiting to be sent
+        self._queued = self._sent = 0 # number of frames that have been queued/sent
+        self._sending = False # whether a thread is sending the queued frames
+        self._error = None # the connection failed while sending
+        self._dispatch()
+
+    def pending(self) -> bool:
+        return False # received frames are handed to their streams right away
+
+    def open(self) -> Stream:
+        with self._lock:
+            self._last_id += 1
+            stream = self.streams[self._last_id] = Stream(self, self._last_id)
+        return stream
+
+    def close(self):
+        try: self.socket.shutdown(socket.SHUT_RDWR) # wakes up the thread that receives
+        except OSError: pass
+        self.socket.close()
+        self._reset()
+
+    def _reset(self):
+        """ the connection is gone: ends all streams """
+        with self._lock:
+            streams = list(self.streams.values())
+            self.streams.clear()
+        for stream in streams: stream._end()
+
+    def _close(self, stream):
+        with self._lock: self.streams.pop(stream.id, None)
+        try: self._send(STREAM_FRAME.pack(stream.id, CLOSE, 0))
+        except ConnectionResetError: pass
+
+
+    # sending
+    def _send(self, *frame):
+        """
+        queues a frame and waits until it has been sent. The thread that finds no one sending sends all frames queued until then
+        at once (one syscall for the frames of several streams)
+        """
+        with self._send_cond:
+            if self._error: raise ConnectionResetError(f"Connection failed: {self._error}")
+            self._queue.extend(frame)
+            self._queued += 1
+            ticket = self._queued
+            while self._sending and self._sent < ticket: self._send_cond.wait()
+            if self._sent >= ticket: return
+            if self._error: raise ConnectionResetError(f"Connection failed: {self._error}")
+            self._sending = True
+            frames, self._queue, queued = self._queue, [], self._queued
+        try: self.socket.sendall(b"".join(frames))
+        except OSError as e:
+            with self._send_cond:
+                self._error, self._sending = e, False
+                self._send_cond.notify_all()
+            raise ConnectionResetError(f"Connection failed: {e}") from e
+        with self._send_cond:
+            self._sent, self._sending = queued, False
+            self._send_cond.notify_all()
+
+
+    # receiving
+    def run(self):
+        """ receives frames until the connection is closed (on the side that does not watch the connection with a selector) """
+        try:
+            while self.feed(): pass
+        except OSError: pass
+        finally: self._reset()
+
+    def feed(self) -> bool:
+        """ receives what is available (blocks if nothing is) and hands the complete frames to their streams, returns False once the connection is closed """
+        data = self.socket.recv(RECV_SIZE)
+        if not data: return False
+        self._buffer += data
+        self._dispatch()
+        return True
+
+    def _dispatch(self):
+        view, pos = memoryview(self._buffer), 0
+        while len(view) - pos >= STREAM_FRAME.size:
+            id, kind, length = STREAM_FRAME.unpack_from(view, pos)
+            end = pos + STREAM_FRAME.size + (length if kind == DATA else 0)
+            if end > len(view): break # incomplete
+            stream = self._stream(id, kind)
+            if stream is not None:
+                if kind == DATA: stream._receive(bytes(view[pos + STREAM_FRAME.size:end]))
+                elif kind == CREDIT: stream._grant(length)
+                else: stream._end()
+            pos = end
+        view.release()
+        del self._buffer[:pos]
+
+    def _stream(self, id, kind):
+        """ the open stream *id*, a new stream if the other side just opened it or None if it has been closed already """
+        with self._lock:
+            stream = self.streams.get(id)
+            if stream is not None or kind != DATA or id <= self._last_id: return stream
+            self._last_id = id
+            stream = self.streams[id] = Stream(self, id)
+        if self.on_stream is not None: self.on_stream(stream)
+        return stream
@@ -0,0 +1,272 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Condition, Lock
+
+from imohash import hashfile
+from imohash.imohash import SAMPLE_THRESHOLD
+
+from src.Config import CONN_SYNCS_KEY, get_logger
+from src.FileTracker import File
+from src.Network import part_path
+
+logger_name, logger = get_logger(__name__)
+
+
+# Swarm downloads: if a local directory is synced with several connected peers, the files a sync downloads are requested from every
+# peer that has them (same hash in its graph), not only from the peer being synced with. Large files are split into ranges that can
+# come from different peers. Every source takes the next files/ranges it has as soon as it is done with its last ones, as many as it
+# sends in about BATCH_TIME seconds (measured), so fast peers do most of the work and slow ones never hold much of it.
+# Files from other peers are checked against the hash of the peer being synced with, what does not match is downloaded from it.
+# imohash only samples large files, so large files that came from other peers are checked with a delta of the file of the peer being
+# synced with afterwards (same as local copies, see Client._copy): the blocks that differ are downloaded from it.
+
+RANGE_SIZE = 8 * 1024 * 1024 # large files are split into ranges of this size
+MIN_RANGED_SIZE = 4 * RANGE_SIZE # smaller files are downloaded whole
+BATCH_TIME = 1.0 # seconds of transfer a source takes at once
+MIN_BATCH_SIZE = 1024 * 1024 # bytes a source takes at once before its throughput is known
+
+
+
+class Source:
+    """ connection to a peer that has a copy of the directory being downloaded (the peer being synced with or a mirror) """
+    def __init__(self, uuid, lane, remote_dir, ranges, graph=None, graph_lock=None):
+        self.uuid = uuid
+        self.lane = lane # connection the files are requested on (a Client or one of its lanes)
+        self.remote_dir = remote_dir
+        self.ranges = ranges # whether the peer can send parts of files
+        self.graph = graph # graph of remote_dir, None = the peer being synced with (has every file)
+        self.graph_lock = graph_lock
+        self.rate = 0.0 # bytes per second (moving average over the batches it sent)
+        self.sent = 0 # bytes it sent during this download
+
+    def has(self, parts, hash) -> bool:
+        if self.graph is None: return True
+        with self.graph_lock: node = self.graph.get_node(parts)
+        return isinstance(node, File) and node.exists and node.hash == hash
+
+    def measured(self, size, seconds):
+        self.sent += size
+        if seconds <= 0: return
+        self.rate = size / seconds if not self.rate else 0.7 * self.rate + 0.3 * size / seconds
+
+
+
+class RangedFile:
+    """ large file that is downloaded in ranges into a temporary file """
+    def __init__(self, path, local_path, hash, size):
+        self.path = path
+        self.local_path = local_path
+        self.temp_path = part_path(local_path)
+        self.hash = hash
+        self.remaining = -(-size // RANGE_SIZE) # ranges that have not been received yet
+        self.mirrored = False # whether ranges came from mirrors
+        with open(self.temp_path, "wb") as file: file.truncate(size)
+
+
+
+class Task:
+    """ a file or a range of a RangedFile """
+    __slots__ = ("path", "hash", "size", "offset", "file", "sources")
+
+    def __init__(self, path, hash, size, sources, offset=0, file=None):
+        self.path = path
+        self.hash = hash
+        self.size = size
+        self.offset = offset
+        self.file = file # RangedFile if this is a range
+        self.sources = sources # sources that may send it
+
+
+
+class Swarm:
+    """ finds the connected peers that have a copy of a directory being synced (shared by the clients of all peers, see Client._sync) """
+    def __init__(self, clients, connections):
+        self.clients = clients # uuid -> Client of every connected peer
+        self.connections = connections
+        self.throughput = {} # uuid -> bytes per second the peer sent during the last swarm download
+        self.lock = Lock()
+
+    def start(self, client, local_dir, remote_dir, graph):
+        """
+        returns a Download for the sync of *local_dir* with *remote_dir* of *client* (*graph*: its graph of remote_dir) or None if no
+        other peer has a copy of local_dir
+        """
+        mirrors = []
+        for uuid, other in list(self.clients.items()):
+            if other is client or not other.connected or not other.use_streams or uuid not in self.connections: continue
+            syncs = self.connections[uuid][CONN_SYNCS_KEY]
+            if local_dir not in syncs: continue
+            for other_dir in list(syncs[local_dir]):
+                try: other_graph = other.req_dir_graph(other_dir)
+                except (OSError, KeyError) as e:
+                    logger.debug(f"Can't use '{other_dir}' of {uuid} as mirror: {e}")
+                    continue
+                mirrors.append(Source(uuid, other, other_dir, other.use_ranges, other_graph, other.graphs_lock))
+        if not mirrors: return None
+        client.logger.info(f"Download files of '{local_dir}' from the mirrors {', '.join(mirror.uuid for mirror in mirrors)} too")
+        return Download(self, client, local_dir, remote_dir, graph, mirrors)
+
+    def measured(self, sources, seconds):
+        """ records the throughput of the peers during a download """
+        if seconds <= 0: return
+        with self.lock:
+            for uuid in {source.uuid for source in sources}:
+                self.throughput[uuid] = sum(source.sent for source in sources if source.uuid == uuid) / seconds
+
+    def stats(self) -> dict:
+        with self.lock: return dict(self.throughput)
+
+
+
+class Download:
+    """ the files one sync downloads from the peer it syncs with and the mirrors (see above) """
+    def __init__(self, swarm, client, local_dir, remote_dir, graph, mirrors):
+        self.swarm = swarm
+        self.client = client
+        self.local_dir = local_dir
+        self.remote_dir = remote_dir
+        self.graph = graph
+        self.mirrors = mirrors
+        self.tasks = deque() # tasks no source has taken yet
+        self.ranged = [] # files that are downloaded in ranges
+        self.pending = 0 # bytes of the tasks no source has taken yet
+        self.sources = 1 # number of sources
+        self.busy = 0 # sources that are downloading a batch
+        self.error = None # connection error of the peer being synced with
+        self.cond = Condition()
+
+    def has_mirror(self, remote_file) -> bool:
+        """ whether a mirror has *remote_file* (node of the graph of the peer being synced with) """
+        return any(mirror.has(remote_file._parts(), remote_file.hash) for mirror in self.mirrors)
+
+    def download(self, files):
+        """ downloads *files* (paths relative to the directories) from all sources """
+        client = self.client
+        lanes = len(client.lanes) >= 2 and client.lanes_in_use.acquire(blocking=False)
+        try:
+            primary = [Source(client.remote_uuid, lane, self.remote_dir, client.use_ranges) for lane in (client.lanes if lanes else [client])]
+            sources = primary + self.mirrors
+            self.sources = len(sources)
+            self._queue(files, primary, sources)
+            start = time.monotonic()
+            with ThreadPoolExecutor(len(sources), thread_name_prefix="swarm") as executor:
+                for future in [executor.submit(self._work, source) for source in sources]: future.result()
+            self.swarm.measured(sources, time.monotonic() - start)
+            for source in sources:
+                if source.sent: client.logger.info(f"Downloaded {source.sent} bytes from {source.uuid} ({source.rate / 2**20:.1f} MiB/s)")
+            if self.tasks and self.error is not None: raise self.error # same as without mirrors
+            for path in dict.fromkeys(task.path for task in self.tasks): 
+                client.logger.warning(f"Remote file '{path}' could not be downloaded from any peer")
+        finally:
+            if lanes: client.lanes_in_use.release()
+            for file in self.ranged:
+                if file.remaining and os.path.exists(file.temp_path): os.remove(file.temp_path)
+
+    def _queue(self, files, primary, sources):
+        for path in files:
+            node = self.graph.get_node(Path(path).parts)
+            hash, size = (node.hash, node.size or 0) if node is not None else (0, 0)
+            have = [source for source in sources if source in primary or (hash and source.has(node._parts(), hash))]
+            if size >= MIN_RANGED_SIZE and self.client.use_ranges and any(source.ranges for source in self.mirrors if source in have):
+                file = RangedFile(path, os.path.join(self.local_dir, path), hash, size)
+                self.ranged.append(file)
+                have = [source for source in have if source.ranges]
+                self.tasks.extend(Task(path, hash, min(RANGE_SIZE, size - offset), have, offset, file) for offset in range(0, size, RANGE_SIZE))
+            else: self.tasks.append(Task(path, hash, size, have))
+        self.pending = sum(task.size for task in self.tasks)
+
+    def _work(self, source):
+        while batch := self._take(source):
+            start, retry = time.monotonic(), []
+            try:
+                if batch[0].file is None: retry = self._download_files(source, batch)
+                else: retry = self._download_ranges(source, batch)
+            except OSError as e:
+                self.client.logger.warning(f"Stop downloading from {source.uuid}: {e}")
+                if source.graph is None: self.error = e
+                retry = batch
+                return
+            finally:
+                for task in retry: task.sources = [other for other in task.sources if other is not source]
+                with self.cond:
+                    self.tasks.extendleft(reversed(retry))
+                    self.pending += sum(task.size for task in retry)
+                    self.busy -= 1
+                    self.cond.notify_all()
+            source.measured(sum(task.size for task in batch), time.monotonic() - start)
+
+    def _take(self, source):
+        """
+        the next tasks *source* can send, as much as it sends in about BATCH_TIME seconds but no more than its share of what is left.
+        Waits while other sources are busy (they might give tasks back), returns [] once there is nothing left for it
+        """
+        with self.cond:
+            while True:
+                budget = max(MIN_BATCH_SIZE, min(source.rate * BATCH_TIME, self.pending / (2 * self.sources)))
+                batch, skipped, size = [], [], 0
+                while self.tasks and size < budget:
+                    task = self.tasks.popleft()
+                    # a batch is either whole files or ranges
+                    if source not in task.sources or (batch and (task.file is None) != (batch[0].file is None)): skipped.append(task)
+                    else:
+                        batch.append(task)
+                        size += task.size
+                self.tasks.extendleft(reversed(skipped))
+                self.pending -= size
+                if batch: self.busy += 1
+                if batch or not self.busy: return batch
+                self.cond.wait()
+
+    def _download_files(self, source, batch):
+        """ returns the files that have to be downloaded again (from another source) """
+        hashes = {} # computed while receiving the files
+        source.lane.req_files(source.remote_dir, [task.path for task in batch], self.local_dir, hashes)
+        if source.graph is None: return []
+        return [task for task in batch if hashes.get(task.path) != task.hash or (task.size >= SAMPLE_THRESHOLD and not self._check(task.path))]
+
+    def _download_ranges(self, source, batch):
+        """ returns the ranges that have to be downloaded again (from another source) """
+        opened = {}
+        try:
+            for task in batch:
+                if task.file not in opened: opened[task.file] = open(task.file.temp_path, "r+b")
+            received = source.lane.req_file_ranges(source.remote_dir, [(task.path, task.offset, task.size, opened[task.file]) for task in batch])
+        finally:
+            for file in opened.values(): file.close()
+        complete = []
+        with self.cond:
+            for task, ok in zip(batch, received):
+                if not ok: continue
+                task.file.remaining -= 1
+                if source.graph is not None: task.file.mirrored = True
+                if task.file.remaining == 0: complete.append(task.file)
+        for file in complete: self._complete(file)
+        return [task for task, ok in zip(batch, received) if not ok]
+
+    def _complete(self, file):
+        """ all ranges of *file* have been received. If they don't add up to the file (one of the peers sent another version), it is downloaded from the peer being synced with """
+        if self._verify(file.temp_path, file.hash): # the ranges were written out of order, only the samples imohash needs are read
+            self.client.staging.replace(self.local_dir, file.temp_path, file.local_path, file.hash)
+            if file.mirrored and not self._check(file.path): 
+                os.remove(file.local_path) # can't be checked, downloaded during the next sync
+                return
+            self.client.logger.info(f"Downloaded file '{file.path}' in '{self.local_dir}' in ranges")
+            return
+        os.remove(file.temp_path)
+        self.client.logger.warning(f"Ranges of '{file.path}' do not match, download it from {self.client.remote_uuid}")
+        self.client.req_file(self.remote_dir, file.path, self.local_dir, file.path)
+
+    def _check(self, path):
+        """ 
+        updates the file at *path* (received from a mirror) with a delta of the file of the peer being synced with. Returns False if 
+        that is not available
+        """
+        return self.client.req_file_delta(self.remote_dir, path, self.local_dir, path)
+
+    @staticmethod
+    def _verify(path, hash):
+        try: return hashfile(path) == hash
+        except OSError: return False
@@ -0,0 +1,198 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+
+from src.Config import get_logger
+
+logger_name, logger = get_logger(__name__)
+
+
+
+# inotify constants (see /usr/include/linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct("iIII") # wd, mask, cookie, len
+
+
+
+class Watcher:
+    """
+    Base class for watching tracked directories. Events are collected and coalesced per directory
+    and applied as targeted updates (Directory.update_paths) once no new events arrived for *debounce* seconds
+    (but at the latest after *max_delay* seconds)
+    """
+    def __init__(self, debounce=0.2, max_delay=1.0):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.directories = {} # dir path -> Directory
+        self.pending = {} # dir path -> set of changed relative paths (None = rescan whole directory)
+        self.first_event = None # time of the first event that has not been applied yet
+        self.last_event = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="watcher_thread", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        logger.info(f"{type(self).__name__} online")
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive(): self.thread.join()
+        logger.info(f"{type(self).__name__} offline")
+
+    def watch(self, directory):
+        self.directories[str(directory.path)] = directory
+
+    def _event(self, dir_path, rel_path):
+        """ registers a change of *rel_path* in *dir_path*. rel_path=None requests a rescan of the whole directory """
+        with self.lock:
+            if rel_path is None: self.pending[dir_path] = None
+            elif self.pending.get(dir_path, set()) is not None: self.pending.setdefault(dir_path, set()).add(rel_path)
+            self.last_event = time.monotonic()
+            if self.first_event is None: self.first_event = self.last_event
+
+    def _due(self):
+        with self.lock:
+            if self.first_event is None: return False
+            t = time.monotonic()
+            return t - self.last_event >= self.debounce or t - self.first_event >= self.max_delay
+
+    def _flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.first_event = self.last_event = None
+        for dir_path, rel_paths in pending.items():
+            directory = self.directories[dir_path]
+            try:
+                if rel_paths is None: stats = directory.update(callback=True)
+                else: stats = directory.update_paths(sorted(rel_paths, key=lambda p: len(p.parts)), callback=True)
+                self._applied(directory, stats)
+            except OSError:
+                directory.logger.exception(f"Failed to apply changes in {dir_path}")
+
+    def _applied(self, directory, stats): pass # to override
+
+    def _run(self): raise NotImplementedError # to override
+
+
+
+class PollingWatcher(Watcher):
+    """ fallback for systems without inotify: runs an incremental update of every directory every *interval* seconds """
+    def __init__(self, interval=2.0, **kwargs):
+        super().__init__(**kwargs)
+        self.interval = interval
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            for dir_path in list(self.directories):
+                self._event(dir_path, None)
+            self._flush()
+
+
+
+class InotifyWatcher(Watcher):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0: raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {} # watch descriptor -> (dir path, relative path of watched folder)
+        self.watched = {} # (dir path, relative path) -> watch descriptor
+        self.watch_lock = threading.Lock() # watches are added by the threads loading the graphs aswell
+
+    def watch(self, directory):
+        # graphs are loaded lazily, until then there is nothing to update (loading a graph brings it up to date)
+        super().watch(directory)
+        directory.when_loaded(lambda: self._add_watches(str(directory.path), directory.root))
+
+    def _add_watches(self, dir_path, folder):
+        """ adds watches for *folder* and all of its tracked subfolders """
+        if not folder.exists: return
+        key = (dir_path, folder.location())
+        with self.watch_lock:
+            if key not in self.watched:
+                wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder.full_path), WATCH_MASK)
+                if wd < 0:
+                    logger.warning(f"Cannot watch '{folder.full_path}': {os.strerror(ctypes.get_errno())}")
+                    return
+                # a folder that has been moved keeps its watch, adding it again at its new path returns the same descriptor
+                if wd in self.watches: self.watched.pop(self.watches[wd], None)
+                self.watches[wd] = key
+                self.watched[key] = wd
+        for sub_folder in list(folder.folders.values()):
+            self._add_watches(dir_path, sub_folder)
+
+    def _remove_watches(self, dir_path, rel_folder):
+        """ removes the watches of the folder *rel_folder* and its subfolders (moved away, they are added again at their new path) """
+        with self.watch_lock:
+            for key in [key for key in self.watched if key[0] == dir_path and key[1].is_relative_to(rel_folder)]:
+                wd = self.watched.pop(key)
+                del self.watches[wd]
+                self.libc.inotify_rm_watch(self.fd, wd)
+
+    def _applied(self, directory, stats):
+        # created (or moved) folders need to be watched aswell
+        with directory.lock:
+            for rel_path in dict.fromkeys(stats.changed):
+                folder = directory.root.get_folder(rel_path.parts)
+                if folder is not None: self._add_watches(str(directory.path), folder)
+
+    def _read_events(self):
+        try: buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError: return
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+            name = buffer[offset + EVENT_HEADER.size: offset + EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW: # events have been lost -> rescan everything
+                for dir_path in self.directories: self._event(dir_path, None)
+                continue
+            with self.watch_lock:
+                if mask & IN_IGNORED: # watch was removed (folder deleted)
+                    if wd in self.watches: del self.watched[self.watches.pop(wd)]
+                    continue
+                if wd not in self.watches: continue
+                dir_path, rel_folder = self.watches[wd]
+            # no IN_IGNORED follows a move, the folder is still watched (unless the watch has been moved to its new path already)
+            if mask & IN_MOVE_SELF and not os.path.isdir(os.path.join(dir_path, rel_folder)): self._remove_watches(dir_path, rel_folder)
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF): self._event(dir_path, rel_folder)
+            elif name: self._event(dir_path, rel_folder / os.fsdecode(name))
+
+    def _run(self):
+        while not self.stopped.is_set():
+            timeout = self.debounce if self.first_event is not None else 0.5
+            if select.select([self.fd], [], [], timeout)[0]: self._read_events()
+            if self._due(): self._flush()
+        os.close(self.fd)
+
+
+
+def create_watcher(**kwargs):
+    """ uses inotify where available, otherwise falls back to polling """
+    if sys.platform.startswith("linux"):
+        try: return InotifyWatcher(**kwargs)
+        except (OSError, AttributeError) as e:
+            logger.warning(f"inotify not available ({e}), falling back to polling")
+    return PollingWatcher(**kwargs)
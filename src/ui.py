@@ -29,6 +29,7 @@ class UI_Code(IntEnum):
     UUID_DEL_SYNC = auto()
     UUID_RESOLVE_CONFLICT = auto()
     UUID_REQ_CONFLICTS = auto()
+    REQ_SYNC_STATS = auto()
     
     REQ_DIRS = auto()
     REQ_DIR_INFO = auto()
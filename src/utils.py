@@ -10,6 +10,19 @@ from pathlib import Path
 def now():
     return datetime.datetime.utcnow()
 
+def to_micros(time:datetime.datetime) -> int:
+    """ microseconds since datetime.min (= DEFAULT_TIME), used for storing timestamps as integers """
+    return (time - datetime.datetime.min) // datetime.timedelta(microseconds=1)
+
+def from_micros(micros:int) -> datetime.datetime:
+    return datetime.datetime.min + datetime.timedelta(microseconds=micros)
+
+EPOCH_MICROS = to_micros(datetime.datetime(1970, 1, 1))
+
+def ns_to_micros(timestamp_ns:int) -> int:
+    """ converts a unix timestamp in nanoseconds (e.g. st_mtime_ns) """
+    return EPOCH_MICROS + timestamp_ns // 1000
+
 
 
 # creates a nested dictionary from given keys (in order of given keys)
@@ -93,7 +106,7 @@ class RepeatedJob(threading.Thread):
             self.execute(*self.args, **self.kwargs)
     
     def join(self):
-        if self.is_alive(): self.join()
+        if self.is_alive(): threading.Thread.join(self)
             
             
 
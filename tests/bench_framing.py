@@ -0,0 +1,86 @@
+from test_utils import this
+import os
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import nullcontext
+
+from src.Network import NT_Code, Socket
+
+
+# Measures how fast messages can be sent over a connection (Network.Socket framing) and how many socket calls (= syscalls) that takes.
+# Both ends run in this process, connected by a socketpair.
+# usage: python bench_framing.py [number of requests]
+
+
+class CountingSocket:
+    """ wraps a socket and counts the calls that make syscalls """
+    def __init__(self, sock, calls):
+        self.sock, self.calls = sock, calls
+
+    def __getattr__(self, name):
+        attribute = getattr(self.sock, name)
+        if name not in ("recv", "recv_into", "send", "sendall", "sendmsg", "sendfile"): return attribute
+        def counted(*args, **kwargs):
+            self.calls[name] += 1
+            return attribute(*args, **kwargs)
+        return counted
+
+
+def connection():
+    sender_calls, receiver_calls = Counter(), Counter()
+    a, b = socket.socketpair()
+    sender, receiver = Socket(CountingSocket(a, sender_calls)), Socket(CountingSocket(b, receiver_calls))
+    sender.send_multi("greeting") # connections always start with a handshake (older versions rely on it)
+    receiver.recv_multi()
+    sender_calls.clear()
+    receiver_calls.clear()
+    return sender, receiver, sender_calls, receiver_calls
+
+
+def measure(name, n_messages, n_bytes, send, receive):
+    sender, receiver, sender_calls, receiver_calls = connection()
+    thread = threading.Thread(target=receive, args=(receiver,))
+    start = time.perf_counter()
+    thread.start()
+    send(sender)
+    thread.join()
+    elapsed = time.perf_counter() - start
+    sender.close()
+    receiver.close()
+    print(f"{name:<24} {n_messages / elapsed:>10,.0f} msg/s {n_bytes / elapsed / 2**20:>8,.0f} MiB/s   "
+          f"calls per message: send {sum(sender_calls.values()) / n_messages:.2f}, receive {sum(receiver_calls.values()) / n_messages:.2f}")
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    batch = lambda sock: sock.batch() if hasattr(sock, "batch") else nullcontext() # Socket.batch does not exist in older versions
+
+    def send_requests(sock, batched=False):
+        for _ in range(n):
+            with batch(sock) if batched else nullcontext():
+                sock.send_code(NT_Code.REQ_FILE)
+                sock.send_str("directory")
+                sock.send_str("folder/file.txt")
+    def receive_requests(sock):
+        for _ in range(n):
+            sock.recv_code()
+            sock.recv_str()
+            sock.recv_str()
+    measure("requests", 3 * n, 0, send_requests, receive_requests)
+    measure("requests (batched)", 3 * n, 0, lambda sock: send_requests(sock, True), receive_requests)
+
+    def send_multi(sock):
+        for i in range(n // 10): sock.send_multi("uuid", {"directory": "name"}, 1)
+    def receive_multi(sock):
+        for _ in range(n // 10): sock.recv_multi()
+    measure("send_multi", 4 * (n // 10), 0, send_multi, receive_multi)
+
+    payload = os.urandom(1024 * 1024)
+    def send_objects(sock):
+        for _ in range(n // 250): sock.send_obj(payload, pickle_obj=False)
+    def receive_objects(sock):
+        for _ in range(n // 250): sock.recv_obj(unpickle=False)
+    measure("1 MiB objects", n // 250, n // 250 * len(payload), send_objects, receive_objects)
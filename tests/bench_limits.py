@@ -0,0 +1,56 @@
+from test_utils import this
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from src.Limits import Limits
+from src.Network import Socket
+
+
+# Measures how a shared upload limit (src/Limits.py) is split between two peers: peer "a" sends the file on 4 connections at the
+# same time, peer "b" on 1. Each peer should get about half of the rate no matter how many connections it uses.
+# Both ends run in this process, connected by socketpairs.
+# usage: python bench_limits.py [rate in MiB/s] [seconds]
+
+
+def send(conn, path, stop):
+    while not stop.is_set(): conn.send_file(path)
+    conn.close()
+
+
+def receive(conn, store_path, received, peer):
+    try:
+        while True:
+            conn.recv_file(store_path)
+            received[peer] += os.path.getsize(store_path)
+    except ConnectionResetError: pass
+
+
+if __name__ == "__main__":
+    rate = int(float(sys.argv[1]) * 2**20) if len(sys.argv) > 1 else 8 * 2**20
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    limits = Limits(upload=rate)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "file")
+        with open(path, "wb") as file: file.write(os.urandom(2**20))
+        received, stop, threads = {"a": 0, "b": 0}, threading.Event(), []
+        for i, peer in enumerate("aaaab"):
+            a, b = socket.socketpair()
+            sender, receiver = Socket(a), Socket(b)
+            sender.limits, sender.peer = limits, peer
+            threads.append(threading.Thread(target=send, args=(sender, path, stop)))
+            threading.Thread(target=receive, args=(receiver, os.path.join(directory, f"received{i}"), received, peer), daemon=True).start()
+        start = time.perf_counter()
+        for thread in threads: thread.start()
+        time.sleep(duration)
+        a, b = received["a"], received["b"] # files that are still being sent are not counted
+        elapsed = time.perf_counter() - start
+        stop.set()
+        for thread in threads: thread.join()
+        print(f"limit                    {rate / 2**20:>8.1f} MiB/s")
+        print(f"peer a (4 connections)   {a / elapsed / 2**20:>8.1f} MiB/s")
+        print(f"peer b (1 connection)    {b / elapsed / 2**20:>8.1f} MiB/s")
+        print(f"total                    {(a + b) / elapsed / 2**20:>8.1f} MiB/s, waited {limits.upload.stats()['waited']:.1f} s")
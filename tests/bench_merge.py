@@ -0,0 +1,123 @@
+from test_utils import this
+import copy
+import datetime
+import random
+import sys
+import time
+from pathlib import Path
+
+from src.Codes import CONFLICT_TYPE
+from src.FileTracker import File, Folder
+from src.utils import to_micros
+
+
+# Measures how long merging two directory graphs takes and checks that the merge engine (src/Merge.py) takes the same decisions
+# as the recursive merge it replaced (recursive_merge below).
+# usage: python bench_merge.py [number of files ...]
+
+
+LAST_SYNC = datetime.datetime(2024, 1, 1)
+
+
+def recursive_merge(self, other, last_time_synced, conflict_callback):
+    """ Folder.merge before the merge engine (reference) """
+    for file in other.files:
+        if not self.is_in_ignore(self.rel_path / file, is_file=True):
+            other_file = File(file, self, update_on_creation=False)
+            if other.files[file].exists:
+                if file not in self.files:
+                    self.files[file] = other_file
+                elif self.files[file].hash != other.files[file].hash and other.files[file].is_modified(last_time_synced):
+                    if self.files[file].is_modified(last_time_synced):
+                        conflict_callback(self, other, file, other_file, False, CONFLICT_TYPE.MODIF_CONFLICT)
+                    elif not self.files[file].exists:
+                        conflict_callback(self, other, file, other_file, False, CONFLICT_TYPE.DELETE_CONFLICT)
+                    else:
+                        self.files[file] = other_file
+            else:
+                if file in self.files:
+                    if self.files[file].is_modified(last_time_synced):
+                        conflict_callback(self, other, file, other_file, False, CONFLICT_TYPE.DELETE_CONFLICT)
+                    else:
+                        self.files[file].deleted()
+
+    for folder in other.folders:
+        if not self.is_in_ignore(self.rel_path / folder, is_file=False):
+            other_folder = Folder(folder, self, update_on_creation=False)
+            if other.folders[folder].exists:
+                if folder not in self.folders:
+                    self.folders[folder] = other_folder
+                if not self.folders[folder].exists:
+                    conflict_callback(self, other, folder, other_folder, True, CONFLICT_TYPE.DELETE_CONFLICT)
+                recursive_merge(self.folders[folder], other.folders[folder], last_time_synced, conflict_callback)
+            else:
+                if folder in self.folders:
+                    if self.folders[folder].is_modified(last_time_synced):
+                        conflict_callback(self, other, folder, other_folder, True, CONFLICT_TYPE.DELETE_CONFLICT)
+                    else:
+                        self.folders[folder].deleted()
+
+
+def random_state(node, rng, deleted=0.1):
+    """ random timestamps around LAST_SYNC, some entries deleted """
+    before, after = to_micros(LAST_SYNC) - 10**9, to_micros(LAST_SYNC) + 10**9
+    node._created = rng.choice((before, after))
+    node._modified = rng.choice((node._created, after))
+    if rng.random() < deleted: node._deleted, node._created, node._modified = after, 0, 0
+
+
+def create_graphs(n_files, files_per_folder=100, seed=0):
+    """ two graphs of roughly *n_files* files that share most of their entries, with random changes on both sides """
+    rng = random.Random(seed)
+    roots = [Folder.root(Path(f"/bench/{side}"), ["*.ign"], update_on_creation=False) for side in ("local", "remote")]
+    for i in range(0, n_files, files_per_folder):
+        parts = (f"folder_{i // files_per_folder // 100}", f"sub_folder_{i // files_per_folder}")
+        for root in roots:
+            folder = root
+            for part in parts:
+                if part not in folder.folders:
+                    folder.folders[part] = Folder(part, folder, update_on_creation=False)
+                    random_state(folder.folders[part], rng, deleted=0.02 if folder is not root else 0)
+                folder = folder.folders[part]
+            for n in range(i, min(n_files, i + files_per_folder)):
+                if rng.random() < 0.05: continue # only on one side
+                name = f"file_{n}.ign" if n % 500 == 0 else f"file_{n}.txt"
+                file = folder.files[name] = File(name, folder, update_on_creation=False)
+                file.hash = f"{n}-{rng.random() < 0.1}".encode()
+                random_state(file, rng)
+    return roots
+
+
+def conflict_recorder(conflicts):
+    """ records the conflicts and resolves about half of them with the remote version (like RESOLVE_POLICY.USE_REMOTE) """
+    def callback(local_folder, remote_folder, name, remote_obj, is_dir, conflict_type):
+        conflicts.append(((*local_folder._parts(), name), is_dir, conflict_type))
+        if sum(map(ord, name)) % 2: (local_folder.folders if is_dir else local_folder.files)[name] = remote_obj
+    return callback
+
+
+def state(folder, parts=()):
+    """ everything the sync acts on: which entries exist and which ones have to be downloaded (hash 0) """
+    entries = {}
+    for name, file in folder.files.items(): entries[(*parts, name)] = (file.exists, file.hash)
+    for name, sub_folder in folder.folders.items():
+        entries[(*parts, name, "/")] = sub_folder.exists
+        entries.update(state(sub_folder, (*parts, name)))
+    return entries
+
+
+def run(merge, local, remote):
+    local, conflicts = copy.deepcopy(local), []
+    start = time.perf_counter()
+    merge(local, remote, LAST_SYNC, conflict_recorder(conflicts))
+    return time.perf_counter() - start, state(local), sorted(conflicts)
+
+
+if __name__ == "__main__":
+    for n_files in map(int, sys.argv[1:] or (10_000, 100_000, 1_000_000)):
+        local, remote = create_graphs(n_files)
+        new_time, new_state, new_conflicts = run(Folder.merge, local, remote)
+        old_time, old_state, old_conflicts = run(recursive_merge, local, remote)
+        assert new_state == old_state, "merged graphs differ"
+        assert new_conflicts == old_conflicts, "conflicts differ"
+        print(f"{n_files:>9} files  recursive: {old_time:8.3f}s  merge engine: {new_time:8.3f}s  ({len(new_conflicts)} conflicts, same decisions)")
@@ -0,0 +1,59 @@
+from test_utils import this
+import gc
+import logging
+import shutil
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+from src.FileTracker import Directory
+
+
+# Measures memory per tracked file and the time it takes to build/load directory graphs.
+# usage: python bench_nodes.py [number of files]
+
+
+class LoggingSettings: # no log files for benchmarks
+    def create_logger(self, name, file_name): return logging.getLogger(name)
+
+
+def create_tree(path:Path, n_files, files_per_folder=100):
+    shutil.rmtree(path, ignore_errors=True)
+    for i in range(n_files):
+        folder = path / f"folder_{i // files_per_folder // 100}" / f"sub_folder_{i // files_per_folder}"
+        if i % files_per_folder == 0: folder.mkdir(parents=True)
+        (folder / f"file_{i}.txt").write_text(str(i))
+
+
+def load(tree, save):
+    directory = Directory(tree, save, [], [], LoggingSettings(), None)
+    directory.root # loads the snapshot and rescans the directory
+    return directory
+
+
+def measure(name, n_files, build):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"{name:<16} {elapsed:8.3f}s {memory / 2**20:10.1f} MiB {memory / n_files:10.0f} bytes/file")
+    return result
+
+
+if __name__ == "__main__":
+    n_files = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    tree, save = this / "bench_tree", this / "bench_save"
+    create_tree(tree, n_files)
+    shutil.rmtree(save, ignore_errors=True)
+    save.mkdir()
+
+    print(f"{n_files} files")
+    measure("scan", n_files, lambda: Directory(tree, save, [], [], LoggingSettings(), None))
+    measure("load + rescan", n_files, lambda: load(tree, save))
+
+    shutil.rmtree(tree)
+    shutil.rmtree(save)
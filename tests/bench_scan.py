@@ -0,0 +1,60 @@
+from test_utils import this
+import os
+import shutil
+import sys
+import time
+from collections import Counter
+
+import src.FileTracker as FileTracker
+from src.FileTracker import Directory
+from bench_nodes import LoggingSettings, create_tree
+
+
+# Counts the file system calls a directory scan makes per file (each of them is one syscall on Linux).
+# Listing a directory with scandir also tells the type of the entries (d_type), so only stat calls are left per file.
+# usage: python bench_scan.py [number of files]
+
+
+calls = Counter()
+
+def counting(name, function):
+    def wrapper(*args, **kwargs):
+        calls[name] += 1
+        return function(*args, **kwargs)
+    return wrapper
+
+def audit(event, args): # opens (hashing) and directory listings
+    if event in ("open", "os.scandir", "os.listdir"): calls[event] += 1
+
+
+def measure(name, n_files, scan):
+    calls.clear()
+    start = time.perf_counter()
+    scan()
+    elapsed = time.perf_counter() - start
+    counts = "  ".join(f"{call}: {count / n_files:.2f}" for call, count in sorted(calls.items()))
+    print(f"{name:<16} {elapsed:8.3f}s  per file: {sum(calls.values()) / n_files:.2f} calls ({counts})")
+
+
+if __name__ == "__main__":
+    n_files = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    tree, save = this / "bench_tree", this / "bench_save"
+    create_tree(tree, n_files)
+    shutil.rmtree(save, ignore_errors=True)
+    save.mkdir()
+
+    os.stat, os.lstat = counting("stat", os.stat), counting("lstat", os.lstat)
+    FileTracker.entry_stat = counting("stat", FileTracker.entry_stat) # stat of a scandir entry
+    sys.addaudithook(audit)
+
+    print(f"{n_files} files")
+    directory = None
+    def scan():
+        global directory
+        directory = Directory(tree, save, [], [], LoggingSettings(), None)
+    measure("scan + hash", n_files, scan)
+    measure("rescan", n_files, lambda: directory.update())
+    measure("full rescan", n_files, lambda: directory.update(full=True))
+
+    shutil.rmtree(tree)
+    shutil.rmtree(save)
@@ -0,0 +1,85 @@
+from test_utils import this
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from src.Network import NT_Code, Socket
+from src.Streams import Multiplexer
+
+
+# Measures how long small requests take while a large file is sent on another stream of the same connection (src/Streams.py).
+# Without streams, a request sent during the transfer has to wait until the whole file has been received.
+# Both ends run in this process, connected by a socketpair.
+# usage: python bench_streams.py [file size in MiB]
+
+
+def serve(conn):
+    """ answers REQ_DIR_LST with a small object and REQ_FILE with the file whose path is sent """
+    try:
+        while True:
+            code = conn.recv_code()
+            if code == NT_Code.REQ_DIR_LST: conn.send_obj(["directory"])
+            elif code == NT_Code.REQ_FILE: conn.send_file(conn.recv_str())
+    except ConnectionResetError: pass
+    finally: conn.close()
+
+
+def connection():
+    a, b = socket.socketpair()
+    client, server = Socket(a), Socket(b)
+    client_mux = Multiplexer(client)
+    server_mux = Multiplexer(server, lambda stream: threading.Thread(target=serve, args=(Socket(stream),)).start())
+    threading.Thread(target=client_mux.run, daemon=True).start()
+    threading.Thread(target=server_mux.run, daemon=True).start()
+    return client_mux, server_mux
+
+
+def request(mux):
+    conn = Socket(mux.open())
+    start = time.perf_counter()
+    conn.send_code(NT_Code.REQ_DIR_LST)
+    conn.recv_obj()
+    conn.close()
+    return time.perf_counter() - start
+
+
+def download(mux, path, store_path):
+    conn = Socket(mux.open())
+    with conn.batch():
+        conn.send_code(NT_Code.REQ_FILE)
+        conn.send_str(path)
+    conn.recv_file(store_path)
+    conn.close()
+
+
+if __name__ == "__main__":
+    size = (int(sys.argv[1]) if len(sys.argv) > 1 else 256) * 2**20
+    with tempfile.TemporaryDirectory() as directory:
+        path, store_path = os.path.join(directory, "file"), os.path.join(directory, "received")
+        with open(path, "wb") as file: file.write(os.urandom(size))
+        client_mux, server_mux = connection()
+
+        idle = [request(client_mux) for _ in range(1000)]
+        print(f"request (idle connection)        median {statistics.median(idle) * 1e6:>8,.0f} µs")
+
+        start = time.perf_counter()
+        download(client_mux, path, store_path)
+        elapsed = time.perf_counter() - start
+        print(f"file alone                       {size / elapsed / 2**20:>8,.0f} MiB/s")
+
+        transfer = threading.Thread(target=download, args=(client_mux, path, store_path))
+        start = time.perf_counter()
+        transfer.start()
+        busy = []
+        while transfer.is_alive(): busy.append(request(client_mux))
+        transfer.join()
+        elapsed = time.perf_counter() - start
+        print(f"file with requests in between    {size / elapsed / 2**20:>8,.0f} MiB/s")
+        print(f"request (during the transfer)    median {statistics.median(busy) * 1e6:>8,.0f} µs, max {max(busy) * 1e6:,.0f} µs ({len(busy)} requests)")
+        print(f"request without streams would wait for the rest of the file: up to {elapsed * 1e6:,.0f} µs")
+        client_mux.close()
+        server_mux.close()
@@ -53,6 +53,8 @@ def add_Sync(uuid, local, remote, loc_ign, sync_ign, policy, default, auto_sync,
     webgui.request(UI_Code.UUID_ADD_SYNC, uuid, local, remote)
 @eel.expose
 def sync(uuid, local, remote): webgui.request(UI_Code.UUID_SYNC, uuid, local, remote)
+@eel.expose
+def get_sync_stats(): return webgui.request(UI_Code.REQ_SYNC_STATS)
 
 
 @eel.expose